@@ -22,6 +22,9 @@ Options:
                                     [default : '/tmp/']
     -b, --bids-dir BIDSDIR          Specify BIDS directory to use
                                     [default : 'TMPDIR/bids']
+    --bids-database DBDIR           Keep a pybids database of BIDSDIR at DBDIR, updated before jobs
+                                    are submitted and given to fmriprep and mriqc so they don't
+                                    index BIDSDIR themselves. Needs --bids-dir
     -w, --walltime WALLTIME         Specify a walltime to use for the qsub submission
                                     [default : '24:00:00']
     -l, --log LOGDIR                Specify additional bids-app log output directory
@@ -30,6 +33,8 @@ Options:
                                     for detecting whether a participant has already been run
                                     [default : None]
     -e, --exclude EXCLUDE,...       Tag to exclude from BIDS-app processing [repeatable option] - you will have to specify BIDS naming convention here!
+    -p, --pack K                    Number of subject groups to run in each job, through a single
+                                    BIDS-app call [default: 1]
     --DRYRUN                        Perform a dry-run, script will be generated at tmp-dir
 
 
@@ -53,6 +58,22 @@ Notes on arguments:
     indicated in the json file under bidsarg for the particular pipeline. This is done so the number
     of processors per node requested matches that of the expected amount of available cores for the bids-apps
 
+    option "bids-database" is worth using when --bids-dir is a large shared BIDS folder, which
+    fmriprep and mriqc otherwise index at the start of every job. Before submitting, the subjects
+    are converted to BIDSDIR with dm_to_bids and, if any session was converted since the
+    database was built, it's rebuilt once with the python in <img> (pybids' database needs
+    python 3 and should match the pybids version the app reads it with). The conversion each
+    job then runs is a no-op. The database isn't updated by --DRYRUN.
+
+    option "pack" runs K subject groups in each job, passing all of their participant labels
+    to one BIDS-app call. This saves the container start up, dm_to_bids set up and scheduling of
+    K-1 jobs, which is a large part of the run time for short sessions. The threads given in
+    bidsargs are per subject group and are multiplied by the size of each pack (as is the qsub
+    request). Packed jobs write one log for the pack, which is copied to each subject's log when
+    the job succeeds. Existing freesurfer reconstructions are fetched for each subject group in
+    the pack that has a single session, the same as for unpacked jobs. Groups with several
+    sessions (longitudinal runs) are reconstructed by the BIDS-app.
+
 
 Requirements:
     FSL - dm_to_bids.py requires it to run
@@ -83,9 +104,11 @@ import sys
 import datman.config
 import logging
 import tempfile
+import shutil
 import subprocess as proc
 from docopt import docopt
 import json
+import glob
 from functools import partial
 import datman.scanid as scan_ident
 
@@ -93,6 +116,11 @@ logging.basicConfig(level=logging.WARN,
         format='[%(name)s %(levelname)s : %(message)s]')
 logger = logging.getLogger(os.path.basename(__file__))
 
+#Bytes at the end of a log checked for errors, when a subject isn't in the ledger
+LOG_TAIL_SIZE = 64 * 1024
+#Written by dm_to_bids in each BIDS session it converts
+BIDS_MANIFEST_NAME = '.datman_bids_manifest.json'
+
 def get_sub_ident(subject):
     '''
     Convenience function for wrapping try/catch around parsing subject identifier
@@ -245,7 +273,7 @@ def get_dict_args(arg_dict):
 
     return args
 
-def get_init_cmd(study,sgroup,bids_dir,tmp_dir,out_dir,simg,log_tag):
+def get_init_cmd(study,sgroup,bids_dir,tmp_dir,out_dir,simg,log_tag,ledger=None):
     '''
     Get initialization steps prior to running BIDS-apps
 
@@ -257,15 +285,25 @@ def get_init_cmd(study,sgroup,bids_dir,tmp_dir,out_dir,simg,log_tag):
         out_dir                     Location of output directory
         simg                        Singularity image location
         log_cmd                     A redirect toward logging
+        ledger                      Ledger file to record the job's exit status in for
+                                    each participant (see read_ledger)
     '''
 
+    record_cmd = '''
+        STATUS=$?
+        for LABEL in $SUB; do
+            printf "sub-%s\\t%s\\t%s\\n" $LABEL $STATUS $(date +%s) >> {ledger}
+        done
+    '''.format(ledger=ledger) if ledger else ''
+
     trap_cmd = '''
 
-    function cleanup(){
+    function cleanup(){{
+        {record}
         rm -rf $APPHOME
-    }
+    }}
 
-    '''
+    '''.format(record=record_cmd.strip())
 
     init_cmd = '''
 
@@ -273,7 +311,7 @@ def get_init_cmd(study,sgroup,bids_dir,tmp_dir,out_dir,simg,log_tag):
     BIDS={bids}
     WORK=$APPHOME/work
     SIMG={simg}
-    SUB={sub}
+    SUB="{sub}"
     OUT={out}
 
     mkdir -p $BIDS
@@ -286,13 +324,22 @@ def get_init_cmd(study,sgroup,bids_dir,tmp_dir,out_dir,simg,log_tag):
     '''.format(home=os.path.join(tmp_dir,'home.XXXXX'),
             bids='$APPHOME/bids' if bids_dir==tmp_dir else bids_dir,
             simg=simg,
-            sub=get_bids_name(sgroup).replace('sub-',''),
+            sub=get_participant_labels(sgroup),
             out=out_dir,
             log_tag=log_tag.replace('&>>','&>'))
     #The log replace bit is to ensure that logs are wiped prior to appending for easier error tracking on re-runs
 
     return [trap_cmd,init_cmd]
 
+def get_participant_labels(sgroup):
+    '''
+    Returns the BIDS participant label of a subject group, or the space separated labels of
+    a pack of subject groups
+    '''
+
+    sgroups = sgroup if isinstance(sgroup, (list, tuple)) else [sgroup]
+    return ' '.join(get_bids_name(s).replace('sub-','') for s in sgroups)
+
 def get_nii_to_bids_cmd(study,sublist,log_tag):
 
     n2b_cmd = '''
@@ -303,9 +350,77 @@ def get_nii_to_bids_cmd(study,sublist,log_tag):
 
     return n2b_cmd
 
+def database_outdated(bids_dir,bids_db):
+    '''
+    Returns True if the BIDS database is missing or older than any session's dm_to_bids
+    manifest (i.e. a session was converted after the database was built)
+    '''
+
+    try:
+        built = os.path.getmtime(bids_db)
+    except OSError:
+        return True
+    manifests = glob.glob(os.path.join(bids_dir,'sub-*','ses-*',BIDS_MANIFEST_NAME))
+    return any(os.path.getmtime(m) > built for m in manifests)
+
+def get_index_cmd(simg,bids_dir,db_dir):
+    '''
+    Returns the command that indexes bids_dir into a pybids database at db_dir, run with the
+    python in the BIDS-app container so the database is written by the pybids the app reads it with
+    '''
+
+    index_script = ("from bids import BIDSLayout; "
+            "BIDSLayout('/bids', validate=False, database_path='/bids_db', reset_database=True)")
+    return ['singularity','exec','-B','{}:/bids'.format(bids_dir),
+            '-B','{}:/bids_db'.format(db_dir),simg,'python','-c',index_script]
+
+def update_bids_database(study,sublist,bids_dir,simg,bids_db):
+    '''
+    Converts the subjects to the shared BIDS folder and rebuilds its pybids database, once, before
+    any job is submitted. The database is built next to bids_db and then moved into place, so an
+    app still reading the old one is never given a partial index
+
+    Arguments:
+        study                       DATMAN-style study shortname
+        sublist                     Datman subject IDs to convert
+        bids_dir                    Shared BIDS directory
+        simg                        Singularity image of the BIDS-app
+        bids_db                     Location of the database
+
+    Output:
+        False if the database couldn't be built
+    '''
+
+    if proc.call(['dm_to_bids.py',study,'--bids-dir',bids_dir] + sublist) != 0:
+        logger.warning('dm_to_bids.py failed for some subjects, indexing what was converted')
+
+    if not database_outdated(bids_dir,bids_db):
+        logger.info('BIDS database {} is up to date'.format(bids_db))
+        return True
+
+    parent = os.path.dirname(bids_db)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    new_db = tempfile.mkdtemp(prefix='.bids_db_',dir=parent)
+    logger.info('Indexing {} into {}'.format(bids_dir,bids_db))
+    if proc.call(get_index_cmd(simg,os.path.abspath(bids_dir),new_db)) != 0:
+        logger.error('Failed to index {} into {}'.format(bids_dir,bids_db))
+        shutil.rmtree(new_db,ignore_errors=True)
+        return False
+
+    old_db = None
+    if os.path.exists(bids_db):
+        old_db = tempfile.mkdtemp(prefix='.bids_db_old_',dir=parent)
+        os.rename(bids_db,os.path.join(old_db,'db'))
+    os.rename(new_db,bids_db)
+    if old_db:
+        shutil.rmtree(old_db,ignore_errors=True)
+    return True
+
 def fetch_fs_recon(fs_dir,out_dir,subject):
     '''
-    Copies over freesurfer reconstruction to fmriprep pipeline output
+    Syncs the freesurfer reconstruction to the fmriprep pipeline output. Only new or
+    changed files are updated, and they're hardlinked where possible
 
     Arguments:
         fs_dir                              Directory to freesurfer $SUBJECTS_DIR
@@ -317,22 +432,17 @@ def fetch_fs_recon(fs_dir,out_dir,subject):
     sub_fmriprep_fs = os.path.join(out_dir,'freesurfer',get_bids_name(subject))
 
     if os.path.isdir(fs_sub_dir):
-        logger.info('Located Freesurfer reconstruction files for {}, rsync to {} enabled'.format(
+        logger.info('Located Freesurfer reconstruction files for {}, sync to {} enabled'.format(
             subject,sub_fmriprep_fs))
 
-        try:
-            os.makedirs(sub_fmriprep_fs)
-        except OSError:
-            logger.warning('Failed to create directory, {} already exists!'.format(sub_fmriprep_fs))
-
-        #Rsyc, dereference
-        rsync_cmd = '''
+        #Follows links, skips unchanged files
+        sync_cmd = '''
 
-        rsync -L -a {recon_dir}/ {out_dir}
+        dm_sync_tree.py --mode hardlink {recon_dir} {out_dir}
 
         '''.format(recon_dir=fs_sub_dir,out_dir=sub_fmriprep_fs)
 
-        return rsync_cmd
+        return sync_cmd
     else:
         logger.info('No freesurfer reconstruction files located for {}'.format(subject))
         return ''
@@ -355,31 +465,40 @@ def get_symlink_cmd(fs_dir,out_dir,subject):
 
     return [remove_cmd, symlink_cmd]
 
-def get_existing_freesurfer(jargs,sub_dir,subject):
+def get_existing_freesurfer(jargs,sub_dir,sublist):
 
     '''
-    Provide commands to fetch subject's freesurfer and symlink over
+    Provide commands to fetch subjects' freesurfer and symlink over
     Arguments:
         jargs                           Dictionary of bids app json file
         sub_dir                         Full path to subject's output directory
-        subject                         Subject name (DATMAN-style ID)
+        sublist                         List of DATMAN-style session IDs in the job
+
+    Only subject groups with a single session get their reconstruction fetched,
+    the recon of one session can't be reused for a longitudinal run
     '''
 
     symlink_cmd_list = []
     fetch_cmd = ''
 
-    #Indicates multiple subjects
-    if len(subject) > 1:
-        return (fetch_cmd,symlink_cmd_list)
-
-    try:
-        fetch_cmd = fetch_fs_recon(jargs['freesurfer-dir'],sub_dir,subject)
-    except KeyError:
+    if 'freesurfer-dir' not in jargs:
         logger.warning('freesurfer-dir not specified in JSON!')
         logger.warning('Will run fmriprep from scratch if freesurfer BIDS output does not exist in output-dir')
-    else:
-        if jargs['keeprecon'] and (fetch_cmd != ''):
-            symlink_cmd_list = get_symlink_cmd(fs_dir,sub_dir,subject)
+        return (fetch_cmd,symlink_cmd_list)
+
+    for group, sessions in sorted(group_subjects(sublist).items()):
+
+        #Indicates multiple sessions
+        if len(sessions) > 1:
+            logger.info('{} has {} sessions, not fetching freesurfer'.format(
+                group,len(sessions)))
+            continue
+
+        subject = sessions[0]
+        sub_fetch_cmd = fetch_fs_recon(jargs['freesurfer-dir'],sub_dir,subject)
+        fetch_cmd += sub_fetch_cmd
+        if jargs['keeprecon'] and (sub_fetch_cmd != ''):
+            symlink_cmd_list += get_symlink_cmd(jargs['freesurfer-dir'],sub_dir,subject)
 
     return (fetch_cmd,symlink_cmd_list)
 
@@ -431,7 +550,7 @@ def fmriprep_fork(jargs,log_tag,out_dir,sublist):
     fetch_cmd, symlink_cmd_list = get_existing_freesurfer(jargs,out_dir,sublist)
 
     #Get BIDS singularity call
-    bids_cmd = fmriprep_cmd(jargs['bidsargs'],log_tag)
+    bids_cmd = fmriprep_cmd(jargs['bidsargs'],log_tag,jargs.get('bids-database'))
 
     #Copy license, fetch freesurfer, run BIDSapp then symlink if KeepRecon false
     return [license_cmd, fetch_cmd, bids_cmd] + symlink_cmd_list
@@ -482,7 +601,16 @@ def ciftify_fork(jargs,log_tag,out_dir,sublist):
     return [license_cmd, fetch_cmd, bids_cmd] + symlink_cmd_list
 
 
-def fmriprep_cmd(bids_args,log_tag):
+def get_database_args(bids_db):
+    '''
+    Returns the singularity bind and BIDS-app argument for a pybids database, if one is used
+    '''
+
+    if not bids_db:
+        return ('', '')
+    return ('-B {}:/bids_db'.format(bids_db), '--bids-database-dir /bids_db')
+
+def fmriprep_cmd(bids_args,log_tag,bids_db=None):
 
     '''
     Formulates fmriprep bash script content to be written into job file
@@ -491,6 +619,7 @@ def fmriprep_cmd(bids_args,log_tag):
 
         bids_args                           bidsargs in JSON file
         log_tag                             String tag for BASH stout/err redirection to log
+        bids_db                             pybids database of $BIDS to use, if any
 
     Output:
         bids_cmd                            Formatted singularity bids app call
@@ -498,16 +627,18 @@ def fmriprep_cmd(bids_args,log_tag):
     '''
 
     append_args = [' '.join([k,v]) for k,v in bids_args.items()]
+    db_bind, db_arg = get_database_args(bids_db)
 
     bids_cmd = '''
 
-    singularity run -H $APPHOME -B $BIDS:/bids -B $WORK:/work -B $OUT:/out -B $LICENSE:/li \\
+    singularity run -H $APPHOME -B $BIDS:/bids -B $WORK:/work -B $OUT:/out -B $LICENSE:/li {db_bind} \\
     $SIMG \\
     /bids /out participant -w /work \\
     --participant-label $SUB \\
-    --fs-license-file /li/license.txt {args} {log_tag}
+    --fs-license-file /li/license.txt {db_arg} {args} {log_tag}
 
-    '''.format(args = ' '.join(append_args), log_tag=log_tag)
+    '''.format(args = ' '.join(append_args), log_tag=log_tag,
+            db_bind=db_bind, db_arg=db_arg)
 
     return bids_cmd
 
@@ -529,16 +660,18 @@ def mriqc_fork(jargs,log_tag,out_dir=None,sublist=None):
 
     bids_args = jargs['bidsargs']
     append_args = [' '.join([k,v]) for k,v in bids_args.items()]
+    db_bind, db_arg = get_database_args(jargs.get('bids-database'))
 
     mrqc_cmd = '''
 
-    singularity run -H $APPHOME -B $BIDS:/bids -B $WORK:/work -B $OUT:/out \\
+    singularity run -H $APPHOME -B $BIDS:/bids -B $WORK:/work -B $OUT:/out {db_bind} \\
     $SIMG \\
     /bids /out participant -w /work \\
     --participant-label $SUB \\
-    {args} {log_tag}
+    {db_arg} {args} {log_tag}
 
-    '''.format(args = ' '.join(append_args), log_tag=log_tag)
+    '''.format(args = ' '.join(append_args), log_tag=log_tag,
+            db_bind=db_bind, db_arg=db_arg)
 
     return [mrqc_cmd]
 
@@ -607,7 +740,7 @@ def submit_jobfile(job_file,subject,queue,walltime='24:00:00',threads=1,partitio
     logger.info('Removing jobfile...')
     os.remove(job_file)
 
-def gen_log_redirect(log_dir,subject,app_name):
+def gen_log_redirect(log_dir,subject,app_name,log_name=None):
     '''
     Convenient function to generate a stdout/stderr redirection to a log file
 
@@ -636,7 +769,7 @@ def gen_log_redirect(log_dir,subject,app_name):
             raise
 
     #Generate base command for default log output
-    log_name = '{}_{}.log'.format(get_bids_name(subject),app_name)
+    log_name = log_name or '{}_{}.log'.format(get_bids_name(subject),app_name)
     base_redir = ' &>> {}'.format(os.path.join(log_dir,log_name))
 
     return base_redir
@@ -663,6 +796,43 @@ def get_requested_threads(jargs, thread_dict):
         else:
             return n_threads
 
+def scale_threads(jargs, thread_dict, factor):
+    '''
+    Multiplies the threads requested in bidsargs by factor so a packed job gets the same
+    number of threads per subject group. Returns the new number of threads, or None if
+    the json doesn't request any
+    '''
+
+    n_threads = get_requested_threads(jargs, thread_dict)
+    if n_threads is None:
+        return None
+
+    n_threads = int(float(n_threads)) * factor
+    jargs['bidsargs'][thread_dict[jargs['app'].upper()]] = str(n_threads)
+    return n_threads
+
+def pack_groups(groups, pack_size):
+    '''
+    Splits the subject group IDs into lists of at most pack_size, each run by one job
+    '''
+
+    groups = sorted(groups)
+    return [groups[i:i + pack_size] for i in range(0, len(groups), pack_size)]
+
+def get_pack_log_cmd(log_dir, pack, app_name):
+    '''
+    Returns a command that copies a pack's log to the log of each subject group, so each
+    can be checked separately when deciding what to re-run
+    '''
+
+    pack_log = os.path.join(log_dir, get_pack_log_name(pack, app_name))
+    cmds = ['cp {} {}'.format(pack_log, os.path.join(log_dir,
+            '{}_{}.log'.format(get_bids_name(s), app_name))) for s in pack]
+    return '\n    {}\n'.format('\n    '.join(cmds))
+
+def get_pack_log_name(pack, app_name):
+    return 'pack_{}_{}_{}.log'.format(get_bids_name(pack[0]), len(pack), app_name)
+
 def group_subjects(subjects):
 
     '''
@@ -682,11 +852,42 @@ def group_subjects(subjects):
 
     return group_dict
 
+def get_ledger_path(log_dir,bids_app):
+    '''
+    Path of the ledger that the jobs of a BIDS-app record their exit status in
+    '''
+
+    return os.path.join(log_dir,'{}_ledger.tsv'.format(bids_app))
+
+def read_ledger(ledger):
+    '''
+    Reads a BIDS-app's ledger, where each job appends a tab separated line of
+    '<BIDS participant> <exit status> <time>' for each of its participants when it ends.
+
+    Output:
+        A dictionary mapping each BIDS participant name to the exit status of its latest job
+    '''
+
+    statuses = {}
+    try:
+        with open(ledger) as ledger_file:
+            for line in ledger_file:
+                fields = line.split()
+                if len(fields) < 2:
+                    #A line being written by a job that's ending
+                    continue
+                statuses[fields[0]] = fields[1]
+    except IOError:
+        pass
+
+    return statuses
+
 def filter_subjects(subjects,out_dir,bids_app,log_dir):
 
     '''
-    Filters out subjects that have successfully completed the BIDS-pipeline
-    Utilizes default log output (always enabled)
+    Filters out subjects that have successfully completed the BIDS-pipeline.
+    The exit status recorded in the app's ledger is used where there is one, otherwise
+    the end of the subject's log (always enabled) is checked for errors
 
     Arguments:
         subjects                List of candidate subjects to be processed through pipeline
@@ -704,33 +905,48 @@ def filter_subjects(subjects,out_dir,bids_app,log_dir):
 
             'MRIQC'     :   error_in_mriqc,
             'FMRIPREP'  :   error_in_fmriprep,
-            'CIFTIFY_FMRIPREP': error_in_ciftify
+            'FMRIPREP_CIFTIFY': error_in_ciftify
             }
 
     check_logfile = key_map[bids_app]
+    statuses = read_ledger(get_ledger_path(log_dir,bids_app))
 
     for s in subjects:
-        if check_logfile(out_dir,log_file.format(get_bids_name(s),bids_app)):
+        bids_name = get_bids_name(s)
+        if bids_name in statuses:
+            if statuses[bids_name] != '0':
+                run_list.append(s)
+        elif check_logfile(out_dir,log_file.format(bids_name,bids_app)):
             run_list.append(s)
 
     return run_list
 
+def read_tail(log_file, size=LOG_TAIL_SIZE):
+    '''
+    Returns the last 'size' bytes of a file
+    '''
+
+    with open(log_file, 'rb') as log:
+        log.seek(0, os.SEEK_END)
+        log.seek(max(log.tell() - size, 0))
+        return log.read().decode('utf-8', 'replace')
+
 def check_keys_in_file(log_file, keys):
     '''
-    Check if log file is contained within list
+    Check if the end of the log file contains any of the keys
     '''
 
     try:
-        with open(log_file) as log:
-            contents = log.read()
-
-            for key in keys:
-                if key in contents:
-                    return True
+        contents = read_tail(log_file)
     except IOError:
         # If log-file not available, subject needs to be run
         return True
 
+    for key in keys:
+        if key in contents:
+            return True
+    return False
+
 def error_in_mriqc(out_dir, log_file):
     '''
     Search target file for error keywords
@@ -754,7 +970,7 @@ def error_in_ciftify(out_dir, log_file):
     Search target file for error keywords
     '''
 
-    keyword = ['ERROR']
+    keywords = ['ERROR']
     return check_keys_in_file(log_file,keywords)
 
 
@@ -777,12 +993,22 @@ def main():
     rewrite             =   arguments['--rewrite']
     tmp_dir             =   arguments['--tmp-dir'] or '/tmp/'
     bids_dir            =   arguments['--bids-dir'] or tmp_dir
+    bids_db             =   arguments['--bids-database']
     log_dir             =   arguments['--log']
 
     DRYRUN              =   arguments['--DRYRUN']
 
     walltime            =   arguments['--walltime']
 
+    try:
+        pack_size       =   int(arguments['--pack'])
+    except ValueError:
+        logger.error('--pack must be a number, given {}'.format(arguments['--pack']))
+        sys.exit(1)
+    if pack_size < 1:
+        logger.error('--pack must be at least 1')
+        sys.exit(1)
+
     #Strategy pattern dictionary for running different applications
     strat_dict = {
             'FMRIPREP' : fmriprep_fork,
@@ -814,7 +1040,12 @@ def main():
         jargs.update({'keeprecon' : config.get_key('KeepRecon')})
     except datman.config.UndefinedSetting:
         jargs.update({'keeprecon':True})
-    n_thread = get_requested_threads(jargs,thread_dict)
+
+    if bids_db:
+        if not arguments['--bids-dir']:
+            logger.error('--bids-database needs a shared --bids-dir, each job has its own BIDS folder otherwise')
+            sys.exit(1)
+        jargs.update({'bids-database' : os.path.abspath(bids_db.rstrip('/'))})
 
     #Handle partition argument if using slurm
     partition=None
@@ -828,6 +1059,7 @@ def main():
     log_dir = os.path.join(log_dir,jargs['app'].lower())
     log_cmd = partial(gen_log_redirect,log_dir=log_dir)
     exclude_cmd_list = [''] if not exclude else get_exclusion_cmd(exclude)
+    ledger = get_ledger_path(log_dir,jargs['app'])
 
     #Get subjects and filter if not rewrite and group if longitudinal
     #Need better way to manage...
@@ -836,26 +1068,51 @@ def main():
     logger.info('Running {}'.format(subjects))
 
     subjects = group_subjects(subjects)
+    packs = pack_groups(subjects.keys(), pack_size)
+
+    #Build the BIDS database once, instead of in every job
+    if bids_db and not DRYRUN and subjects:
+        sublist = sorted(sub for group in subjects.values() for sub in group)
+        if not update_bids_database(study,sublist,bids_dir,jargs['img'],jargs['bids-database']):
+            sys.exit(1)
+
+    #Threads requested in the json are per subject group
+    thread_args = dict(jargs['bidsargs'])
 
-    #Process subject groups
-    for s in subjects.keys():
+    #Process packs of subject groups
+    for pack in packs:
+
+        if len(pack) == 1:
+            s = pack[0]
+            log_tag = log_cmd(subject=s,app_name=jargs['app'])
+            job_name = s
+            pack_log_cmd = ''
+        else:
+            s = pack
+            log_tag = log_cmd(subject=pack[0],app_name=jargs['app'],
+                    log_name=get_pack_log_name(pack,jargs['app']))
+            job_name = '{}_pack{}'.format(pack[0],len(pack))
+            pack_log_cmd = get_pack_log_cmd(log_dir,pack,jargs['app'])
 
-        #Get subject directory and log tag
-        log_tag = log_cmd(subject=s,app_name=jargs['app'])
+        jargs['bidsargs'] = dict(thread_args)
+        n_thread = scale_threads(jargs,thread_dict,len(pack))
 
         #Get commands
-        init_cmd_list = get_init_cmd(study,s,bids_dir,tmp_dir,out,jargs['img'],log_tag)
-        n2b_cmd = get_nii_to_bids_cmd(study,subjects[s],log_tag)
-        bids_cmd_list = strat_dict[jargs['app']](jargs,log_tag,out,s)
+        sessions = [sub for group in pack for sub in subjects[group]]
+        init_cmd_list = get_init_cmd(study,s,bids_dir,tmp_dir,out,jargs['img'],log_tag,ledger)
+        n2b_cmd = get_nii_to_bids_cmd(study,sessions,log_tag)
+        bids_cmd_list = strat_dict[jargs['app']](jargs,log_tag,out,sessions)
 
         #Write commands to executable and submit
-        master_cmd = init_cmd_list + [n2b_cmd] + exclude_cmd_list + bids_cmd_list +  ['\n cleanup \n']
+        #cleanup runs when the job exits, recording its exit status
+        master_cmd = init_cmd_list + [n2b_cmd] + exclude_cmd_list + bids_cmd_list + \
+                [pack_log_cmd]
         fd, job_file = tempfile.mkstemp(suffix='datman_BIDS_job',dir=tmp_dir)
         os.close(fd)
         write_executable(job_file,master_cmd)
 
         if not DRYRUN:
-            submit_jobfile(job_file,s,queue,walltime,n_thread,partition)
+            submit_jobfile(job_file,job_name,queue,walltime,n_thread,partition)
 
 if __name__ == '__main__':
     main()
@@ -2,6 +2,7 @@
 """
 Usage:
     dm_header_checks.py [options] [--ignore=<STR>]... <series> <standard>
+    dm_header_checks.py [options] [--ignore=<STR>]... --study <study>
 
 Arguments:
     <series>                Full path to the series JSON file being examined
@@ -9,7 +10,14 @@ Arguments:
                             against
 
 Options:
-    --output <PATH>         Full path to store output as a file
+    --study <study>         Check every subject's series JSONs in a study
+                            against the study's gold standards and write all
+                            differences to one table (see below)
+    --processes <N>         Number of processes used to compare series when
+                            checking a whole study [default: 4]
+    --output <PATH>         Full path to store output as a file. When
+                            checking a whole study this defaults to
+                            <meta>/header_diffs.csv
     --ignore <STR>          A dicom header field to ignore. Can be specified
                             more than once. Can be used along with the
                             --ignore-file option
@@ -23,17 +31,46 @@ Options:
                             as the series (or gold standard) with the
                             same file name as the series (or gold standard)
     --ignore-db             Disable attempts to update database
+
+Study mode:
+    Each site's gold standards (<std>/*.json) are read once, with that site's
+    IgnoreHeaderFields removed and its HeaderFieldTolerance applied, the same
+    as dm_qc_report.py. The series JSONs are then compared in parallel and
+    every difference is written as a row of a csv with the columns:
+
+        subject, series, site, tag, field, issue, expected, actual, tolerance
+
+    where 'issue' is one of 'diff', 'missing' (the field isn't in the
+    series' JSON), 'bvals' or 'error' (e.g. there's no gold standard for the
+    tag). Series with no differences have no rows. Phantoms are skipped.
+    Any --ignore, --ignore-file and --tolerance settings apply to every site.
 """
 import os
+import csv
+import glob
 import json
+import logging
+from multiprocessing import Pool
 
 from numpy import isclose
 from docopt import docopt
 
+import datman.config
+import datman.scanid
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+DIFF_COLUMNS = ['subject', 'series', 'site', 'tag', 'field', 'issue',
+        'expected', 'actual', 'tolerance']
+
+# The standards each worker process compares against in --study mode
+_standards = None
+
 def main():
     args = docopt(__doc__)
     series_json = args['<series>']
     standard_json = args['<standard>']
+    study = args['--study']
     output = args['--output']
     ignored_fields = args['--ignore']
     ignore_file = args['--ignore-file']
@@ -47,6 +84,18 @@ def main():
     if tolerances:
         tolerances = read_json(tolerances)
 
+    if study:
+        logging.basicConfig(level=logging.INFO,
+                format="[%(name)s] %(levelname)s: %(message)s")
+        config = datman.config.config(study=study)
+        if not output:
+            output = os.path.join(config.get_path('meta'), 'header_diffs.csv')
+        rows = check_study(config, processes=int(args['--processes']),
+                ignored_fields=ignored_fields, tolerances=tolerances)
+        write_diff_table(rows, output)
+        logger.info("Wrote {} differences to {}".format(len(rows), output))
+        return
+
     diffs = construct_diffs(series_json, standard_json, ignored_fields,
             tolerances, dti)
 
@@ -154,6 +203,186 @@ def write_diff_log(diffs, output_path):
     with open(output_path, 'w') as dest:
         json.dump(diffs, dest)
 
+def find_series(nii_dir):
+    """
+    Returns a list of (series json, identifier, tag) for every correctly
+    named, non-phantom series JSON in a study's nii folder.
+    """
+    paths = sorted(glob.glob(os.path.join(nii_dir, '*', '*.json')))
+    parsed = datman.scanid.parse_filenames(paths)
+    if parsed['errors']:
+        logger.warning("Ignoring {} misnamed JSON files".format(
+                len(parsed['errors'])))
+    series = []
+    for idx, path in enumerate(paths):
+        ident = parsed['ident'][idx]
+        if ident is None or datman.scanid.is_phantom(ident):
+            continue
+        series.append((path, ident, parsed['tag'][idx]))
+    return series
+
+def get_site_settings(config, site, ignored_fields=None, tolerances=None):
+    """
+    Returns the fields to ignore, the field tolerances and a dictionary
+    mapping tags to their qc_type for a site. Any fields or tolerances given
+    are added to those in the site's config.
+    """
+    try:
+        site_ignored = config.get_key('IgnoreHeaderFields', site=site)
+    except datman.config.UndefinedSetting:
+        site_ignored = []
+    try:
+        site_tolerances = dict(config.get_key('HeaderFieldTolerance',
+                site=site))
+    except datman.config.UndefinedSetting:
+        site_tolerances = {}
+    site_tolerances.update(tolerances or {})
+
+    tag_settings = config.get_tags(site=site)
+    qc_types = {}
+    for tag in tag_settings:
+        try:
+            qc_types[tag] = tag_settings.get(tag, 'qc_type')
+        except KeyError:
+            qc_types[tag] = None
+    return (list(site_ignored) + list(ignored_fields or []), site_tolerances,
+            qc_types)
+
+def load_standards(config, sites, ignored_fields=None, tolerances=None):
+    """
+    Reads every gold standard for the given sites once. Returns a dictionary
+    mapping (site, tag) to the standard's path, its contents (with ignored
+    fields already removed), tolerances, whether to check bvals, and the
+    standard's bvals when they're checked.
+    """
+    standard_dir = config.get_path('std')
+    standards = {}
+    settings = {}
+    for path in sorted(glob.glob(os.path.join(standard_dir, '*.json'))):
+        try:
+            ident, tag, _, _ = datman.scanid.parse_filename(path)
+        except datman.scanid.ParseException:
+            logger.error("Standards file misnamed, ignoring: {}".format(path))
+            continue
+        if ident.site not in sites:
+            continue
+        if ident.site not in settings:
+            settings[ident.site] = get_site_settings(config, ident.site,
+                    ignored_fields, tolerances)
+        site_ignored, site_tolerances, qc_types = settings[ident.site]
+
+        contents = read_json(path)
+        remove_fields(contents, site_ignored)
+        dti = qc_types.get(tag) == 'dti'
+        bvals = None
+        if dti:
+            try:
+                bvals = find_bvals(path)
+            except IOError as e:
+                bvals = 'Error - {}'.format(e)
+        standards[(ident.site, tag)] = {'path': path,
+                                        'contents': contents,
+                                        'tolerances': site_tolerances,
+                                        'dti': dti,
+                                        'bvals': bvals}
+    return standards
+
+def check_study(config, processes=4, ignored_fields=None, tolerances=None):
+    """
+    Compares every series JSON in a study against its gold standard. Returns
+    a list of rows (dictionaries with the keys in DIFF_COLUMNS), one for each
+    difference found.
+    """
+    series = find_series(config.get_path('nii'))
+    sites = set(ident.site for _, ident, _ in series)
+    standards = load_standards(config, sites, ignored_fields, tolerances)
+    logger.info("Comparing {} series against {} standards".format(
+            len(series), len(standards)))
+
+    jobs = [(path, ident.get_full_subjectid_with_timepoint_session(),
+            ident.site, tag) for path, ident, tag in series]
+
+    if processes <= 1:
+        _init_worker(standards)
+        results = [_diff_series(job) for job in jobs]
+    else:
+        pool = Pool(processes, initializer=_init_worker,
+                initargs=(standards,))
+        try:
+            results = pool.map(_diff_series, jobs,
+                    chunksize=max(1, len(jobs) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return [row for rows in results for row in rows]
+
+def _init_worker(standards):
+    global _standards
+    _standards = standards
+
+def _diff_series(job):
+    series_json, subject, site, tag = job
+    base_row = {'subject': subject,
+                'series': os.path.basename(series_json),
+                'site': site,
+                'tag': tag}
+
+    def make_row(field, issue, expected='', actual='', tolerance=''):
+        return dict(base_row, field=field, issue=issue, expected=expected,
+                actual=actual, tolerance=tolerance)
+
+    try:
+        standard = _standards[(site, tag)]
+    except KeyError:
+        return [make_row('', 'error', expected='Gold standard not found')]
+
+    try:
+        series = read_json(series_json)
+    except (IOError, ValueError) as e:
+        return [make_row('', 'error', actual='Unreadable JSON - {}'.format(e))]
+
+    diffs = compare_headers(series, standard['contents'],
+            tolerance=standard['tolerances'])
+    rows = [make_row(field, 'missing', expected=standard['contents'][field])
+            for field in diffs.pop('missing', [])]
+    for field in sorted(diffs):
+        rows.append(make_row(field, 'diff', expected=diffs[field]['expected'],
+                actual=diffs[field]['actual'],
+                tolerance=diffs[field].get('tolerance', '')))
+
+    if standard['dti']:
+        rows.extend(_diff_bvals(series_json, standard['bvals'], make_row))
+    return rows
+
+def _diff_bvals(series_json, standard_bvals, make_row):
+    if standard_bvals.startswith('Error'):
+        return [make_row('bvals', 'error', expected=standard_bvals)]
+    try:
+        series_bvals = find_bvals(series_json)
+    except IOError as e:
+        return [make_row('bvals', 'error', actual='Error - {}'.format(e))]
+    if series_bvals != standard_bvals:
+        return [make_row('bvals', 'bvals', expected=standard_bvals.strip(),
+                actual=series_bvals.strip())]
+    return []
+
+def write_diff_table(rows, output_path):
+    rows = sorted(rows, key=lambda row: (row['series'], row['field']))
+    with open(output_path, 'w') as dest:
+        writer = csv.DictWriter(dest, fieldnames=DIFF_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({column: _format_value(row[column])
+                    for column in DIFF_COLUMNS})
+
+def _format_value(value):
+    # Lists and dictionaries (e.g. ImageType) are written as JSON so they
+    # can be read back
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
 # def update_database(series, diffs):
 #     return
 
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Watches a study's zips folder and links and uploads each new exam archive as
+soon as it has finished arriving.
+
+Usage:
+    dm_ingest_daemon.py [options] <study>
+
+Arguments:
+    <study>                 Name of the study to watch
+
+Options:
+    --lookup FILE           Path to scan id lookup table,
+                            overrides metadata/scans.csv
+    --scanid-field STR      Dicom field to match target_name with
+                            [default: PatientName]
+    --server URL            XNAT server to connect to, overrides the server
+                            defined in the site config file.
+    -u --username USER      XNAT username. If specified then the credentials
+                            file is ignored and you are prompted for password.
+    --workers N             Number of archives to link and upload at the same
+                            time [default: 2]
+    --poll SECONDS          How often to check the zips folder when inotify
+                            is not available, and how often to check the
+                            lookup table for changes [default: 30]
+    --settle SECONDS        When polling, how long an archive's size and
+                            modification time must stay the same before it is
+                            considered complete [default: 60]
+    --no-inotify            Always poll the zips folder, even if inotify is
+                            available (e.g. the folder is on NFS, where
+                            inotify misses changes made by other hosts)
+    -v --verbose            Verbose logging
+    -d --debug              Debug logging
+    -q --quiet              Less debuggering
+    --dry-run               Log what would be linked, but don't link or upload
+
+DETAILS
+    This runs the same steps as dm_link.py followed by dm_xnat_upload.py, but
+    only for archives that have just arrived instead of for the whole folder.
+
+    When the 'inotify_simple' package is installed the zips folder is watched
+    with inotify and an archive is picked up as soon as it's closed after
+    writing or moved into the folder. Otherwise the folder is polled, and an
+    archive is picked up once it has stopped changing for --settle seconds.
+
+    Archives already in the zips folder that haven't been linked yet are
+    processed once at start up. Archives that can't be linked (e.g. because
+    their scans.csv entry hasn't been added yet) are tried again whenever the
+    lookup table changes. Archives that are linked but fail to upload are not
+    retried, so dm_xnat_upload.py should still be run periodically.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from docopt import docopt
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    inotify_found = False
+else:
+    inotify_found = True
+
+import datman.config
+import dm_link as link
+import dm_xnat_upload as upload
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+DRYRUN = False
+
+
+class ArchiveQueue(object):
+    """
+    A work queue of archive paths that ignores archives that are already
+    waiting or being worked on. Archives that failed are remembered along with
+    the lookup table version they failed with, so they can be retried once
+    the lookup table changes.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._active = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def put(self, archive):
+        with self._lock:
+            if archive in self._active:
+                return
+            self._active.add(archive)
+        logger.info('Queueing {}'.format(archive))
+        self._queue.put(archive)
+
+    def get(self):
+        return self._queue.get()
+
+    def done(self, archive):
+        with self._lock:
+            self._active.discard(archive)
+            self._failed.pop(archive, None)
+
+    def failed(self, archive, lookup_mtime):
+        with self._lock:
+            self._active.discard(archive)
+            self._failed[archive] = lookup_mtime
+
+    def retry_failed(self, lookup_mtime):
+        """
+        Queues again every failed archive that was tried with a different
+        version of the lookup table.
+        """
+        with self._lock:
+            retry = [archive for archive, mtime in self._failed.items()
+                    if mtime != lookup_mtime]
+            for archive in retry:
+                del self._failed[archive]
+        for archive in retry:
+            logger.info('Lookup table changed, retrying {}'.format(archive))
+            self.put(archive)
+
+    def stop(self, num_workers):
+        # Drop anything still waiting, it will be caught up on the next start
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in range(num_workers):
+            self._queue.put(None)
+
+
+class LookupTable(object):
+    """
+    Keeps dm_link's lookup table current, re-reading it when it changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Returns the mtime of the lookup table now in use.
+        """
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                logger.error('Lookup file {} not found'.format(self.path))
+                return self.mtime
+            if mtime != self.mtime:
+                link.lookup = link.read_lookup(self.path)
+                self.mtime = mtime
+            return self.mtime
+
+
+def is_archive(file_name):
+    return os.path.splitext(file_name)[1] == '.zip'
+
+
+def process_new_archive(archive, dicom_path, scanid_field, config):
+    """
+    Links a newly arrived archive and then uploads it to XNAT. Returns False
+    if the archive couldn't be linked.
+    """
+    target = link.link_archive(archive, dicom_path, scanid_field, config)
+    if not target:
+        return os.path.realpath(archive) in link.already_linked
+    logger.info('Uploading {}'.format(target))
+    upload.process_archive(target)
+    return True
+
+
+def run_worker(work, dicom_path, scanid_field, config, lookup):
+    while True:
+        archive = work.get()
+        if archive is None:
+            return
+        lookup_mtime = lookup.refresh()
+        try:
+            linked = process_new_archive(archive, dicom_path, scanid_field,
+                    config)
+        except Exception:
+            logger.error('Failed to process {}'.format(archive), exc_info=True)
+            linked = os.path.realpath(archive) in link.already_linked
+        if linked:
+            work.done(archive)
+        else:
+            work.failed(archive, lookup_mtime)
+
+
+def queue_unlinked(zips_path, work):
+    """
+    Queues any archive in the zips folder that hasn't been linked yet.
+    """
+    for archive in os.listdir(zips_path):
+        if not is_archive(archive):
+            continue
+        full_path = os.path.join(zips_path, archive)
+        if os.path.realpath(full_path) in link.already_linked:
+            continue
+        work.put(full_path)
+
+
+def watch_inotify(zips_path, work, lookup, interval):
+    inotify = INotify()
+    inotify.add_watch(zips_path, flags.CLOSE_WRITE | flags.MOVED_TO)
+    logger.info('Watching {} with inotify'.format(zips_path))
+    while True:
+        # Wakes up every interval even when nothing arrives, to retry failed
+        # archives if the lookup table has changed
+        for event in inotify.read(timeout=interval * 1000):
+            if is_archive(event.name):
+                work.put(os.path.join(zips_path, event.name))
+        work.retry_failed(lookup.refresh())
+
+
+def watch_polling(zips_path, work, lookup, interval, settle):
+    """
+    Polls the zips folder, queueing archives whose size and mtime have not
+    changed for 'settle' seconds. Archives that failed to link are queued
+    again when the lookup table changes.
+    """
+    logger.info('Polling {} every {}s'.format(zips_path, interval))
+    # Maps archive path -> ((size, mtime), time that state was first seen,
+    # whether it has been queued in that state)
+    pending = {}
+    while True:
+        now = time.time()
+        seen = set()
+        for archive in os.listdir(zips_path):
+            if not is_archive(archive):
+                continue
+            full_path = os.path.join(zips_path, archive)
+            if os.path.realpath(full_path) in link.already_linked:
+                continue
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            seen.add(full_path)
+            state = (stat.st_size, stat.st_mtime)
+            if full_path not in pending or pending[full_path][0] != state:
+                pending[full_path] = (state, now, False)
+                continue
+            _, first_seen, queued = pending[full_path]
+            if not queued and now - first_seen >= settle:
+                work.put(full_path)
+                pending[full_path] = (state, first_seen, True)
+        for archive in set(pending) - seen:
+            del pending[archive]
+        work.retry_failed(lookup.refresh())
+        time.sleep(interval)
+
+
+def setup_logging(study, quiet, verbose, debug):
+    ch = logging.StreamHandler(sys.stdout)
+    level = logging.WARN
+    if quiet:
+        level = logging.ERROR
+    if verbose:
+        level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - {study} - '
+                                  '%(levelname)s - %(message)s'.format(
+                                  study=study))
+    ch.setFormatter(formatter)
+    ch.setLevel(level)
+
+    # dm_link and dm_xnat_upload log to their own loggers
+    for module_logger in [logger, link.logger, upload.logger]:
+        module_logger.setLevel(level)
+        module_logger.addHandler(ch)
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    global DRYRUN
+
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    lookup_path = arguments['--lookup']
+    scanid_field = arguments['--scanid-field']
+    server = arguments['--server']
+    username = arguments['--username']
+    num_workers = int(arguments['--workers'])
+    poll = int(arguments['--poll'])
+    settle = int(arguments['--settle'])
+    use_inotify = inotify_found and not arguments['--no-inotify']
+    DRYRUN = arguments['--dry-run']
+
+    setup_logging(study, arguments['--quiet'], arguments['--verbose'],
+            arguments['--debug'])
+
+    config = datman.config.config(study=study)
+    if not lookup_path:
+        lookup_path = os.path.join(config.get_path('meta'), 'scans.csv')
+
+    dicom_path = config.get_path('dicom')
+    zips_path = config.get_path('zips')
+
+    if not os.path.isdir(zips_path):
+        logger.error('Zips path {} doesnt exist'.format(zips_path))
+        return
+    if not os.path.isdir(dicom_path):
+        logger.warning('Dicom folder {} doesnt exist, creating it.'.format(
+                dicom_path))
+        os.makedirs(dicom_path)
+
+    link.DRYRUN = DRYRUN
+    link.already_linked = link.find_linked_archives(dicom_path)
+    lookup = LookupTable(lookup_path)
+    lookup.refresh()
+    if link.lookup is None:
+        return
+
+    if not DRYRUN:
+        upload.connect(config, url=server, user=username)
+
+    work = ArchiveQueue()
+    workers = []
+    for _ in range(num_workers):
+        worker = threading.Thread(target=run_worker, args=(work, dicom_path,
+                scanid_field, config, lookup))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        if use_inotify:
+            # Polling finds these on its own, once they've settled
+            queue_unlinked(zips_path, work)
+            watch_inotify(zips_path, work, lookup, poll)
+        else:
+            watch_polling(zips_path, work, lookup, poll, settle)
+    except KeyboardInterrupt:
+        logger.info('Shutting down, waiting for running jobs to finish')
+    finally:
+        work.stop(num_workers)
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
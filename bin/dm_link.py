@@ -145,16 +145,13 @@ def main():
         return
 
     try:
-        lookup = pd.read_table(lookup_path, sep='\s+', dtype=str)
+        lookup = read_lookup(lookup_path)
     except IOError:
         logger.error('Lookup file {} not found'.format(lookup_path))
         return
 
     # identify which zip files have already been linked
-    already_linked = {os.path.realpath(f): f
-                      for f
-                      in glob.glob(os.path.join(dicom_path, '*'))
-                      if os.path.islink(f)}
+    already_linked = find_linked_archives(dicom_path)
 
     if zipfile:
         if isinstance(zipfile, basestring):
@@ -171,7 +168,30 @@ def main():
         link_archive(archive, dicom_path, scanid_field, cfg)
 
 
+def read_lookup(lookup_path):
+    """
+    Reads the scan id lookup table into a pandas dataframe. Raises IOError if
+    the file doesn't exist.
+    """
+    return pd.read_table(lookup_path, sep='\s+', dtype=str)
+
+
+def find_linked_archives(dicom_path):
+    """
+    Returns a dictionary mapping the real path of each archive that has
+    already been linked into dicom_path to its link.
+    """
+    return {os.path.realpath(f): f
+            for f
+            in glob.glob(os.path.join(dicom_path, '*'))
+            if os.path.islink(f)}
+
+
 def link_archive(archive_path, dicom_path, scanid_field, config):
+    """
+    Links an archive into dicom_path under its datman name. Returns the path
+    to the new link, or None if no link was made.
+    """
     if not os.path.isfile(archive_path):
         logger.error('Archive {} not found'.format(archive_path))
         return
@@ -220,8 +240,11 @@ def link_archive(archive_path, dicom_path, scanid_field, config):
 
     relpath = os.path.relpath(archive_path, dicom_path)
     logger.info('Linking {} to {}'.format(relpath, target))
-    if not DRYRUN:
-        os.symlink(relpath, target)
+    if DRYRUN:
+        return
+    os.symlink(relpath, target)
+    already_linked[os.path.realpath(archive_path)] = target
+    return target
 
 
 def get_scanid_from_lookup_table(archive_path):
@@ -123,39 +123,52 @@ def make_link(source, target):
     return target
 
 
-def add_link_to_dashboard(source, target, target_path):
-    if not dashboard.dash_found:
+def add_links_to_dashboard(links):
+    """
+    Adds database entries for a list of (source, target, target_path) links.
+    All source and target scans are looked up together.
+    """
+    if not dashboard.dash_found or not links:
         return
 
-    logger.debug('Creating database entry linking {} to {}.'.format(
-            source, target))
+    for source, target, _ in links:
+        logger.debug('Creating database entry linking {} to {}.'.format(
+                source, target))
     if DRYRUN:
         return
 
-    target_record = dashboard.get_scan(target)
-    if target_record:
-        # Already in database, no work to do.
-        return
+    names = [source for source, _, _ in links] + \
+            [target for _, target, _ in links]
+    records = dashboard.get_scans(names)
 
-    db_source = dashboard.get_scan(source)
-    if not db_source:
-        logger.error("Source scan {} not found in dashboard database. "
-                "Can't create link {}".format(source, target))
-        return
+    # Files from the same series (e.g. .nii.gz and .json) share one record
+    added = set()
+    for source, target, target_path in links:
+        series = dm.scanid.parse_filename(target)[:3]
+        if records[target] or series in added:
+            # Already in database, no work to do.
+            continue
+
+        db_source = records[source]
+        if not db_source:
+            logger.error("Source scan {} not found in dashboard database. "
+                    "Can't create link {}".format(source, target))
+            continue
 
-    try:
-        dashboard.add_scan(target, source_id=db_source.id)
-    except Exception as e:
-        logger.error("Failed to add link {} to dashboard database. "
-                "Reason: {}. Removing link from file system to re-attempt "
-                "later.".format(target, str(e)))
-        if not target_path:
-            # No link was made
-            return
         try:
-            os.remove(target_path)
-        except:
-            logger.error("Failed to clean up link {}".format(target_path))
+            dashboard.add_scan(target, source_id=db_source.id)
+            added.add(series)
+        except Exception as e:
+            logger.error("Failed to add link {} to dashboard database. "
+                    "Reason: {}. Removing link from file system to re-attempt "
+                    "later.".format(target, str(e)))
+            if not target_path:
+                # No link was made
+                continue
+            try:
+                os.remove(target_path)
+            except:
+                logger.error("Failed to clean up link {}".format(target_path))
 
 
 def link_files(tags, src_session, trg_session, src_data_dir, trg_data_dir):
@@ -173,6 +186,7 @@ def link_files(tags, src_session, trg_session, src_data_dir, trg_data_dir):
     logger.info("Making links in {} for tagged files in {}".format(trg_dir,
             src_dir))
 
+    links = []
     for root, dirs, files in os.walk(src_dir):
         for filename in files:
             try:
@@ -191,7 +205,9 @@ def link_files(tags, src_session, trg_session, src_data_dir, trg_data_dir):
                 trg_file = os.path.join(trg_dir, trg_name) + ext
 
                 result = make_link(src_file, trg_file)
-                add_link_to_dashboard(src_file, trg_file, result)
+                links.append((src_file, trg_file, result))
+
+    add_links_to_dashboard(links)
 
 
 def get_file_types_for_tag(tag_settings, tag):
@@ -382,6 +398,9 @@ def main():
     if debug:
         logger.setLevel(logging.DEBUG)
 
+    # Records are looked up repeatedly but not changed elsewhere during a run
+    dashboard.enable_cache()
+
     if link_file is not None:
         logger.info("Using link file {} to make links".format(link_file))
         for line in read_link_file(link_file):
@@ -13,6 +13,8 @@ Arguments:
 
 Options:
     --rewrite          Rewrite the html of an existing qc page
+    --cores N          Number of QC commands to run at the same time for each
+                       subject [default: 1]
     --log-to-server    If set, all log messages will also be sent to the
                        configured logging server. This is useful when the
                        script is run with the Sun Grid Engine, since it swallows
@@ -40,6 +42,15 @@ Details:
 
      One subfolder for each subject will be created under the <QCDir> folder.
 
+     **updating pages**
+
+     Each subject's QC folder holds a qc-manifest.json that records, for every
+     nifti, its size, modification time and hash, the QC outputs made from it
+     and its part of the html page. When a subject's niftis change (e.g. a
+     repeat session is added) their page is rebuilt, but only series whose
+     contents changed are QC'd again. --rewrite rebuilds the whole page,
+     reusing any QC outputs made from unchanged niftis.
+
      **gold standards**
 
      To check for changes to the MRI machine's settings over time this compares
@@ -70,7 +81,6 @@ Details:
            - T1:  {Pattern: {'regex1', 'regex2'}, Count: n_expected}
            - DTI: {Pattern: {'regex1', 'regex2'}, Count: n_expected}
 Requires:
-    FSL
     QCMON
     MATLAB/R2014a - qa-dti phantom pipeline
     AFNI - abcd_fmri phantom pipeline
@@ -85,6 +95,12 @@ import logging.handlers
 import copy
 import random
 import string
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import pandas as pd
 import nibabel as nib
@@ -96,6 +112,10 @@ import datman.utils
 import datman.scanid
 import datman.scan
 import datman.dashboard
+import datman.qc.dti
+import datman.qc.fmri
+import datman.qc.montage
+import datman.qc.manifest
 
 logging.basicConfig(level=logging.WARN,
         format="[%(name)s] %(levelname)s: %(message)s")
@@ -103,44 +123,156 @@ logger = logging.getLogger(os.path.basename(__file__))
 
 config = None
 REWRITE = False
+CORES = 1
 
 SLICER_GAP = 2
 SLICER_RES = 1600
 SLICER_FMRI_RES = 600
 
+class QCTask(object):
+    """
+    A single QC command (or function) and the tasks it must wait for.
+    """
+
+    def __init__(self, action, args, after):
+        self.action = action
+        self.args = args
+        self.after = after
+        self.dependents = []
+        self.failed = False
+
+    def run(self):
+        failed_deps = [task for task in self.after if task.failed]
+        if failed_deps:
+            logger.error("Skipping {} because a command it depends on "
+                    "failed".format(self))
+            self.failed = True
+            return
+        try:
+            if callable(self.action):
+                self.action(*self.args)
+            else:
+                return_code, _ = datman.utils.run(self.action)
+                self.failed = bool(return_code)
+        except Exception:
+            logger.error("{} failed".format(self), exc_info=True)
+            self.failed = True
+
+    def __str__(self):
+        if callable(self.action):
+            return "{}{}".format(self.action.__name__, self.args)
+        return self.action
+
+
+class QCTasks(object):
+    """
+    The graph of QC commands needed to build one subject's report.
+
+    The QC handlers add the commands for each series as the report is
+    written, naming any earlier tasks whose outputs a command reads. run()
+    then works through the graph, running up to 'cores' tasks that don't
+    depend on each other at a time. If 'immediate' is set tasks are instead
+    run as soon as they're added.
+    """
+
+    def __init__(self, immediate=False):
+        self.immediate = immediate
+        self.tasks = []
+
+    def add(self, action, *args, **kwargs):
+        """
+        Adds a shell command (a string) or a function to call with 'args'.
+        The 'after' keyword argument can list tasks returned by earlier calls
+        that must finish first (None entries are ignored).
+        """
+        after = [task for task in kwargs.get('after', []) if task]
+        task = QCTask(action, args, after)
+        if self.immediate:
+            task.run()
+            return task
+        for dependency in after:
+            dependency.dependents.append(task)
+        self.tasks.append(task)
+        return task
+
+    def run(self, cores=1):
+        if cores <= 1 or len(self.tasks) <= 1:
+            # Tasks can only depend on tasks added before them
+            for task in self.tasks:
+                task.run()
+            return
+
+        ready = queue.Queue()
+        waiting_on = {task: len(task.after) for task in self.tasks}
+        lock = threading.Lock()
+        finished = [0]
+
+        def work():
+            while True:
+                task = ready.get()
+                if task is None:
+                    return
+                task.run()
+                with lock:
+                    for dependent in task.dependents:
+                        waiting_on[dependent] -= 1
+                        if not waiting_on[dependent]:
+                            ready.put(dependent)
+                    finished[0] += 1
+                    if finished[0] == len(self.tasks):
+                        for _ in range(cores):
+                            ready.put(None)
+
+        for task in self.tasks:
+            if not task.after:
+                ready.put(task)
+        workers = [threading.Thread(target=work) for _ in range(cores)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+class ReportFragment(object):
+    """
+    Collects the html written for one series so it can be added to the report
+    and cached in the subject's QC manifest.
+    """
+
+    def __init__(self, report_name):
+        # add_image() makes image paths relative to the report
+        self.name = report_name
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
 def random_str(n):
     """generates a random string of length n"""
     return(''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(n)))
 
 def slicer(fpath, pic, slicergap, picwidth):
     """
-    Uses FSL's slicer function to generate a montage png from a nifti file
+    Generates a montage png of axial slices from a nifti file (the same image
+    FSL's 'slicer -S' makes)
         fpath       -- submitted image file name
         slicergap   -- int of "gap" between slices in Montage
         picwidth    -- width (in pixels) of output image
         pic         -- fullpath to for output image
     """
-    datman.utils.run("slicer {} -S {} {} {}".format(fpath,slicergap,picwidth,pic))
+    datman.qc.montage.axial_montage(fpath, pic, gap=slicergap,
+            width=picwidth)
 
 def slicesdir(fpath, pic):
     """
-    Uses FSL's slicer function to generate a montage of three slices from
-    each direction that matches FSL's slicesdir output
+    Generates a montage of three slices from each direction that matches
+    FSL's slicesdir output
     """
-
-    with datman.utils.make_temp_directory() as temp:
-        img_command = "slicer {0} -s 1 "\
-                "-x 0.4 {1}/grota.png -x 0.5 {1}/grotb.png -x 0.6 {1}/grotc.png "\
-                "-y 0.4 {1}/grotd.png -y 0.5 {1}/grote.png -y 0.6 {1}/grotf.png "\
-                "-z 0.4 {1}/grotg.png -z 0.5 {1}/groth.png -z 0.6 {1}/groti.png"\
-                .format(fpath, temp)
-        datman.utils.run(img_command)
-
-        montage_command = "pngappend {0}/grota.png + {0}/grotb.png + "\
-                "{0}/grotc.png + {0}/grotd.png + {0}/grote.png + {0}/grotf.png "\
-                "+ {0}/grotg.png + {0}/groth.png + {0}/groti.png {1}"\
-                .format(temp, pic)
-        datman.utils.run(montage_command)
+    datman.qc.montage.orthogonal_montage(fpath, pic)
 
 def add_image(qc_html, image, title=None):
     """
@@ -157,7 +289,7 @@ def add_image(qc_html, image, title=None):
     return qc_html
 
 # PIPELINES
-def ignore(filename, qc_dir, report):
+def ignore(filename, qc_dir, report, tasks=None):
     pass
 
 def gather_input_req(nifti, pipeline):
@@ -211,21 +343,22 @@ def run_phantom_pipeline(nifti,qc_path,reqs):
 
 
 
-def fmri_qc(file_name, qc_dir, report):
+def fmri_qc(file_name, qc_dir, report, tasks=None):
+    if tasks is None:
+        tasks = QCTasks(immediate=True)
     base_name = datman.utils.nifti_basename(file_name)
     output_name = os.path.join(qc_dir, base_name)
 
     # check scan length
     script_output = output_name + '_scanlengths.csv'
-    logger.info('Running qc-scanlength')
     if not os.path.isfile(script_output):
-        datman.utils.run('qc-scanlength {} {}'.format(file_name, script_output))
+        tasks.add(datman.qc.fmri.write_scan_length, file_name, script_output)
 
     # check fmri signal
     script_output = output_name + '_stats.csv'
-    logger.info('Running qc-fmri')
+    fmri = None
     if not os.path.isfile(script_output):
-        datman.utils.run('qc-fmri {} {}'.format(file_name, output_name))
+        fmri = tasks.add(datman.qc.fmri.run_qc, file_name, output_name)
 
     slices_montage = output_name + "_montage.png"
     image_raw = output_name + '_raw.png'
@@ -233,31 +366,36 @@ def fmri_qc(file_name, qc_dir, report):
     image_corr = output_name + '_corr.png'
 
     if not os.path.isfile(slices_montage):
-        slicesdir(file_name, slices_montage)
+        tasks.add(slicesdir, file_name, slices_montage)
     add_image(report, slices_montage)
 
     if not os.path.isfile(image_raw):
-        slicer(file_name, image_raw, SLICER_GAP, SLICER_FMRI_RES)
+        tasks.add(slicer, file_name, image_raw, SLICER_GAP, SLICER_FMRI_RES)
     add_image(report, image_raw, title='BOLD montage')
 
+    # The sfnr and correlation maps are made by datman.qc.fmri.run_qc
     if not os.path.isfile(image_sfnr):
-        slicer(os.path.join(qc_dir, base_name + '_sfnr.nii.gz'), image_sfnr,
-                SLICER_GAP, SLICER_FMRI_RES)
+        tasks.add(slicer, os.path.join(qc_dir, base_name + '_sfnr.nii.gz'),
+                image_sfnr, SLICER_GAP, SLICER_FMRI_RES, after=[fmri])
     add_image(report, image_sfnr, title='SFNR map')
 
     if not os.path.isfile(image_corr):
-        slicer(os.path.join(qc_dir, base_name + '_corr.nii.gz'), image_corr,
-                SLICER_GAP, SLICER_FMRI_RES)
+        tasks.add(slicer, os.path.join(qc_dir, base_name + '_corr.nii.gz'),
+                image_corr, SLICER_GAP, SLICER_FMRI_RES, after=[fmri])
     add_image(report, image_corr, title='correlation map')
 
-def anat_qc(filename, qc_dir, report):
+def anat_qc(filename, qc_dir, report, tasks=None):
+    if tasks is None:
+        tasks = QCTasks(immediate=True)
 
     image = os.path.join(qc_dir, datman.utils.nifti_basename(filename) + '.png')
     if not os.path.isfile(image):
-        slicer(filename, image, 5, SLICER_RES)
+        tasks.add(slicer, filename, image, 5, SLICER_RES)
     add_image(report, image)
 
-def dti_qc(filename, qc_dir, report):
+def dti_qc(filename, qc_dir, report, tasks=None):
+    if tasks is None:
+        tasks = QCTasks(immediate=True)
     dirname = os.path.dirname(filename)
     basename = datman.utils.nifti_basename(filename)
 
@@ -265,26 +403,23 @@ def dti_qc(filename, qc_dir, report):
     bval = os.path.join(dirname, basename + '.bval')
 
     output_prefix = os.path.join(qc_dir, basename)
-    output_file = output_prefix + '_stats.csv'
-    if not os.path.isfile(output_file):
-       datman.utils.run('qc-dti {} {} {} {}'.format(filename, bvec, bval,
-                output_prefix))
+    if not (os.path.isfile(output_prefix + '_stats.csv') and
+            os.path.isfile(output_prefix + '_spikecount.csv')):
+        tasks.add(datman.qc.dti.run_qc, filename, bval, output_prefix)
 
-    output_file = os.path.join(qc_dir, basename + '_spikecount.csv')
-    if not os.path.isfile(output_file):
-        datman.utils.run('qc-spikecount {} {} {}'.format(filename,
-                os.path.join(qc_dir, basename + '_spikecount.csv'), bval))
+    directions = output_prefix + '_directions.png'
+    if not os.path.isfile(directions):
+        tasks.add(datman.qc.dti.plot_directions, bvec, directions)
 
     slices_montage = os.path.join(qc_dir, basename + "_montage.png")
     if not os.path.isfile(slices_montage):
-        slicesdir(filename, slices_montage)
+        tasks.add(slicesdir, filename, slices_montage)
     image = os.path.join(qc_dir, basename + '_b0.png')
     if not os.path.isfile(image):
-        slicer(filename, image, SLICER_GAP, SLICER_RES)
+        tasks.add(slicer, filename, image, SLICER_GAP, SLICER_RES)
     add_image(report, slices_montage)
     add_image(report, image, title='b0 montage')
-    add_image(report, os.path.join(qc_dir, basename + '_directions.png'),
-            title='bvec directions')
+    add_image(report, directions, title='bvec directions')
 
 
 def make_qc_command(subject_id, study):
@@ -302,6 +437,7 @@ def make_qc_command(subject_id, study):
         command = " ".join([command, '-q'])
     if use_server:
         command = " ".join([command, '--log-to-server'])
+    command = " ".join([command, '--cores', arguments['--cores']])
 
     if REWRITE:
         command = command + ' --rewrite'
@@ -321,7 +457,8 @@ def qc_all_scans(config):
         command = make_qc_command(subject, config.study_name)
         job_name = "qc_report_{}_{}_{}".format(time.strftime("%Y%m%d"),
                 random_str(5), i)
-        datman.utils.submit_job(command, job_name, "/tmp", system=config.system)
+        datman.utils.submit_job(command, job_name, "/tmp", system=config.system,
+                cpu_cores=CORES)
 
 def get_new_subjects(config):
     qc_dir = config.get_path('qc')
@@ -333,10 +470,13 @@ def get_new_subjects(config):
     if REWRITE:
         return all_subs
 
-    # Finished subjects are those that have an html file in their qc output dir
+    # Finished subjects are those that have an html file in their qc output
+    # dir, unless their niftis have changed since the page was made
     html_pages = glob.glob(os.path.join(qc_dir, '*/*.html'))
     subject_qc_dirs = [os.path.dirname(qc_path) for qc_path in html_pages]
-    finished_subs = [os.path.basename(path) for path in subject_qc_dirs]
+    finished_subs = [os.path.basename(path) for path in subject_qc_dirs
+            if not needs_update(path, os.path.join(nii_dir,
+                    os.path.basename(path)))]
 
     # Finished phantoms are those that have a non-empty folder
     # (so if qc outputs are missing, delete the folder to get it to re-run!)
@@ -349,6 +489,17 @@ def get_new_subjects(config):
     new_subs = filter(lambda sub: sub not in finished_phantoms, new_subs)
     return new_subs
 
+def needs_update(qc_path, nii_path):
+    """
+    True if a subject's QC manifest shows their niftis have changed since
+    their QC page was made. Pages made before manifests were kept are assumed
+    to be up to date.
+    """
+    manifest = datman.qc.manifest.QCManifest(qc_path)
+    if not manifest.exists():
+        return False
+    return manifest.inputs_changed(get_nifti_paths(nii_path))
+
 def add_header_qc(nifti, qc_html, header_diffs):
     """
     Adds header-diff.log information to the report.
@@ -402,7 +553,15 @@ def add_header_qc(nifti, qc_html, header_diffs):
         qc_html.write(table_row)
     qc_html.write('</tbody></table>\n')
 
-def write_report_body(report, expected_files, subject, header_diffs, tag_settings):
+def write_report_body(report, expected_files, subject, header_diffs,
+        tag_settings, tasks=None, manifest=None):
+    """
+    Writes each series' QC to the report. If a QCManifest is given, series
+    with a current entry are copied from it instead of being QC'd again.
+
+    Returns a list of (nifti path, ReportFragment, tasks) for the series that
+    were QC'd, so the manifest can be updated once their tasks have run.
+    """
     handlers = {
     # List of qc functions available mapped to 'qc_type' from user settings
         "anat"      : anat_qc,
@@ -412,6 +571,7 @@ def write_report_body(report, expected_files, subject, header_diffs, tag_setting
         "dmap_fmri" : anat_qc,
         "dmap_dmri" : anat_qc
     }
+    qced = []
     for idx in range(0,len(expected_files)):
         series = expected_files.loc[idx,'File']
         if not series:
@@ -439,12 +599,30 @@ def write_report_body(report, expected_files, subject, header_diffs, tag_setting
         new_series = get_series_to_add(series, subject)
 
         for series in new_series:
-            try:
-                handlers[qc_type](series.path, subject.qc_path, report)
-            except KeyError:
+            if qc_type not in handlers:
                 raise KeyError('series tag {} not defined in handlers:\n{}'.format(
                         series.tag, handlers))
+
+            fragment = None
+            if manifest and not REWRITE:
+                fragment = manifest.get_fragment(series.path)
+            if fragment is not None:
+                logger.debug("Reusing QC for unchanged {}".format(series.path))
+                report.write(fragment)
+                report.write('<br>')
+                continue
+
+            if manifest:
+                manifest.invalidate(series.path)
+            fragment = ReportFragment(report.name)
+            first_task = len(tasks.tasks) if tasks else 0
+            handlers[qc_type](series.path, subject.qc_path, fragment,
+                    tasks=tasks)
+            series_tasks = tasks.tasks[first_task:] if tasks else []
+            qced.append((series.path, fragment, series_tasks))
+            report.write(fragment.getvalue())
             report.write('<br>')
+    return qced
 
 def get_series_to_add(series, subject):
     """
@@ -622,20 +800,54 @@ def write_report_header(report, subject_id):
 
     report.write('<h1> QC report for {} <h1/>'.format(subject_id))
 
-def generate_qc_report(report_name, subject, expected_files, header_diffs, config):
+def generate_qc_report(report_name, subject, expected_files, header_diffs,
+        config, manifest=None):
     tag_settings = config.get_tags(site=subject.site)
+    # The page only refers to the QC outputs by name, so it's written in
+    # series order while the commands that make the outputs are collected
+    # and then run together before the page is closed
+    tasks = QCTasks()
     try:
         with open(report_name, 'wb') as report:
             write_report_header(report, subject.full_id)
             write_table(report, expected_files, subject)
             write_tech_notes_link(report, subject.site, config.study_name,
                     subject.resource_path)
-            write_report_body(report, expected_files, subject, header_diffs,
-                    tag_settings)
+            qced = write_report_body(report, expected_files, subject,
+                    header_diffs, tag_settings, tasks=tasks, manifest=manifest)
+            logger.info("Running {} QC commands for {} on {} cores".format(
+                    len(tasks.tasks), subject.full_id, CORES))
+            tasks.run(cores=CORES)
     except:
         raise
+    if manifest:
+        update_manifest(manifest, subject, qced)
     update_dashboard(subject, report_name, header_diffs)
 
+def update_manifest(manifest, subject, qced):
+    """
+    Records the series QC'd for this report in the subject's manifest. Series
+    with a failed QC command are left out, so they're retried next run.
+    """
+    failed = []
+    for nifti, fragment, tasks in qced:
+        if any(task.failed for task in tasks):
+            failed.append(nifti)
+            continue
+        manifest.update(nifti, fragment.getvalue())
+
+    niftis = get_nifti_paths(subject.nii_path)
+    manifest.prune(niftis)
+    manifest.set_inputs([nifti for nifti in niftis if nifti not in failed])
+    manifest.save()
+
+def get_nifti_paths(nii_path):
+    """
+    Returns the paths of all niftis in a subject's nii folder
+    """
+    return sorted(path for path in datman.scan.list_files(nii_path)
+            if datman.utils.get_extension(path) in ['.nii', '.nii.gz'])
+
 def update_dashboard(subject, report_name, header_diffs):
     db_subject = datman.dashboard.get_subject(subject.full_id)
     if not db_subject:
@@ -833,8 +1045,10 @@ def qc_subject(subject, config):
     # header diff
     header_diffs_log = os.path.join(subject.qc_path, 'header-diff.json')
 
+    manifest = datman.qc.manifest.QCManifest(subject.qc_path)
+
     if os.path.isfile(report_name):
-        if not REWRITE:
+        if not REWRITE and not page_outdated(subject, manifest):
             logger.debug("{} exists, skipping.".format(report_name))
             return
         os.remove(report_name)
@@ -859,7 +1073,7 @@ def qc_subject(subject, config):
 
     try:
         generate_qc_report(report_name, subject, expected_files, header_diffs,
-                config)
+                config, manifest=manifest)
     except:
         logger.error("Exception raised during qc-report generation for {}. " \
                 "Removing .html page.".format(subject.full_id), exc_info=True)
@@ -868,6 +1082,16 @@ def qc_subject(subject, config):
 
     return report_name
 
+def page_outdated(subject, manifest):
+    """
+    True if a subject's existing QC page needs to be brought up to date,
+    either because their niftis changed since the manifest was written or,
+    for pages made without a manifest, because a repeat session was added.
+    """
+    if manifest.exists():
+        return manifest.inputs_changed(get_nifti_paths(subject.nii_path))
+    return check_for_repeat_session(subject)
+
 def qc_phantom(subject, config):
     """
     subject:            The Scan object for the subject_id of this run
@@ -935,25 +1159,22 @@ def verify_input_paths(path_list):
 
 def check_for_repeat_session(subject):
     """
-    Will modify the REWRITE flag, causing a page to be regenerated, if new
-    data from a repeat session has been added since the page was originally
-    created.
+    Returns True if new data from a repeat session has been added since the
+    page was originally created. Only needed for pages made before QC
+    manifests were kept, the manifest catches new series for all others.
 
     WARNING: If it cannot find the dashboard/database pages will not be updated
     to add the new session(s)
     """
-    global REWRITE
-
     db_subject = datman.dashboard.get_subject(subject.full_id)
 
     # will be None if entry doesn't exist in dashboard or dashboard isnt setup
     if not db_subject:
         logger.warning('Cannot find subject {} in dashboard database. They may '
                 'be missing, or database may be inaccessible.'.format(subject))
-        return
+        return False
 
-    if db_subject.last_qc_repeat_generated < len(db_subject.sessions):
-        REWRITE = True
+    return db_subject.last_qc_repeat_generated < len(db_subject.sessions)
 
 def prepare_scan(subject_id, config):
     """
@@ -963,11 +1184,12 @@ def prepare_scan(subject_id, config):
     """
     try:
         subject = datman.scan.Scan(subject_id, config)
+        # Misnamed files are only detected once the nii folder is read
+        subject.niftis
     except datman.scanid.ParseException as e:
         logger.error(e, exc_info=True)
         sys.exit(1)
 
-    check_for_repeat_session(subject)
     verify_input_paths([subject.nii_path])
 
     qc_dir = datman.utils.define_folder(subject.qc_path)
@@ -1011,6 +1233,7 @@ def add_server_handler(config):
 def main():
     global config
     global REWRITE
+    global CORES
 
     arguments = docopt(__doc__)
     use_server = arguments['--log-to-server']
@@ -1020,6 +1243,7 @@ def main():
     study = arguments['<study>']
     session = arguments['<session>']
     REWRITE = arguments['--rewrite']
+    CORES = int(arguments['--cores'])
 
 
     config = get_config(study)
@@ -1034,6 +1258,9 @@ def main():
     if debug:
         logger.setLevel(logging.DEBUG)
 
+    # Records are looked up repeatedly but not changed elsewhere during a run
+    datman.dashboard.enable_cache()
+
     if session:
         subject = prepare_scan(session, config)
         qc_single_scan(subject, config)
@@ -12,13 +12,35 @@ Options:
     -q --quiet                  Suppress output.
     -v --verbose                Show more output.
     -d --debug                  Show lots of output.
+    -c N, --connections N       Number of SFTP channels to download through
+                                at once [default: 4]
     --dry-run
 
+Details:
+    Each remote folder is listed once, with the size and modification time of
+    every entry, and compared against a manifest of what was already fetched
+    (meta/sftp_manifest.json), so unchanged exports cost no extra round
+    trips. New or changed files are downloaded through several SFTP channels
+    opened on the same connection. Each download is written to a '.part' file
+    that is renamed into place when complete, and an interrupted download
+    resumes from where it stopped on the next run.
+
+    Remote folders (e.g. a session exported as loose DICOMs) are read file by
+    file straight into <folder>.zip in the zips folder, stored without
+    compression and using ZIP64 so archives over 2 GB are valid. Nothing is
+    written to a temp folder first.
 """
 import logging
 import sys
 import os
+import json
+import stat
+import time
 import shutil
+import zipfile
+import posixpath
+import threading
+from multiprocessing.pool import ThreadPool
 
 import pysftp
 import fnmatch
@@ -26,12 +48,20 @@ import paramiko
 
 from docopt import docopt
 import datman.config
-from datman.utils import make_temp_directory
 
 logging.basicConfig(level=logging.WARN,
         format="[%(asctime)s %(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(os.path.basename(__file__))
 
+MANIFEST_NAME = 'sftp_manifest.json'
+
+# Size of the reads made from each remote file. paramiko's prefetch keeps
+# many of these requests in flight at once
+BLOCK_SIZE = 1024 * 1024
+
+# Zip files can't store times before 1980
+ZIP_EPOCH = 315532800
+
 def main():
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -39,6 +69,7 @@ def main():
     dryrun = arguments['--dry-run']
     quiet = arguments['--quiet']
     study = arguments['<study>']
+    connections = int(arguments['--connections'])
 
     # setup logging
     log_level = logging.WARN
@@ -64,6 +95,9 @@ def main():
         if not dryrun:
             os.mkdir(zips_path)
 
+    manifest_path = os.path.join(meta_path, MANIFEST_NAME)
+    manifest = read_manifest(manifest_path)
+
     server_config = get_server_config(cfg)
 
     for mrserver in server_config:
@@ -96,11 +130,16 @@ def main():
                 if len(valid_dirs) < 1:
                     logger.error('Source folders:{} not found'.format(mrfolders))
 
-                for valid_dir in valid_dirs:
-                    #  process each folder in turn
-                    logger.debug('Copying from:{}  to:{}'
-                                 .format(valid_dir, zips_path))
-                    process_dir(sftp, valid_dir, zips_path)
+                fetched = manifest.setdefault(mrserver, {})
+                with Downloader(sftp, connections) as downloader:
+                    for valid_dir in valid_dirs:
+                        #  process each folder in turn
+                        logger.debug('Copying from:{}  to:{}'
+                                     .format(valid_dir, zips_path))
+                        process_dir(sftp, valid_dir, zips_path, fetched,
+                                downloader, dryrun=dryrun)
+                        if not dryrun:
+                            write_manifest(manifest_path, manifest)
 
 
 def get_server_config(cfg):
@@ -183,61 +222,274 @@ def get_valid_remote_dirs(connection, mrfolders):
     return valid_dirs
 
 
-def process_dir(connection, directory, zips_path):
+def read_manifest(manifest_path):
+    """
+    Returns the files already fetched from each server. Each remote path maps
+    to the size and mtime it had when it was downloaded.
+    """
+    try:
+        with open(manifest_path) as manifest:
+            return json.load(manifest)
+    except IOError:
+        return {}
+    except ValueError:
+        logger.error("Manifest {} is unreadable, modification times will be "
+                "used instead".format(manifest_path))
+        return {}
+
+def write_manifest(manifest_path, manifest):
+    temp = manifest_path + '.tmp'
+    with open(temp, 'w') as fh:
+        json.dump(manifest, fh, sort_keys=True, indent=4,
+                separators=(',', ': '))
+    os.rename(temp, manifest_path)
+
+def process_dir(connection, directory, zips_path, fetched, downloader,
+        dryrun=False):
     """Process a directory on the ftp server,
     copy new files to zips_path
+
+    fetched is the manifest entry for this server and is updated with every
+    file downloaded.
     """
-    with connection.cd(directory):
-        try:
-            files = connection.listdir()
-        except IOError:
-            # can get this if user doesn't have permission to enter the folder
-            logger.debug('Cant access remote folder:{}, skipping.'
-                         .format(directory))
-            return
-        for file_name in files:
-            if connection.isfile(file_name):
-                get_file(connection, file_name, zips_path)
-            else:
-                get_folder(connection, file_name, zips_path)
-
-def get_folder(connection, folder_name, dst_path):
-    expected_file = os.path.join(dst_path, folder_name + ".zip")
-    if not download_needed(connection, folder_name, expected_file):
-        logger.debug("File: {} already exists, skipping".format(folder_name))
+    try:
+        entries = connection.listdir_attr(directory)
+    except IOError:
+        # can get this if user doesn't have permission to enter the folder
+        logger.debug('Cant access remote folder:{}, skipping.'
+                     .format(directory))
         return
 
-    with make_temp_directory() as temp_dir:
-        # Note 'get_r' is needed instead of 'get'
-        connection.get_r(folder_name, temp_dir, preserve_mtime=True)
-        source = os.path.join(temp_dir, folder_name)
-        dest = os.path.join(dst_path, folder_name)
-        new_zip = shutil.make_archive(dest, 'zip', source)
-        logger.info("Copied remote file {} to: {}".format(folder_name, new_zip))
-
-def get_file(connection, file_name, zips_path):
-    target = os.path.join(zips_path, file_name)
-    if download_needed(connection, file_name, target):
-        logger.info('Copying new remote file: {}'.format(file_name))
-        connection.get(file_name, target, preserve_mtime=True)
-    else:
-        logger.debug("File: {} already exists, skipping".format(file_name))
-
-def download_needed(sftp, filename, target):
-    """Check if a local copy of the file exists,
-    If no local copy exists return True
-    If local copy exists and is older than remote return True
-    otherwise return false"""
+    downloads = []
+    folders = []
+    for entry in entries:
+        remote_path = posixpath.join(directory, entry.filename)
+        if stat.S_ISDIR(entry.st_mode):
+            target = os.path.join(zips_path, entry.filename + ".zip")
+            if not folder_needed(entry, target):
+                logger.debug("File: {} already exists, skipping".format(
+                        entry.filename))
+                continue
+            logger.info('Copying new remote folder: {}'.format(
+                    entry.filename))
+            folders.append((remote_path, target))
+            continue
+        target = os.path.join(zips_path, entry.filename)
+        if not download_needed(fetched.get(remote_path), entry, target):
+            logger.debug("File: {} already exists, skipping".format(
+                    entry.filename))
+            fetched[remote_path] = {'size': entry.st_size,
+                    'mtime': entry.st_mtime}
+            continue
+        logger.info('Copying new remote file: {}'.format(entry.filename))
+        downloads.append((remote_path, target, entry.st_size,
+                entry.st_mtime))
+
+    if dryrun:
+        return
+    for remote_path, size, mtime in downloader.fetch(downloads):
+        fetched[remote_path] = {'size': size, 'mtime': mtime}
+    downloader.zip_folders(folders)
+
+def folder_needed(entry, target):
+    """Check if a remote folder needs to be zipped again.
+
+    Adding or removing files updates the folder's mtime, so it's zipped if
+    there's no local zip or the zip is older than the folder.
+    """
     if not os.path.isfile(target):
         return True
+    return os.path.getmtime(target) < entry.st_mtime
 
-    # check the file modification times
-    local_mtime = os.path.getmtime(target)
-    remote_mtime = sftp.stat(filename).st_mtime
-    if local_mtime < remote_mtime:
+def walk_remote(client, folder):
+    """
+    Yields the path and attributes of every file under a remote folder.
+    """
+    for entry in sorted(client.listdir_attr(folder),
+            key=lambda item: item.filename):
+        path = posixpath.join(folder, entry.filename)
+        if stat.S_ISDIR(entry.st_mode):
+            for item in walk_remote(client, path):
+                yield item
+        else:
+            yield path, entry
+
+def add_remote_file(zip_file, client, remote_path, arcname, entry):
+    """
+    Copies a remote file into an open zip file, stored uncompressed since
+    DICOMs hardly compress and the zips are only unpacked again later.
+    """
+    info = zipfile.ZipInfo(arcname,
+            date_time=time.localtime(max(entry.st_mtime, ZIP_EPOCH))[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = (entry.st_mode & 0xFFFF) << 16
+    with client.open(remote_path, 'rb') as remote:
+        remote.prefetch(entry.st_size)
+        if sys.version_info >= (3, 6):
+            with zip_file.open(info, 'w', force_zip64=True) as dest:
+                shutil.copyfileobj(remote, dest, BLOCK_SIZE)
+        else:
+            # Python 2 can't stream a member into a zip file, so only one
+            # file at a time is held in memory
+            zip_file.writestr(info, remote.read())
+
+def download_needed(record, entry, target):
+    """Check if a file needs to be downloaded.
+
+    record is the manifest entry for the remote file (if any) and entry its
+    attributes from the remote listing. A file is downloaded if there's no
+    local copy or if the remote size or mtime no longer match the manifest.
+    Files fetched before the manifest existed are downloaded only if the
+    local copy is older than the remote one.
+    """
+    if not os.path.isfile(target):
         return True
 
-    return False
+    if record is not None:
+        return (record['size'] != entry.st_size or
+                record['mtime'] != entry.st_mtime)
+
+    # check the file modification times
+    return os.path.getmtime(target) < entry.st_mtime
+
+def get_part_name(target, size, mtime):
+    """
+    The name of the partial download of target. It includes the remote size
+    and mtime so that a partial copy of an older version of the file is never
+    resumed.
+    """
+    return '{}.{}-{}.part'.format(target, size, int(mtime))
+
+def remove_stale_parts(target, part):
+    """
+    Deletes partial downloads of other versions of target, which can't be
+    resumed.
+    """
+    folder, name = os.path.split(target)
+    for item in os.listdir(folder):
+        if (item.startswith(name + '.') and item.endswith('.part') and
+                item != os.path.basename(part)):
+            os.remove(os.path.join(folder, item))
+
+class Downloader(object):
+    """
+    Downloads files through several SFTP channels opened on one connection,
+    so that many transfers can wait on the network at the same time. Each
+    worker thread opens its own channel the first time it's used.
+    """
+
+    def __init__(self, connection, channels):
+        self.transport = connection.sftp_client.get_channel().get_transport()
+        self.channels = max(channels, 1)
+        self.pool = None
+        self.clients = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        self.pool = ThreadPool(self.channels)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.close()
+        self.pool.join()
+        for client in self.clients:
+            client.close()
+
+    def fetch(self, downloads):
+        """
+        Downloads each (remote path, local path, size, mtime) tuple given.
+        Returns a (remote path, size, mtime) tuple for each file that was
+        downloaded successfully.
+        """
+        completed = []
+        for result in self.pool.imap_unordered(self._download, downloads):
+            if result:
+                completed.append(result)
+        return completed
+
+    def zip_folders(self, folders):
+        """
+        Writes each remote folder in a list of (remote path, local zip) tuples
+        to its zip file. Returns the zips that were written.
+        """
+        completed = []
+        for result in self.pool.imap_unordered(self._zip_folder, folders):
+            if result:
+                completed.append(result)
+        return completed
+
+    def _get_client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = paramiko.SFTPClient.from_transport(self.transport)
+            self.local.client = client
+            with self.lock:
+                self.clients.append(client)
+        return client
+
+    def _download(self, download):
+        remote_path, target, size, mtime = download
+        part = get_part_name(target, size, mtime)
+        try:
+            remove_stale_parts(target, part)
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > size:
+                os.remove(part)
+                offset = 0
+            if offset:
+                logger.info("Resuming download of {} from {} bytes".format(
+                        remote_path, offset))
+            client = self._get_client()
+            with client.open(remote_path, 'rb') as remote, \
+                    open(part, 'ab') as local:
+                remote.seek(offset)
+                remote.prefetch(size)
+                while True:
+                    data = remote.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    local.write(data)
+            received = os.path.getsize(part)
+            if received != size:
+                logger.error("Download of {} stopped at {} of {} bytes, it "
+                        "will be resumed next run".format(remote_path,
+                        received, size))
+                return None
+            os.utime(part, (mtime, mtime))
+            os.rename(part, target)
+        except (IOError, OSError, paramiko.SSHException) as e:
+            logger.error("Failed to download {}: {}".format(remote_path, e))
+            return None
+        logger.debug("Downloaded {} to {}".format(remote_path, target))
+        return remote_path, size, mtime
+
+    def _zip_folder(self, folder):
+        remote_path, target = folder
+        # Written under a temporary name so a partial zip is never mistaken
+        # for a complete export
+        temp = target + '.tmp'
+        try:
+            client = self._get_client()
+            count = 0
+            with zipfile.ZipFile(temp, 'w', zipfile.ZIP_STORED,
+                    allowZip64=True) as zip_file:
+                for path, entry in walk_remote(client, remote_path):
+                    arcname = posixpath.relpath(path, remote_path)
+                    add_remote_file(zip_file, client, path, arcname, entry)
+                    count += 1
+            os.rename(temp, target)
+        except (IOError, OSError, zipfile.LargeZipFile,
+                paramiko.SSHException) as e:
+            logger.error("Failed to copy remote folder {}: {}".format(
+                    remote_path, e))
+            if os.path.exists(temp):
+                os.remove(temp)
+            return None
+        logger.info("Copied remote folder {} ({} files) to: {}".format(
+                remote_path, count, target))
+        return target
+
 
 if __name__ == '__main__':
     main()
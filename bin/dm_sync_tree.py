@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Brings a copy of a folder tree (e.g. a freesurfer subject) up to date with
+the original, only updating files that are new or have changed.
+
+Usage:
+    dm_sync_tree.py [options] <source> <dest>
+
+Arguments:
+    <source>            The folder to copy
+    <dest>              Where to put the copy. Existing contents are merged
+                        with source
+
+Options:
+    --mode MODE         How files are placed in dest. One of copy, hardlink,
+                        symlink or reflink [default: hardlink]
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Details:
+    A file is skipped if dest already has a link to it, or a file of the
+    same size and modification time, so syncing an unchanged tree writes
+    nothing. Links in source are followed. Hardlinks and reflinks fall back
+    to copying if dest is on another file system. See
+    datman.utils.materialize() for what each mode shares with source.
+"""
+import os
+import sys
+import logging
+
+from docopt import docopt
+
+import datman.utils
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+def main():
+    arguments = docopt(__doc__)
+    source = arguments['<source>']
+    dest = arguments['<dest>']
+    mode = arguments['--mode']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    if mode not in datman.utils.MATERIALIZE_MODES:
+        logger.error("--mode must be one of: {}".format(
+                ', '.join(datman.utils.MATERIALIZE_MODES)))
+        sys.exit(1)
+    if not os.path.isdir(source):
+        logger.error("{} is not a folder".format(source))
+        sys.exit(1)
+
+    updated, unchanged, saved = datman.utils.sync_tree(source, dest, mode)
+    logger.info("Synced {} to {}: {} files updated, {} unchanged, {} MB "
+            "shared with source".format(source, dest, updated, unchanged,
+            saved // 1024 ** 2))
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,47 @@ Options:
                                 freesurfer data in fmriprep format. Will let fmriprep
                                 skip this part of its process
     --freesurfer-dir PATH       Path to freesurfer data to copy into fmriprep-out-dir
-    --rewrite                   Overwrite existing BIDS directories
+    --rewrite                   Convert every session again, even those that
+                                haven't changed since the last conversion
+    --materialize MODE          How files are placed in the BIDS folder and
+                                freesurfer data in fmriprep-out-dir. One of
+                                copy, hardlink, symlink or reflink
+                                [default: copy]
     --log-to-server             If set, all log messages are sent to the configured
                                 logging server.
     --debug                     Debug logging
     -q, --use-queue             Enable queue submission from script
+    -j N, --jobs N              Number of subjects to convert at once on this
+                                machine, when not using the queue [default: 1]
+
+Materializing:
+    hardlink, symlink and reflink avoid duplicating the nii data. Files that
+    dm_to_bids changes (JSON sidecars, trimmed task runs and fixed field maps)
+    are always given their own copy, so the nii folder is never modified.
+    Falls back to copying when the file system can't hardlink or reflink
+    (e.g. the BIDS folder is on another device). Hard and symbolic links
+    share data with the source, so programs that change files in place
+    (e.g. FreeSurfer resuming a run in fmriprep-out-dir) would also change
+    the originals. Use reflink (on btrfs / xfs) or copy if that matters.
+
+Incremental conversion:
+    The nii files (and their size and modification time) that each BIDS
+    session was made from, and every BIDS file made from them (including the
+    field maps made by CMH_generate_fmap.sh), are recorded in
+    '.datman_bids_manifest.json' in the session's folder. Later runs only
+    convert the sessions with new, changed or deleted files, missing outputs,
+    or whose run numbers have changed. The recorded outputs of those sessions
+    are deleted first, so renumbered runs don't leave stale files behind. Run numbers count up
+    through a subject's sessions, so adding a repeat session doesn't rename
+    the runs before it. A BIDS session without a manifest is skipped unless
+    --rewrite is given.
+
+Dummy volumes:
+    The first volumes of each task run are dropped. The number dropped can be
+    set for each tag with 'DummyVolumes' in the system config's
+    ExportSettings, and overridden for a site with 'DummyVolumes' in that
+    site's ExportInfo in the study config. The default is 4, and 0 keeps
+    every volume.
 """
 import datman.config as config
 import datman.scanid as scanid
@@ -36,19 +72,61 @@ import traceback
 import nibabel, numpy
 import glob, fnmatch
 from docopt import docopt
-from shutil import copyfile, copytree
-from distutils import dir_util
+from shutil import copytree
 from queue import *
-from collections import Counter
+from collections import Counter, OrderedDict
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 dmlogger = logging.getLogger('datman.utils')
 
 tag_map = dict()
+# How files are placed in the BIDS folder, see datman.utils.materialize
+materialize_mode = 'copy'
+# Maps each BIDS file that shares its data with the nii folder to its size
+shared_files = dict()
+# Volumes dropped from the start of each task run, when not set for its tag.
+# dummy_volumes maps each site (None for ExportSettings) to its tag settings
+DUMMY_VOLUMES = 4
+dummy_volumes = dict()
+# Records the nii files each BIDS session was made from
+MANIFEST_NAME = '.datman_bids_manifest.json'
+# Settings for run_subject(), set by init_worker()
+_worker_log_dir = None
+_convert_options = dict()
 get_session_series = lambda x: (scanid.parse_filename(x)[0].session, scanid.parse_filename(x)[2])
 get_series = lambda x: scanid.parse_filename(x)[2]
 get_tag = lambda x: scanid.parse_filename(x)[1]
 
+def place_file(src, dst, modified=False):
+    """
+    Puts a file in the BIDS folder using the --materialize mode. Files that
+    will be changed after they're placed must be 'modified', so they get
+    their own copy.
+    """
+    mode = 'copy' if modified else materialize_mode
+    used = datman.utils.materialize(src, dst, mode)
+    if used == 'copy':
+        shared_files.pop(dst, None)
+    else:
+        shared_files[dst] = os.path.getsize(src)
+
+def make_private(path):
+    """
+    Gives a BIDS file its own copy of its data, if it shares it with the nii
+    folder, so it can be changed in place.
+    """
+    if datman.utils.unshare(path):
+        logger.debug("Copied {} to modify it".format(path))
+    shared_files.pop(path, None)
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return "{:.1f} TB".format(num_bytes)
+
 def validify_fmap(fmap):
     img = nibabel.load(fmap)
     hdr = img.header
@@ -56,6 +134,7 @@ def validify_fmap(fmap):
         value = hdr['pixdim'][3]
         hdr['srow_z'][2] = value
         img.affine[2][2] = value
+        make_private(fmap)
         nibabel.save(img, fmap)
 
 def get_missing_data(data, nii_file):
@@ -279,7 +358,12 @@ def validify_file(sub_nii_dir):
     return ses_ser_file_map, matched_fmaps
 
 def modify_json(nii_to_bids_match, intended_fors, sub_nii_dir):
+    """
+    Writes the BIDS sidecar of each nii file converted. Returns a dictionary
+    mapping each nii file name to the sidecar written for it.
+    """
     fmap_pattern = re.compile(r'ECHO\d')
+    sidecars = dict()
     for nii, bids in nii_to_bids_match.items():
         intendeds = list()
         nii_file = os.path.join(sub_nii_dir, nii)
@@ -288,6 +372,8 @@ def modify_json(nii_to_bids_match, intended_fors, sub_nii_dir):
             intendeds = intended_fors[nii]
         bids_json = bids.replace('nii.gz', 'json')
 
+        if os.path.lexists(bids_json):
+            make_private(bids_json)
         try:
             json_file = open(bids_json, 'r+')
             data = json.load(json_file)
@@ -321,6 +407,8 @@ def modify_json(nii_to_bids_match, intended_fors, sub_nii_dir):
         json.dump(data, json_file, sort_keys=True, indent=4, separators=(',', ': '))
         json_file.truncate()
         json_file.close()
+        sidecars[nii] = bids_json
+    return sidecars
 
 def create_task_json(file_path, tags_list):
     task_names = dict()
@@ -373,6 +461,7 @@ def create_command(subject, arguments):
         flags += [arg_flag, arguments[arg_flag]] if arguments[arg_flag] else []
     for flag in ['--rewrite', '--log-to-server', '--debug']:
         flags += [flag] if arguments[flag] else []
+    flags += ['--materialize', arguments['--materialize']]
     flags += [arguments['<study>']]
     flags += [subject]
     return " ".join(flags)
@@ -438,8 +527,400 @@ def init_setup(study, cfg, bids_dir):
     for tag in all_tags.keys():
         tag_map[all_tags.get(tag, "qc_type")].append(tag)
 
+    global dummy_volumes
+    dummy_volumes[None] = read_dummy_volumes(all_tags)
+    for site in cfg.get_sites():
+        try:
+            dummy_volumes[site] = read_dummy_volumes(cfg.get_tags(site=site))
+        except config.UndefinedSetting:
+            continue
+
     return all_tags.keys()
 
+def read_dummy_volumes(tags):
+    volumes = dict()
+    for tag in tags.keys():
+        try:
+            volumes[tag] = int(tags.get(tag, "DummyVolumes"))
+        except KeyError:
+            continue
+    return volumes
+
+def get_dummy_volumes(site, tag):
+    """
+    Returns the number of volumes to drop from a task run, from the site's
+    ExportInfo if set there, otherwise from ExportSettings.
+    """
+    for settings in [dummy_volumes.get(site, {}), dummy_volumes.get(None, {})]:
+        if tag in settings:
+            return settings[tag]
+    return DUMMY_VOLUMES
+
+
+def get_manifest_path(bids_dir, ident):
+    return os.path.join(bids_dir, to_sub(ident), to_ses(ident.timepoint),
+            MANIFEST_NAME)
+
+def read_manifest(manifest_path):
+    """
+    Returns a subject's manifest, or None if it has none. Under 'files', each
+    nii file name maps to its session, size, mtime and the BIDS path
+    (relative to the BIDS folder) it was converted to. Under 'outputs', each
+    session maps to every BIDS file that was made for it.
+    """
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        files = manifest['files']
+    except IOError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        logger.error("Manifest {} is unreadable, the subject will be "
+                "reconverted".format(manifest_path))
+        return {'files': dict(), 'outputs': dict()}
+    if 'outputs' not in manifest:
+        # Older manifests only record the file each nii was placed at
+        manifest['outputs'] = dict()
+        for item in files.values():
+            if item['bids']:
+                manifest['outputs'].setdefault(item['session'], []).append(
+                        item['bids'])
+    return manifest
+
+def write_manifest(manifest_path, files, outputs):
+    temp = manifest_path + '.tmp'
+    with open(temp, 'w') as manifest:
+        json.dump({'files': files, 'outputs': outputs}, manifest,
+                sort_keys=True, indent=4, separators=(',', ': '))
+    os.rename(temp, manifest_path)
+
+def plan_subject(ses_ser_file_map, all_tags, type_folders):
+    """
+    Works out the BIDS path of every file, in the order they're converted.
+    Returns an OrderedDict mapping each nii file name to (session, tag, BIDS
+    path), with a BIDS path of None for files that aren't converted. Run
+    numbers count up through all sessions, so a change to one session can
+    rename the runs of the sessions after it.
+    """
+    plan = OrderedDict()
+    cnt = {k : 0 for k in all_tags}
+    for ses in sorted(ses_ser_file_map.keys()):
+        for ser in sorted(ses_ser_file_map[ses].keys()):
+            series_tags = set()
+            for item in sorted(ses_ser_file_map[ses][ser]):
+                ident, tag, series, description = scanid.parse_filename(item)
+                ext = os.path.splitext(item)[1]
+                try:
+                    bids_path = to_bids_name(ident, tag, cnt, type_folders, ext)
+                except ValueError, err:
+                    logger.info(err)
+                    plan[item] = (ses, tag, None)
+                    continue
+                plan[item] = (ses, tag, bids_path)
+                series_tags.add(tag)
+            while len(series_tags) > 0:
+                cnt[series_tags.pop()] += 1
+    return plan
+
+def find_changed_sessions(files, manifest, bids_dir):
+    """
+    Compares the files to convert against the manifest of the last
+    conversion. Returns the sessions with a new, changed or removed file, a
+    file that would get a different BIDS name, or an output that has gone
+    missing.
+    """
+    changed = set()
+    for item, current in files.items():
+        if manifest['files'].get(item) != current:
+            changed.add(current['session'])
+    for item, old in manifest['files'].items():
+        if item not in files:
+            changed.add(old['session'])
+    for ses, outputs in manifest['outputs'].items():
+        if not all(os.path.exists(os.path.join(bids_dir, output))
+                for output in outputs):
+            changed.add(ses)
+    return changed
+
+def remove_outputs(manifest, sessions, bids_dir):
+    """
+    Deletes the BIDS files the last conversion made for the given sessions.
+    """
+    for ses in sessions:
+        for output in manifest['outputs'].get(ses, []):
+            output = os.path.join(bids_dir, output)
+            if os.path.lexists(output):
+                logger.info("Removing outdated {}".format(output))
+                os.remove(output)
+
+def convert_subject(subject_dir, nii_dir, bids_dir, all_tags, stats,
+        fmriprep_fs_dir=None, fs_dir=None, rewrite=False):
+    """
+    Converts one subject's nii folder to BIDS. Returns False if the subject
+    was skipped. The bytes read and the bytes saved by --materialize are
+    added to 'stats'.
+
+    The files converted are recorded in the subject's manifest. If one
+    exists, only the sessions with new or changed files are converted again.
+    """
+    shared_files.clear()
+    if scanid.is_phantom(subject_dir):
+        logger.info("File is phantom and will be ignored: {}".format(subject_dir))
+        return False
+
+    parsed = scanid.parse(subject_dir)
+    manifest_path = get_manifest_path(bids_dir, parsed)
+    manifest = read_manifest(manifest_path)
+    if os.path.isdir(os.path.join(bids_dir, to_sub(parsed), to_ses(parsed.timepoint))) \
+            and manifest is None and not rewrite:
+        logger.warning('BIDS subject directory already exists and has no '
+                'manifest. Use --rewrite to convert it again: {}'.format(subject_dir))
+        return False
+    if manifest is None:
+        manifest = {'files': dict(), 'outputs': dict()}
+    type_folders = create_bids_dirs(bids_dir, parsed)
+    sub_nii_dir = os.path.join(nii_dir,subject_dir) + '/'
+    logger.info("Will now begin creating files in BIDS format for: {}".format(sub_nii_dir))
+
+    #Pair together FMAPS if using PEPOLAR and map intended for json fields
+    ses_ser_file_map, matched_fmaps = validify_file(sub_nii_dir)
+    intended_fors = get_intended_fors(ses_ser_file_map, matched_fmaps)
+
+    plan = plan_subject(ses_ser_file_map, all_tags, type_folders)
+    files = dict()
+    for item, (ses, _, bids_path) in plan.items():
+        item_stat = os.stat(os.path.join(sub_nii_dir, item))
+        files[item] = {'session': ses, 'size': item_stat.st_size,
+                'mtime': item_stat.st_mtime,
+                'bids': os.path.relpath(bids_path, bids_dir) if bids_path else None}
+
+    if rewrite:
+        changed = set(item['session'] for item in
+                files.values() + manifest['files'].values())
+    else:
+        changed = find_changed_sessions(files, manifest, bids_dir)
+
+    # The recon can change without the nii data changing, so it's always
+    # synced. Unchanged files are skipped so this is cheap on re-runs.
+    if fmriprep_fs_dir:
+        fs_src = os.path.join(fs_dir, subject_dir)
+        sub_ses = "{}_{}".format(to_sub(parsed), to_ses(parsed.timepoint))
+        fs_dst = os.path.join(fmriprep_fs_dir, sub_ses)
+        if os.path.isdir(fs_src):
+            updated, unchanged, fs_saved = datman.utils.sync_tree(fs_src,
+                    fs_dst, materialize_mode)
+            logger.warning("Synced {} to {}: {} files updated, {} unchanged".format(
+                    fs_src, fs_dst, updated, unchanged))
+            stats['saved'] += fs_saved
+
+    if not changed:
+        logger.warning('BIDS subject directory is up to date: {}'.format(subject_dir))
+        remove_empty_dirs(type_folders)
+        return False
+    if manifest['files']:
+        logger.warning('Converting changed sessions {} of {}'.format(
+                ', '.join(sorted(changed)), subject_dir))
+    remove_outputs(manifest, changed, bids_dir)
+
+    nii_to_bids_match = dict()
+
+    placed = set()
+    # The BIDS files made for each session converted
+    generated = dict((ses, set()) for ses in changed)
+    for item, (ses, tag, bids_path) in plan.items():
+        if ses not in changed or not bids_path:
+            continue
+        logger.info('File: {}'.format(item))
+        item_path = os.path.join(sub_nii_dir, item)
+        stats['bytes'] += files[item]['size']
+        is_task = bids_path.endswith('nii.gz') and "task" in os.path.basename(bids_path)
+        dummies = get_dummy_volumes(parsed.site, tag) if is_task else 0
+        if dummies:
+            logger.info('Dropping {} dummy volumes'.format(dummies))
+            try:
+                datman.utils.trim_volumes(item_path, bids_path, dummies)
+            except ValueError as e:
+                # e.g. an aborted run with too few volumes to trim
+                logger.warning("Can't trim {}, copying it untrimmed. "
+                        "Reason: {}".format(item, e))
+                dummies = 0
+            else:
+                shared_files.pop(bids_path, None)
+                logger.warning("Finished trimming {}".format(os.path.basename(bids_path)))
+        if not dummies:
+            logger.info('Copying file')
+            # Sidecars are rewritten by modify_json
+            place_file(item_path, bids_path,
+                    modified=bids_path.endswith('.json'))
+        logger.info("{:<80} {:<80}".format(os.path.basename(item), os.path.basename(bids_path)))
+        if item_path.endswith('nii.gz'):
+            nii_to_bids_match[item] = bids_path
+        placed.add(bids_path)
+        generated[ses].add(bids_path)
+
+    #Generate field maps for the sessions converted. The echoes of sessions
+    #that weren't converted are already gone, so only those placed are paired
+    pattern = re.compile(r'_ECHO\d\.nii\.gz')
+    echoes = dict()
+    for ses, _, bids_path in plan.values():
+        if bids_path in placed and pattern.search(bids_path):
+            echoes.setdefault(pattern.sub("", bids_path), (ses, []))[1].append(bids_path)
+    for without_tag, (ses, fmaps) in sorted(echoes.items()):
+        fmaps = sorted(fmaps)
+        if len(fmaps) < 2:
+            continue
+        for fmap in fmaps:
+            validify_fmap(fmap)
+        base = os.path.basename(without_tag)
+
+        cmd = ['bash', 'CMH_generate_fmap.sh', fmaps[0], fmaps[1], without_tag, base]
+        datman.utils.run(cmd)
+        logger.warning("Running: {}".format(cmd))
+        generated[ses].update([without_tag + '_fieldmap.nii.gz',
+                without_tag + '_magnitude.nii.gz'])
+
+    sidecars = modify_json(nii_to_bids_match, intended_fors, sub_nii_dir)
+    for item, sidecar in sidecars.items():
+        generated[plan[item][0]].add(sidecar)
+
+    remove_empty_dirs(type_folders)
+
+    # Field map echoes are deleted once combined, so only what's left is kept
+    outputs = dict((ses, paths) for ses, paths in manifest['outputs'].items()
+            if ses not in changed)
+    for ses, paths in generated.items():
+        outputs[ses] = sorted(os.path.relpath(path, bids_dir)
+                for path in paths if os.path.lexists(path))
+    sessions = set(item['session'] for item in files.values())
+    write_manifest(manifest_path, files, dict((ses, paths)
+            for ses, paths in outputs.items() if ses in sessions))
+
+    stats['saved'] += sum(shared_files.values())
+    return True
+
+def remove_empty_dirs(type_folders):
+    logger.info("Deleting unecessary BIDS folders")
+    for key in type_folders.keys():
+        folder = type_folders[key]
+        if os.listdir(folder) == []:
+            try:
+                logger.info("Deleting: {}".format(folder))
+                os.rmdir(folder)
+            except Exception, e:
+                logger.info("Folder {} contains multiple acquistions. Should not be deleted.")
+
+def run_subject(job):
+    """
+    Converts a subject, returning a dictionary describing the result instead
+    of raising, so one subject can't stop the others.
+    """
+    subject = job[0]
+    stats = {'subject': subject, 'status': 'failed', 'bytes': 0, 'saved': 0,
+            'seconds': 0, 'error': ''}
+    start = time.time()
+    handler = None
+    if _worker_log_dir:
+        handler = add_subject_handler(_worker_log_dir, subject)
+    try:
+        converted = convert_subject(*job, stats=stats, **_convert_options)
+        stats['status'] = 'converted' if converted else 'skipped'
+    except (Exception, SystemExit) as e:
+        logger.error("Failed converting {}".format(subject), exc_info=True)
+        stats['error'] = str(e) or e.__class__.__name__
+    finally:
+        stats['seconds'] = time.time() - start
+        if handler:
+            logger.removeHandler(handler)
+            dmlogger.removeHandler(handler)
+            handler.close()
+    return stats
+
+def set_convert_settings(options, settings):
+    """
+    Sets the options and config values run_subject() converts with.
+    """
+    global _convert_options, materialize_mode, dummy_volumes, tag_map
+    _convert_options = options
+    materialize_mode, dummy_volumes, tag_map = settings
+
+def init_worker(log_dir, options, settings):
+    """
+    Sets up a --jobs worker. The file handler of the main process is replaced
+    by one for each subject, so workers never write to the same log.
+    """
+    global _worker_log_dir
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.FileHandler):
+            logger.removeHandler(handler)
+    _worker_log_dir = log_dir
+    set_convert_settings(options, settings)
+
+def add_subject_handler(log_dir, subject):
+    date = str(datetime.date.today())
+    log_name = os.path.join(log_dir, date + "-dm_to_bids_{}.log".format(subject))
+    handler = logging.FileHandler(log_name, "w")
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter(
+            "[%(name)s] %(asctime)s - %(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    dmlogger.addHandler(handler)
+    return handler
+
+def convert_subjects(sub_ids, jobs, log_dir, options, args):
+    """
+    Converts each subject, in a pool of 'jobs' processes if more than one.
+    Returns the result of each (see run_subject) in the order they finish.
+    """
+    work = [(sub_id,) + args for sub_id in sub_ids]
+    settings = (materialize_mode, dummy_volumes, tag_map)
+    if jobs < 2 or len(work) < 2:
+        # Runs here, logging to the main log
+        set_convert_settings(options, settings)
+        return [run_subject(job) for job in work]
+
+    pool = Pool(min(jobs, len(work)), initializer=init_worker,
+            initargs=(log_dir, options, settings))
+    results = []
+    try:
+        for result in pool.imap_unordered(run_subject, work):
+            logger.warning("{} {} in {:.0f}s".format(result['subject'],
+                    result['status'], result['seconds']))
+            results.append(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def report_results(results, elapsed):
+    """
+    Logs the outcome of each subject and the overall throughput. Returns the
+    number of subjects that failed. Skipped subjects (e.g. those with nothing
+    new to convert) don't count as failures.
+    """
+    for result in sorted(results, key=lambda x: x['subject']):
+        message = "{:<30} {:<10} {:>8.0f}s {:>10}".format(result['subject'],
+                result['status'], result['seconds'],
+                format_size(result['bytes']))
+        if result['error']:
+            message += "  " + result['error']
+        logger.warning(message)
+
+    counts = Counter(result['status'] for result in results)
+    total_bytes = sum(result['bytes'] for result in results)
+    logger.warning("Converted {}, skipped {}, failed {} of {} subjects in "
+            "{:.0f}s ({:.1f} subjects/hour, {}/s)".format(
+            counts['converted'], counts['skipped'], counts['failed'],
+            len(results), elapsed, len(results) * 3600.0 / max(elapsed, 1),
+            format_size(total_bytes / max(elapsed, 1))))
+
+    if materialize_mode != 'copy':
+        saved = sum(result['saved'] for result in results)
+        logger.warning("Used {} instead of copying, saving {} of disk "
+                "space".format(materialize_mode, format_size(saved)))
+    return counts['failed']
 
 def main():
     arguments = docopt(__doc__)
@@ -468,6 +949,19 @@ def main():
     setup_logger(log_dir, to_server, debug, cfg, sub_ids)
     logger.info("BIDS folder will be {}".format(bids_dir))
 
+    try:
+        jobs = int(arguments['--jobs'])
+    except ValueError:
+        logger.error("--jobs must be a number")
+        sys.exit(1)
+
+    global materialize_mode
+    materialize_mode = arguments['--materialize']
+    if materialize_mode not in datman.utils.MATERIALIZE_MODES:
+        logger.error("--materialize must be one of: {}".format(
+                ', '.join(datman.utils.MATERIALIZE_MODES)))
+        sys.exit(1)
+
     if not nii_dir:
         nii_dir = cfg.get_path('nii')
         logger.info("Nii files to be converted to BIDS format will be from: {}".format(nii_dir))
@@ -509,92 +1003,13 @@ def main():
 
     #Run if either queue disabled or single subject
     else:
-        for sub_id in sub_ids:
-            subject_dir = sub_id
-            if scanid.is_phantom(subject_dir):
-                logger.info("File is phantom and will be ignored: {}".format(subject_dir))
-                sys.exit(1)
-
-            parsed = scanid.parse(subject_dir)
-            if os.path.isdir(os.path.join(bids_dir, to_sub(parsed), to_ses(parsed.timepoint))) and not rewrite:
-                logger.warning('BIDS subject directory already exists. Exiting: {}'.format(subject_dir))
-                sys.exit(1)
-            type_folders = create_bids_dirs(bids_dir, parsed)
-            sub_nii_dir = os.path.join(nii_dir,subject_dir) + '/'
-            logger.info("Will now begin creating files in BIDS format for: {}".format(sub_nii_dir))
-
-            #Pair together FMAPS if using PEPOLAR and map intended for json fields
-            ses_ser_file_map, matched_fmaps = validify_file(sub_nii_dir)
-            intended_fors = get_intended_fors(ses_ser_file_map, matched_fmaps)
-
-            nii_to_bids_match = dict()
-            if fmriprep_dir:
-                fs_src = os.path.join(fs_dir, subject_dir)
-                sub_ses = "{}_{}".format(to_sub(parsed), to_ses(parsed.timepoint))
-                fs_dst = os.path.join(fmriprep_fs_dir, sub_ses)
-                if os.path.isdir(fs_src):
-                    dir_util.copy_tree(fs_src, fs_dst)
-                    logger.warning("Copied {} to {}".format(fs_src, fs_dst))
-
-            cnt = {k : 0 for k in all_tags}
-            for ses in sorted(ses_ser_file_map.keys()):
-                logger.info('Session: {}'.format(ses))
-                for ser in sorted(ses_ser_file_map[ses].keys()):
-                    logger.info('Series: {}'.format(ser))
-                    series_tags = set()
-                    for item in sorted(ses_ser_file_map[ses][ser]):
-                        logger.info('File: {}'.format(item))
-                        item_path = os.path.join(sub_nii_dir, item)
-                        ident, tag, series, description = scanid.parse_filename(item)
-                        ext = os.path.splitext(item)[1]
-                        logger.info('to_bids_name')
-                        try:
-                            bids_path = to_bids_name(ident, tag, cnt, type_folders, ext)
-                        except ValueError, err:
-                            logger.info(err)
-                            continue
-                        logger.info('Copying file')
-                        copyfile(item_path, bids_path)
-                        if bids_path.endswith('nii.gz') and "task" in os.path.basename(bids_path):
-                            logger.info('fslroi')
-                            os.system('fslroi {0} {0} 4 -1'.format(bids_path))
-                            logger.warning("Finished fslroi on {}".format(os.path.basename(bids_path)))
-                        logger.info("{:<80} {:<80}".format(os.path.basename(item), os.path.basename(bids_path)))
-                        if item_path.endswith('nii.gz'):
-                            nii_to_bids_match[item] = bids_path
-                        series_tags.add(tag)
-                    while len(series_tags) > 0:
-                        cnt[series_tags.pop()] += 1
-
-            run_num = 1
-
-            #Generate field maps
-            fmaps = sorted(glob.glob("{}*run-0{}_ECHO*".format(type_folders['fmap'],run_num)))
-            while len(fmaps) > 1:
-                for fmap in fmaps:
-                    validify_fmap(fmap)
-                pattern = re.compile(r'_ECHO\d\.nii\.gz')
-                without_tag = pattern.sub("", fmaps[0])
-                base = os.path.basename(without_tag)
-
-                cmd = ['bash', 'CMH_generate_fmap.sh', fmaps[0], fmaps[1], without_tag, base]
-                datman.utils.run(cmd)
-                logger.warning("Running: {}".format(cmd))
-                run_num+=1
-                fmaps = sorted(glob.glob("{}*run-0{}*_ECHO*".format(type_folders['fmap'],run_num)))
-
-
-            modify_json(nii_to_bids_match, intended_fors, sub_nii_dir)
-
-            logger.info("Deleting unecessary BIDS folders")
-            for key in type_folders.keys():
-                folder = type_folders[key]
-                if os.listdir(folder) == []:
-                    try:
-                        logger.info("Deleting: {}".format(folder))
-                        os.rmdir(folder)
-                    except Exception, e:
-                        logger.info("Folder {} contains multiple acquistions. Should not be deleted.")
+        start = time.time()
+        options = {'fmriprep_fs_dir': fmriprep_fs_dir, 'fs_dir': fs_dir,
+                'rewrite': rewrite}
+        results = convert_subjects(sub_ids, jobs, log_dir, options,
+                (nii_dir, bids_dir, all_tags))
+        if report_results(results, time.time() - start):
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -90,6 +90,7 @@ xnat = None
 cfg = None
 DRYRUN = False
 db_ignore = False  # if True dont update the dashboard db
+db_sessions = {}  # dashboard records for sessions, looked up together
 wanted_tags = None
 
 
@@ -98,6 +99,8 @@ def main():
     global cfg
     global DRYRUN
     global wanted_tags
+    global db_ignore
+    global db_sessions
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -176,6 +179,9 @@ def main():
     logger.info("Found {} sessions for study: {}"
                 .format(len(sessions), study))
 
+    if not db_ignore:
+        db_sessions = get_dashboard_sessions(sessions)
+
     for session in sessions:
         process_session(session)
 
@@ -207,6 +213,24 @@ def collect_sessions(xnat_projects, config):
     return sessions
 
 
+def get_dashboard_sessions(sessions):
+    """
+    Retrieves the dashboard records of all existing sessions in one go.
+    Sessions not found are created as they're processed.
+    """
+    # One bad label would fail the whole lookup. process_session() skips
+    # these anyway
+    labels = [label for _, label in sessions
+            if datman.scanid.is_scanid(label)]
+    try:
+        found = dashboard.get_sessions(labels)
+    except dashboard.DashboardException as e:
+        logger.error("Failed retrieving sessions from dashboard. "
+                     "Reason: {}".format(e))
+        return {}
+    return found or {}
+
+
 def process_session(session):
     xnat_project = session[0]
     session_label = session[1]
@@ -274,7 +298,12 @@ def process_session(session):
     if not db_ignore:
         logger.debug("Adding session {} to dashboard".format(session_label))
         try:
-            db_session = dashboard.get_session(ident, create=True)
+            if session_label in db_sessions:
+                # Already looked up, so a missing record can just be added
+                db_session = db_sessions[session_label] or \
+                        dashboard.add_session(ident)
+            else:
+                db_session = dashboard.get_session(ident, create=True)
         except dashboard.DashboardException as e:
             logger.error("Failed adding session {}. Reason: {}".format(
                     session_label, e))
@@ -82,10 +82,7 @@ def main():
     logger.info('Loading config')
 
     CFG = datman.config.config(study=study)
-
-    server = datman.xnat.get_server(CFG, url=server)
-    username, password = datman.xnat.get_auth(username)
-    XNAT = datman.xnat.xnat(server, username, password)
+    connect(CFG, url=server, user=username)
 
     dicom_dir = CFG.get_path('dicom', study)
     # deal with a single archive specified on the command line,
@@ -111,6 +108,22 @@ def main():
         process_archive(os.path.join(dicom_dir, archivefile))
 
 
+def connect(config, url=None, user=None):
+    """
+    Sets the config and opens the XNAT connection used by process_archive()
+    """
+    global username
+    global server
+    global password
+    global XNAT
+    global CFG
+
+    CFG = config
+    server = datman.xnat.get_server(CFG, url=url)
+    username, password = datman.xnat.get_auth(user)
+    XNAT = datman.xnat.xnat(server, username, password)
+
+
 def is_datman_id(archive):
     # scanid.is_scanid() isnt used because a complete id is needed (either
     # a whole phantom ID or a subid with timepoint and session)
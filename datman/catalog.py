@@ -0,0 +1,295 @@
+"""
+A persistent index of the datman-named files found in a study's folders.
+
+Many tools need to know which subjects and series exist in the nii, dcm, qc,
+etc. folders. Globbing these folders on every run is slow when the archive is
+large or mounted over the network, so this module keeps a SQLite database of
+their contents that can be cheaply brought up to date.
+
+    import datman.config
+    import datman.catalog
+
+    config = datman.config.config(study='SPINS')
+    with datman.catalog.Catalog(config) as catalog:
+        catalog.refresh()
+        t1s = catalog.find(tag='T1', path_type='nii')
+        subjects = catalog.subjects('qc')
+
+Only files inside datman-named subject folders (e.g. nii/SPN01_CMH_0001_01) are
+indexed. Each entry records the subject folder, the parsed datman name of the
+file (if it has one), and its size and mtime.
+
+Refreshing is incremental. A directory is only re-read when its mtime has
+changed, which happens when entries are added, removed or renamed. Files
+rewritten in place inside an unchanged directory keep their old size and
+mtime until the directory itself changes, or until refresh(full=True) is used.
+"""
+import os
+import logging
+import sqlite3
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2 without the scandir backport
+    scandir = None
+
+import datman.scanid as scanid
+
+logger = logging.getLogger(__name__)
+
+# The study folders indexed by default
+PATH_TYPES = ['nii', 'dcm', 'mnc', 'nrrd', 'qc', 'resources']
+
+# Default database location, relative to the study's 'meta' folder
+CATALOG_NAME = '.datman_catalog.sqlite'
+
+CatalogEntry = namedtuple('CatalogEntry', ['path', 'path_type', 'subject',
+        'session', 'tag', 'series', 'description', 'size', 'mtime'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    path_type TEXT NOT NULL,
+    subject TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    path_type TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    session TEXT,
+    tag TEXT,
+    series TEXT,
+    description TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, path_type);
+CREATE INDEX IF NOT EXISTS files_tag ON files (tag, path_type);
+"""
+
+
+class CatalogException(Exception):
+    pass
+
+
+class Catalog(object):
+    """
+    A SQLite backed index of a study's files.
+
+        config:         A datman config object, set to the study to index
+        db_path:        Where to keep the database. Defaults to
+                        CATALOG_NAME inside the study's 'meta' folder
+        path_types:     The study folders to index (default: PATH_TYPES).
+                        Folders not defined for the study are skipped.
+    """
+
+    def __init__(self, config, db_path=None, path_types=None):
+        if not db_path:
+            db_path = os.path.join(config.get_path('meta'), CATALOG_NAME)
+        self.db_path = db_path
+        self.roots = {}
+        for path_type in (path_types or PATH_TYPES):
+            try:
+                self.roots[path_type] = config.get_path(path_type)
+            except Exception:
+                logger.debug("Path {} not defined, it will not be "
+                        "catalogued".format(path_type))
+        try:
+            self._db = sqlite3.connect(db_path, timeout=60)
+            self._db.executescript(_SCHEMA)
+        except sqlite3.Error as e:
+            raise CatalogException("Can't open catalog {}. Reason - "
+                    "{}".format(db_path, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self, full=False):
+        """
+        Brings the index up to date with the file system. Only directories
+        whose mtime has changed since the last refresh are re-read, unless
+        'full' is set.
+
+        Returns the number of directories that were re-read.
+        """
+        rescanned = 0
+        with self._db:
+            for path_type, root in self.roots.items():
+                rescanned += self._refresh_dir(root, None, path_type, None,
+                        full)
+        return rescanned
+
+    def find(self, subject=None, tag=None, path_type=None):
+        """
+        Returns a list of CatalogEntry tuples for the indexed files that match
+        all of the given criteria.
+
+        subject may be an ID with or without a session number (or a
+        datman.scanid.Identifier). If a session is included only files from
+        that session are returned.
+        """
+        clauses = []
+        values = []
+        if subject:
+            ident = _get_ident(subject)
+            clauses.append('subject = ?')
+            values.append(ident.get_full_subjectid_with_timepoint())
+            if ident.session:
+                clauses.append('session = ?')
+                values.append(ident.session)
+        if tag:
+            clauses.append('tag = ?')
+            values.append(tag)
+        if path_type:
+            clauses.append('path_type = ?')
+            values.append(path_type)
+
+        query = 'SELECT path, path_type, subject, session, tag, series, ' \
+                'description, size, mtime FROM files'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY path'
+
+        return [CatalogEntry(*row) for row in self._db.execute(query, values)]
+
+    def subjects(self, path_type):
+        """
+        Returns the sorted names of all subject folders found for a path type.
+        """
+        rows = self._db.execute('SELECT path FROM dirs WHERE path_type = ? '
+                'AND parent = ?', (path_type, self.roots.get(path_type)))
+        return sorted(os.path.basename(row[0]) for row in rows)
+
+    def _refresh_dir(self, path, parent, path_type, subject, full):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._forget_dir(path)
+            return 0
+
+        row = self._db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                (path,)).fetchone()
+        if row and row[0] == mtime and not full:
+            # Contents unchanged, but nested folders may still have changed
+            children = [child[0] for child in self._db.execute(
+                    'SELECT path FROM dirs WHERE parent = ?', (path,))]
+            rescanned = 0
+        else:
+            try:
+                children = self._read_dir(path, path_type, subject)
+            except OSError as e:
+                # Keep what was last read and the old mtime, so the folder is
+                # read again on the next refresh instead of looking empty
+                logger.error("Can't read {}. Reason - {}".format(path, e))
+                return 0
+            self._db.execute('INSERT OR REPLACE INTO dirs (path, parent, '
+                    'path_type, subject, mtime) VALUES (?, ?, ?, ?, ?)',
+                    (path, parent, path_type, subject, mtime))
+            rescanned = 1
+
+        for child in children:
+            child_subject = subject or _get_subject(child)
+            rescanned += self._refresh_dir(child, path, path_type,
+                    child_subject, full)
+        return rescanned
+
+    def _read_dir(self, path, path_type, subject):
+        """
+        Re-indexes the files directly inside 'path' and returns the sub
+        directories that should be catalogued.
+        """
+        dirs = []
+        files = []
+        for name, full_path, is_dir in _list_dir(path):
+            if is_dir:
+                if subject or _get_subject(full_path):
+                    dirs.append(full_path)
+                continue
+            if not subject:
+                # Files outside of subject folders aren't tracked
+                continue
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            files.append(_make_row(full_path, path, path_type, subject, stat))
+
+        self._db.execute('DELETE FROM files WHERE dir = ?', (path,))
+        self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?)', files)
+
+        known = [row[0] for row in self._db.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (path,))]
+        for old_dir in set(known) - set(dirs):
+            self._forget_dir(old_dir)
+
+        return dirs
+
+    def _forget_dir(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        self._db.execute('DELETE FROM files WHERE dir = ? OR '
+                'substr(dir, 1, ?) = ?', (path, len(prefix), prefix))
+        self._db.execute('DELETE FROM dirs WHERE path = ? OR '
+                'substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+
+
+def _get_ident(subject):
+    if isinstance(subject, scanid.Identifier):
+        return subject
+    try:
+        return scanid.parse(subject)
+    except scanid.ParseException:
+        raise CatalogException("Invalid subject ID {}".format(subject))
+
+
+def _get_subject(path):
+    """
+    Returns the subject ID (minus session) for a datman named folder or None
+    """
+    try:
+        ident = scanid.parse(os.path.basename(path))
+    except scanid.ParseException:
+        return None
+    return ident.get_full_subjectid_with_timepoint()
+
+
+def _make_row(path, dir_path, path_type, subject, stat):
+    try:
+        ident, tag, series, description = scanid.parse_filename(path)
+    except scanid.ParseException:
+        session = tag = series = description = None
+    else:
+        subject = ident.get_full_subjectid_with_timepoint()
+        session = ident.session
+    return (path, dir_path, path_type, subject, session, tag, series,
+            description, stat.st_size, stat.st_mtime)
+
+
+def _list_dir(path):
+    """
+    Yields (name, full path, is a directory) for every non-hidden entry in
+    path. Raises OSError if path can't be read.
+    """
+    if scandir is None:
+        entries = [(name, os.path.join(path, name)) for name in
+                os.listdir(path)]
+        for name, full_path in entries:
+            if not name.startswith('.'):
+                yield name, full_path, os.path.isdir(full_path)
+        return
+    for entry in scandir(path):
+        if not entry.name.startswith('.'):
+            yield entry.name, entry.path, entry.is_dir()
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from functools import wraps
+from contextlib import contextmanager
 import os
 import logging
 from datetime import datetime
@@ -10,7 +11,7 @@ from datman.exceptions import DashboardException
 logger = logging.getLogger(__name__)
 
 try:
-    from dashboard import queries, monitors
+    from dashboard import queries, monitors, models
 except ImportError:
     dash_found = False
     logger.error("Dashboard not found, proceeding without it.")
@@ -18,6 +19,82 @@ else:
     dash_found = True
 
 
+# The per-process record cache. None unless enable_cache() has been called.
+_cache = None
+
+# Most names given to one 'IN (...)' filter by the batch queries
+QUERY_CHUNK_SIZE = 500
+
+
+class RecordCache(object):
+    """
+    Remembers each dashboard record looked up by this process, keyed by a
+    normalized identifier (e.g. 'subject' + subject ID minus session), so the
+    same record is only retrieved from the database once. Misses (None
+    results) are remembered too. Entries are invalidated when the add_*
+    functions create the records they refer to.
+
+    Records aren't refreshed if something else changes the database, so this
+    is only meant for scripts that do a single pass over a study.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, query):
+        try:
+            record = self.records[key]
+        except KeyError:
+            self.misses += 1
+            record = query()
+            self.records[key] = record
+        else:
+            self.hits += 1
+        return record
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.records.pop(key, None)
+
+    def clear(self):
+        self.records.clear()
+
+    def __repr__(self):
+        return "<datman.dashboard.RecordCache: {} records, {} hits, {} " \
+                "misses>".format(len(self.records), self.hits, self.misses)
+
+
+def enable_cache():
+    """
+    Turns on the record cache for the rest of this process (see RecordCache)
+    and returns it, so its hits and misses can be reported.
+    """
+    global _cache
+    if _cache is None:
+        _cache = RecordCache()
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def _lookup(key, query):
+    if _cache is None:
+        return query()
+    return _cache.lookup(key, query)
+
+
+def _invalidate(*keys):
+    if _cache is not None:
+        _cache.invalidate(*keys)
+
 
 def dashboard_required(f):
     @wraps(f)
@@ -105,16 +182,23 @@ def filename_required(f):
 @dashboard_required
 @scanid_required
 def get_subject(name, create=False):
+    subject = _lookup(_subject_key(name), lambda: _find_subject(name))
+    if subject:
+        return subject
+
+    if create:
+        return add_subject(name)
+
+    return None
+
+
+def _find_subject(name):
     found = queries.find_subjects(name.get_full_subjectid_with_timepoint())
     if len(found) > 1:
         raise DashboardException("Couldnt identify record for {}. {} matching "
             "records found".format(name, len(found)))
     if len(found) == 1:
         return found[0]
-
-    if create:
-        return add_subject(name)
-
     return None
 
 
@@ -131,21 +215,19 @@ def add_subject(name):
                 len(studies)))
     study = studies[0].study
 
-    return study.add_timepoint(name)
+    timepoint = study.add_timepoint(name)
+    _invalidate(_subject_key(name))
+    return timepoint
 
 
 @dashboard_required
 @scanid_required
 def get_session(name, create=False, date=None):
-    try:
-        sess_num = datman.scanid.get_session_num(name)
-    except datman.scanid.ParseException:
-        logger.info("{} is missing a session number. Using default session "
-                "'1'".format(name))
-        sess_num = 1
+    sess_num = _get_session_num(name)
 
-    session = queries.get_session(name.get_full_subjectid_with_timepoint(),
-            sess_num)
+    session = _lookup(_session_key(name, sess_num),
+            lambda: queries.get_session(
+                name.get_full_subjectid_with_timepoint(), sess_num))
 
     if not session and create:
         session = add_session(name, date=date)
@@ -157,13 +239,7 @@ def get_session(name, create=False, date=None):
 @scanid_required
 def add_session(name, date=None):
     timepoint = get_subject(name, create=True)
-
-    try:
-        sess_num = datman.scanid.get_session_num(name)
-    except datman.scanid.ParseException:
-        logger.info("{} is missing a session number. Using default session "
-                "'1'".format(name))
-        sess_num = 1
+    sess_num = _get_session_num(name)
 
     if timepoint.is_phantom and sess_num > 1:
         raise DashboardException("ERROR: attempt to add repeat scan session to "
@@ -178,6 +254,7 @@ def add_session(name, date=None):
             raise DashboardException("Invalid date format {}".format(date))
 
     new_session = timepoint.add_session(sess_num, date=date)
+    _invalidate(_subject_key(name), _session_key(name, sess_num))
 
     if timepoint.expects_redcap():
         try:
@@ -196,20 +273,28 @@ def get_scan(name, tag=None, series=None, description=None, source_id=None,
         create=False):
     scan_name = _get_scan_name(name, tag, series)
 
+    scan = _lookup(_scan_key(scan_name), lambda: _find_scan(name,
+            scan_name))
+    if scan:
+        return scan
+
+    if create:
+        return add_scan(name, tag=tag, series=series, description=description,
+                source_id=source_id)
+
+    return None
+
+
+def _find_scan(ident, scan_name):
     scan = queries.get_scan(scan_name,
-            timepoint=name.get_full_subjectid_with_timepoint(),
-            session=name.session)
+            timepoint=ident.get_full_subjectid_with_timepoint(),
+            session=ident.session)
 
     if len(scan) > 1:
         raise DashboardException("Couldnt identify scan {}. {} matches "
                 "found".format(scan_name, len(scan)))
     if len(scan) == 1:
         return scan[0]
-
-    if create:
-        return add_scan(name, tag=tag, series=series, description=description,
-                source_id=source_id)
-
     return None
 
 
@@ -217,21 +302,150 @@ def get_scan(name, tag=None, series=None, description=None, source_id=None,
 @filename_required
 def add_scan(name, tag=None, series=None, description=None, source_id=None):
     session = get_session(name, create=True)
-    studies = queries.get_study(tag=name.study, site=name.site)
     scan_name = _get_scan_name(name, tag, series)
+    study = _get_scan_study(name, scan_name)
+    _check_scan_tag(study, scan_name, tag)
 
-    if len(studies) != 1:
-        raise DashboardException("Can't identify study to add scan {} to. {} "
-                "matches found.".format(scan_name, len(studies)))
-    study = studies[0].study
-    allowed_tags = [st.tag for st in study.scantypes]
+    scan = session.add_scan(scan_name, series, tag, description,
+            source_id=source_id)
+    _invalidate(_scan_key(scan_name))
+    return scan
 
-    if tag not in allowed_tags:
-        raise DashboardException("Scan name {} contains tag not configured "
-                "for study {}".format(scan_name, str(study)))
 
-    return session.add_scan(scan_name, series, tag, description,
-            source_id=source_id)
+@dashboard_required
+def get_scans(names, create=False):
+    """
+    Looks up many scans at once. <names> should be a list of datman style
+    file names (paths and extensions are ignored).
+
+    Returns a dictionary mapping each name to its dashboard record, or to None
+    if it isn't in the database and 'create' isn't set. All records not
+    already cached are retrieved with one query.
+    """
+    scan_names = {}
+    for name in names:
+        ident, tag, series, _ = _parse_filename(name)
+        scan_names[name] = _get_scan_name(ident, tag, series)
+
+    unique = set(scan_names.values())
+    uncached = [scan_name for scan_name in unique
+            if _cache is None or _scan_key(scan_name) not in _cache]
+    found = {}
+    for record in _query_scans(uncached):
+        found.setdefault(record.name, []).append(record)
+
+    def find(scan_name):
+        matches = found.get(scan_name, [])
+        if len(matches) > 1:
+            raise DashboardException("Couldnt identify scan {}. {} "
+                    "matches found".format(scan_name, len(matches)))
+        return matches[0] if matches else None
+
+    records = {scan_name: _lookup(_scan_key(scan_name),
+            lambda: find(scan_name)) for scan_name in unique}
+    scans = {name: records[scan_name]
+            for name, scan_name in scan_names.items()}
+
+    if create:
+        missing = [name for name in scans if scans[name] is None]
+        if missing:
+            scans.update(add_scans(missing))
+
+    return scans
+
+
+@dashboard_required
+def add_scans(records):
+    """
+    Adds many scans at once. <records> should be either a list of datman
+    style file names or a dictionary mapping file names to the ID of the scan
+    each one is a link to (None for scans that aren't links).
+
+    Each study is only looked up once and all sessions are retrieved together
+    (missing sessions are created first). The scans are then added in a
+    single transaction, so either all of them are added or none are. Returns
+    a dictionary of each file name mapped to its new record.
+    """
+    if not isinstance(records, dict):
+        records = {name: None for name in records}
+
+    parsed = {}
+    studies = {}
+    for name in records:
+        ident, tag, series, description = _parse_filename(name)
+        scan_name = _get_scan_name(ident, tag, series)
+
+        study_key = (ident.study, ident.site)
+        if study_key not in studies:
+            studies[study_key] = _get_scan_study(ident, scan_name)
+        _check_scan_tag(studies[study_key], scan_name, tag)
+        parsed[name] = (ident, scan_name, tag, series, description)
+
+    sessions = get_sessions(set(str(item[0]) for item in parsed.values()),
+            create=True)
+
+    added = {}
+    with _single_transaction() as savepoint:
+        for name, (ident, scan_name, tag, series, description) in \
+                parsed.items():
+            savepoint()
+            added[name] = sessions[str(ident)].add_scan(scan_name, series,
+                    tag, description, source_id=records[name])
+    _invalidate(*[_scan_key(item[1]) for item in parsed.values()])
+    return added
+
+
+@dashboard_required
+def get_sessions(names, create=False):
+    """
+    Looks up many sessions at once. <names> should be a list of subject IDs
+    (with session numbers) or datman.scanid.Identifier instances.
+
+    Returns a dictionary mapping each name to its dashboard record, or to None
+    if it isn't in the database and 'create' isn't set. All records are
+    retrieved with one query.
+    """
+    keys = {}
+    for name in names:
+        ident = _parse_scanid(name)
+        keys[name] = (ident.get_full_subjectid_with_timepoint(),
+                _get_session_num(ident))
+
+    found = {(record.name, record.num): record
+            for record in _query_sessions(set(keys.values()))}
+    sessions = {name: found.get(key) for name, key in keys.items()}
+
+    if create:
+        for name in sessions:
+            if sessions[name] is None:
+                sessions[name] = add_session(name)
+
+    return sessions
+
+
+@dashboard_required
+def add_checklist_entries(entries, user=None, sign_off=False):
+    """
+    Adds a QC checklist entry for many scans at once. <entries> should be a
+    dictionary of datman style file names mapped to their comments.
+
+    All scans are looked up together and must already exist. If no user is
+    given the default dashboard user is used.
+    """
+    if not user:
+        user = get_default_user()
+
+    scans = get_scans(list(entries))
+    missing = [name for name in scans if scans[name] is None]
+    if missing:
+        raise DashboardException("Scans not found in the dashboard database: "
+                "{}".format(", ".join(sorted(missing))))
+
+    with _single_transaction() as savepoint:
+        for name in entries:
+            savepoint()
+            scans[name].add_checklist_entry(user.id, comment=entries[name],
+                    sign_off=sign_off)
 
 
 @dashboard_required
@@ -245,6 +459,11 @@ def get_project(name=None, tag=None, site=None):
     if not (name or tag):
         raise DashboardException("Can't locate a study without the study "
                 "nickname or a study tag")
+    return _lookup(('project', name, tag, site), lambda: _find_project(
+            name=name, tag=tag, site=site))
+
+
+def _find_project(name=None, tag=None, site=None):
     studies = queries.get_study(name=name, tag=tag, site=site)
     search_term = name or tag
     if len(studies) == 0:
@@ -265,6 +484,10 @@ def get_default_user():
     except KeyError:
         raise DashboardException("Can't retrieve default dashboard user ID. "
                 "DASHBOARD_USER environment variable not set.")
+    return _lookup(('user', user), lambda: _find_user(user))
+
+
+def _find_user(user):
     user = queries.get_user(user)
     if not user or len(user) > 1:
         raise DashboardException("Can't locate default user {} in "
@@ -291,3 +514,109 @@ def get_default_user():
 def _get_scan_name(ident, tag, series):
     name = "_".join([str(ident), tag, str(series)])
     return name
+
+
+def _subject_key(ident):
+    return ('subject', ident.get_full_subjectid_with_timepoint())
+
+
+def _session_key(ident, sess_num):
+    return ('session', ident.get_full_subjectid_with_timepoint(), sess_num)
+
+
+def _scan_key(scan_name):
+    return ('scan', scan_name)
+
+
+def _get_session_num(ident):
+    try:
+        sess_num = datman.scanid.get_session_num(ident)
+    except datman.scanid.ParseException:
+        logger.info("{} is missing a session number. Using default session "
+                "'1'".format(ident))
+        sess_num = 1
+    return sess_num
+
+
+def _get_scan_study(ident, scan_name):
+    studies = queries.get_study(tag=ident.study, site=ident.site)
+    if len(studies) != 1:
+        raise DashboardException("Can't identify study to add scan {} to. {} "
+                "matches found.".format(scan_name, len(studies)))
+    return studies[0].study
+
+
+def _check_scan_tag(study, scan_name, tag):
+    allowed_tags = [st.tag for st in study.scantypes]
+    if tag not in allowed_tags:
+        raise DashboardException("Scan name {} contains tag not configured "
+                "for study {}".format(scan_name, str(study)))
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), QUERY_CHUNK_SIZE):
+        yield items[start:start + QUERY_CHUNK_SIZE]
+
+
+def _query_scans(scan_names):
+    """
+    Returns the scan records matching any of the given scan names, with one
+    'IN (...)' query for each QUERY_CHUNK_SIZE names.
+    """
+    found = []
+    for chunk in _chunks(scan_names):
+        found.extend(models.Scan.query.filter(
+                models.Scan.name.in_(chunk)).all())
+    return found
+
+
+def _query_sessions(keys):
+    """
+    Returns the session records matching any of the given (subject ID,
+    session number) pairs. Sessions are retrieved for all of the subjects
+    at once and then matched on their number.
+    """
+    keys = set(keys)
+    found = []
+    for chunk in _chunks(set(name for name, _ in keys)):
+        found.extend(models.Session.query.filter(
+                models.Session.name.in_(chunk)).all())
+    return [record for record in found if (record.name, record.num) in keys]
+
+
+@contextmanager
+def _single_transaction():
+    """
+    Runs the dashboard model methods called inside it as one transaction.
+    Each of those methods commits its own changes, so the caller must call
+    the function this yields before each one. That opens a savepoint for the
+    method to commit to instead, and the real commit happens once at the end.
+    Everything is rolled back if any of them fails.
+    """
+    db_session = models.db.session
+    try:
+        yield db_session.begin_nested
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+
+def _parse_filename(name):
+    try:
+        return datman.scanid.parse_filename(name)
+    except datman.scanid.ParseException:
+        raise DashboardException("Expected: a datman file name. Received: "
+                "{}".format(name))
+
+
+def _parse_scanid(name):
+    if isinstance(name, datman.scanid.Identifier):
+        return name
+    try:
+        return datman.scanid.parse(name)
+    except datman.scanid.ParseException:
+        raise DashboardException("Expected: a valid subject ID or an "
+                "instance of datman.scanid.Identifier. Received: "
+                "{}".format(name))
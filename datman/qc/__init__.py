@@ -0,0 +1,4 @@
+"""
+Native implementations of the image rendering and metrics used by the QC
+pages, so they can be produced without running external programs.
+"""
@@ -0,0 +1,233 @@
+"""
+Computes the DTI QC metrics shown on the QC pages. This replaces qcmon's
+'qc-dti' and 'qc-spikecount' commands.
+
+    import datman.qc.dti as dti_qc
+
+    dti_qc.run_qc('dti.nii.gz', 'dti.bval', '/path/to/qc/dti')
+    dti_qc.plot_directions('dti.bvec', '/path/to/qc/dti_directions.png')
+
+run_qc() writes:
+
+    <prefix>_spikecount.csv     One line for each slice flagged as a spike or
+                                a dropout ('volume,slice,bval,type,ratio').
+    <prefix>_stats.csv          Summary metrics (one 'metric,value' per line).
+
+Each slice of each volume is summarized by its mean intensity inside a brain
+mask made from the first b0. A slice is compared to the same slice in every
+other volume of its shell (the b0s, or the volumes sharing a b-value). A
+slice is a spike if it's much brighter than that shell's median, or a
+dropout if it's much darker, measured both as a robust z-score and as a
+ratio to the median.
+
+The image is read a chunk of volumes at a time (see datman.qc.fmri), so only
+the per slice means and the b0 sums are held in memory no matter how many
+directions were acquired.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+from datman.qc.fmri import iter_chunks, write_stats, CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Largest b-value still treated as a b0
+B0_THRESHOLD = 50
+
+# b-values within this of each other are the same shell
+SHELL_ROUNDING = 100
+
+# A slice is flagged when its robust z-score against the rest of its shell is
+# beyond this and its mean differs from the shell's median by more than the
+# given fraction
+Z_THRESHOLD = 5.0
+SPIKE_RATIO = 1.1
+DROPOUT_RATIO = 0.9
+
+# Smallest spread (as a fraction of the median) used for the z-scores
+MIN_SPREAD = 0.01
+
+# Shells with fewer volumes than this aren't checked
+MIN_SHELL_SIZE = 3
+
+# Fraction of the first b0's 98th percentile used for the brain mask
+MASK_THRESHOLD = 0.1
+
+
+def read_bvals(bval):
+    bvals = np.loadtxt(bval, ndmin=1).ravel()
+    return bvals
+
+
+def get_shells(bvals):
+    """
+    Returns an array giving each volume's shell, with 0 for the b0s.
+    """
+    shells = np.round(bvals / float(SHELL_ROUNDING)) * SHELL_ROUNDING
+    shells[bvals <= B0_THRESHOLD] = 0
+    return shells
+
+
+def get_slice_means(nifti, bvals, chunk_size=CHUNK_SIZE):
+    """
+    Reads the image once, returning a (volumes, slices) array of the mean of
+    each slice inside the brain mask, the mask, and the mean and standard
+    deviation over the b0 volumes.
+    """
+    image = nib.load(nifti)
+    shape = image.shape
+    n_vols = shape[3] if len(shape) > 3 else 1
+    if len(bvals) != n_vols:
+        raise ValueError("{} has {} volumes but {} b-values".format(nifti,
+                n_vols, len(bvals)))
+    is_b0 = bvals <= B0_THRESHOLD
+    if not is_b0.any():
+        raise ValueError("No b0 volumes found for {}".format(nifti))
+
+    # The mask comes from the first b0, which is nearly always the first
+    # volume, so this reads very little
+    first_b0 = np.asarray(image.dataobj[..., int(np.argmax(is_b0))],
+            dtype=np.float64)
+    mask = first_b0 > MASK_THRESHOLD * np.percentile(first_b0, 98)
+    voxels_per_slice = mask.sum(axis=(0, 1)).astype(np.float64)
+
+    slice_means = np.zeros((n_vols, shape[2]))
+    b0_sum = np.zeros(shape[:3])
+    b0_sum_sq = np.zeros(shape[:3])
+
+    for start, chunk in iter_chunks(image, chunk_size):
+        count = chunk.shape[-1]
+        masked = chunk * mask[..., np.newaxis]
+        sums = masked.sum(axis=(0, 1))
+        slice_means[start:start + count] = np.divide(sums.T,
+                voxels_per_slice, out=np.zeros((count, shape[2])),
+                where=voxels_per_slice > 0)
+        b0s = chunk[..., is_b0[start:start + count]]
+        b0_sum += b0s.sum(axis=3)
+        b0_sum_sq += (b0s ** 2).sum(axis=3)
+
+    n_b0 = is_b0.sum()
+    b0_mean = b0_sum / n_b0
+    b0_var = np.maximum(b0_sum_sq / n_b0 - b0_mean ** 2, 0)
+    if n_b0 > 1:
+        b0_var *= n_b0 / float(n_b0 - 1)
+    return slice_means, mask, b0_mean, np.sqrt(b0_var)
+
+
+def find_outliers(slice_means, shells):
+    """
+    Compares each slice to the same slice in the rest of its shell.
+
+    Returns a list of (volume, slice, shell, 'spike' or 'dropout', ratio to
+    the shell median) tuples.
+    """
+    outliers = []
+    for shell in np.unique(shells):
+        volumes = np.flatnonzero(shells == shell)
+        if len(volumes) < MIN_SHELL_SIZE:
+            logger.debug("Only {} volumes with b={}, not checked".format(
+                    len(volumes), shell))
+            continue
+        means = slice_means[volumes]
+        median = np.median(means, axis=0)
+        mad = 1.4826 * np.median(np.abs(means - median), axis=0)
+        # Keeps slices with almost no spread in their shell from being
+        # flagged for tiny differences
+        mad = np.maximum(mad, MIN_SPREAD * median)
+        checked = median > 0
+        ratio = np.divide(means, median, out=np.ones(means.shape),
+                where=checked)
+        z_score = np.divide(means - median, mad, out=np.zeros(means.shape),
+                where=checked)
+
+        spikes = (z_score > Z_THRESHOLD) & (ratio > SPIKE_RATIO)
+        dropouts = (z_score < -Z_THRESHOLD) & (ratio < DROPOUT_RATIO)
+        for kind, found in [('spike', spikes), ('dropout', dropouts)]:
+            for vol_idx, slice_num in zip(*np.nonzero(found)):
+                outliers.append((int(volumes[vol_idx]), int(slice_num),
+                        shell, kind, ratio[vol_idx, slice_num]))
+    return sorted(outliers)
+
+
+def compute_metrics(nifti, bval, chunk_size=CHUNK_SIZE):
+    """
+    Returns a tuple of (outliers, stats) for a DTI series. See find_outliers()
+    for the format of outliers. stats is an OrderedDict of summary values.
+    """
+    bvals = read_bvals(bval)
+    shells = get_shells(bvals)
+    slice_means, mask, b0_mean, b0_std = get_slice_means(nifti, bvals,
+            chunk_size=chunk_size)
+    outliers = find_outliers(slice_means, shells)
+
+    spikes = [item for item in outliers if item[3] == 'spike']
+    dropouts = [item for item in outliers if item[3] == 'dropout']
+    stats = OrderedDict()
+    stats['volumes'] = len(bvals)
+    stats['b0_volumes'] = int((shells == 0).sum())
+    stats['directions'] = int((shells > 0).sum())
+    stats['shells'] = ' '.join(str(int(shell))
+            for shell in np.unique(shells) if shell > 0)
+    stats['b0_mean'] = b0_mean[mask].mean()
+    valid = mask & (b0_std > 0)
+    stats['b0_tsnr'] = (b0_mean[valid] / b0_std[valid]).mean() \
+            if valid.any() else 0
+    stats['spike_count'] = len(spikes)
+    stats['dropout_count'] = len(dropouts)
+    stats['volumes_with_spikes'] = len(set(item[0] for item in spikes))
+    stats['volumes_with_dropouts'] = len(set(item[0] for item in dropouts))
+    return outliers, stats
+
+
+def write_outliers(outliers, output):
+    with open(output, 'w') as fh:
+        fh.write('volume,slice,bval,type,ratio\n')
+        for volume, slice_num, shell, kind, ratio in outliers:
+            fh.write('{},{},{},{},{:.3f}\n'.format(volume, slice_num,
+                    int(shell), kind, ratio))
+
+
+def run_qc(nifti, bval, output_prefix, chunk_size=CHUNK_SIZE):
+    """
+    Writes the spike / dropout list and summary stats for a DTI series to
+    files starting with output_prefix.
+    """
+    logger.debug("Computing DTI QC metrics for {}".format(nifti))
+    outliers, stats = compute_metrics(nifti, bval, chunk_size=chunk_size)
+    write_outliers(outliers, output_prefix + '_spikecount.csv')
+    write_stats(stats, output_prefix + '_stats.csv')
+    return stats
+
+
+def plot_directions(bvec, output):
+    """
+    Plots the diffusion directions on the unit sphere, seen from three sides.
+    """
+    # matplotlib is only needed here. pyplot keeps global state and this runs
+    # on QC worker threads, so the figure is drawn straight onto its own Agg
+    # canvas instead
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    vectors = np.loadtxt(bvec, ndmin=2)
+    if vectors.shape[0] != 3:
+        vectors = vectors.T
+    vectors = vectors[:, np.linalg.norm(vectors, axis=0) > 0]
+
+    figure = Figure(figsize=(12, 4))
+    FigureCanvasAgg(figure)
+    axes = [figure.add_subplot(1, 3, num) for num in range(1, 4)]
+    for axis, (first, second), title in zip(axes, [(0, 1), (0, 2), (1, 2)],
+            ['x-y', 'x-z', 'y-z']):
+        # Directions and their opposites are equivalent
+        axis.scatter(np.concatenate([vectors[first], -vectors[first]]),
+                np.concatenate([vectors[second], -vectors[second]]), s=8)
+        axis.set_xlim(-1.1, 1.1)
+        axis.set_ylim(-1.1, 1.1)
+        axis.set_aspect('equal')
+        axis.set_title(title)
+    figure.suptitle('{} directions'.format(vectors.shape[1]))
+    figure.savefig(output)
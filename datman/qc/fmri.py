@@ -0,0 +1,229 @@
+"""
+Computes the fMRI QC metrics shown on the QC pages. This replaces qcmon's
+'qc-fmri' and 'qc-scanlength' commands.
+
+    import datman.qc.fmri as fmri_qc
+
+    fmri_qc.write_scan_length('run.nii.gz', 'run_scanlengths.csv')
+    fmri_qc.run_qc('run.nii.gz', '/path/to/qc/run')
+
+run_qc() writes outputs with the same names qc-fmri used:
+
+    <prefix>_sfnr.nii.gz    Signal to fluctuation noise ratio map. The mean
+                            divided by the standard deviation of the
+                            residuals after removing a quadratic trend.
+    <prefix>_corr.nii.gz    Correlation of each voxel's time series with the
+                            global signal.
+    <prefix>_stats.csv      Summary metrics (one 'metric,value' per line).
+
+along with a <prefix>_tsnr.nii.gz map (the mean divided by the temporal
+standard deviation).
+
+The maps are computed the way qc-fmri computed them, but the stats aren't
+the same: _stats.csv has its own 'metric,value' layout and leaves out
+qc-fmri's motion (framewise displacement) metrics, which need the run to be
+registered. tests/benchmark_qc_fmri.py compares the two sets of outputs.
+
+All metrics are accumulated in a single pass over the time series. The image
+is read a chunk of volumes at a time straight from the file (compressed or
+not), so memory use depends on the chunk size and not on the run length.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+import nibabel.openers
+
+logger = logging.getLogger(__name__)
+
+# Volumes read at a time
+CHUNK_SIZE = 32
+
+# Order of the polynomial trend removed before computing SFNR
+DETREND_ORDER = 2
+
+# Voxels brighter than this fraction of the first volume's 98th percentile
+# are used for the global signal and summary metrics
+MASK_THRESHOLD = 0.1
+
+
+def get_scan_length(nifti):
+    """
+    Returns the number of volumes in an image, using only its header.
+    """
+    shape = nib.load(nifti).shape
+    if len(shape) < 4:
+        return 1
+    return shape[3]
+
+
+def write_scan_length(nifti, output):
+    """
+    Writes an image's number of volumes to a csv.
+    """
+    with open(output, 'w') as fh:
+        fh.write('file,scan_length\n')
+        fh.write('{},{}\n'.format(nifti, get_scan_length(nifti)))
+
+
+def iter_chunks(image, chunk_size=CHUNK_SIZE):
+    """
+    Yields (first volume number, float64 array of up to chunk_size volumes)
+    reading the image's data sequentially. Volumes are contiguous on disk, so
+    this never needs to seek backwards in a compressed file.
+    """
+    # The array proxy holds the on disk layout and scaling of the data
+    proxy = image.dataobj
+    shape = image.shape
+    vol_shape = tuple(shape[:3])
+    n_vols = shape[3] if len(shape) > 3 else 1
+    dtype = np.dtype(proxy.dtype)
+    vol_bytes = int(np.prod(vol_shape)) * dtype.itemsize
+    slope, inter = proxy.slope, proxy.inter
+
+    with nibabel.openers.ImageOpener(image.get_filename()) as fobj:
+        fobj.seek(proxy.offset)
+        for start in range(0, n_vols, chunk_size):
+            count = min(chunk_size, n_vols - start)
+            raw = fobj.read(vol_bytes * count)
+            if len(raw) != vol_bytes * count:
+                raise IOError("{} is truncated".format(image.get_filename()))
+            data = np.frombuffer(raw, dtype=dtype).reshape(
+                    vol_shape + (count,), order='F').astype(np.float64)
+            if slope is not None and slope != 1:
+                data *= slope
+            if inter:
+                data += inter
+            yield start, data
+
+
+def _trend_basis(n_vols, order=DETREND_ORDER):
+    """
+    Returns an (n_vols, order + 1) matrix with orthonormal columns spanning
+    polynomials of up to 'order' over time.
+    """
+    order = min(order, n_vols - 1)
+    time = np.linspace(-1, 1, n_vols)
+    basis = np.polynomial.legendre.legvander(time, order)
+    q, _ = np.linalg.qr(basis)
+    return q
+
+
+def _clamp(sum_sq, sum_y2):
+    """
+    Zeroes sums of squares that are only rounding error, so constant voxels
+    get a variance of 0 instead of a tiny (or negative) one.
+    """
+    sum_sq[sum_sq <= 1e-10 * sum_y2] = 0
+    return sum_sq
+
+
+def _divide(numerator, denominator):
+    result = np.zeros(numerator.shape)
+    valid = denominator > 0
+    result[valid] = numerator[valid] / denominator[valid]
+    return result
+
+
+def compute_metrics(nifti, chunk_size=CHUNK_SIZE):
+    """
+    Computes the fMRI QC maps and summary metrics in one pass over an image.
+
+    Returns a tuple of (maps, stats) where maps is a dictionary of 3D arrays
+    ('mean', 'std', 'tsnr', 'sfnr', 'corr'), and stats an OrderedDict of
+    summary values.
+    """
+    image = nib.load(nifti)
+    shape = image.shape
+    n_vols = shape[3] if len(shape) > 3 else 1
+    basis = _trend_basis(n_vols)
+
+    mask = None
+    n_vox = int(np.prod(shape[:3]))
+    sum_y = np.zeros(n_vox)
+    sum_y2 = np.zeros(n_vox)
+    sum_yg = np.zeros(n_vox)
+    # Projection of each voxel's time series onto the trend basis
+    trend = np.zeros((basis.shape[1], n_vox))
+    global_signal = np.zeros(n_vols)
+
+    for start, chunk in iter_chunks(image, chunk_size):
+        count = chunk.shape[-1]
+        data = chunk.reshape(n_vox, count)
+        if mask is None:
+            first = data[:, 0]
+            mask = first > MASK_THRESHOLD * np.percentile(first, 98)
+            if not mask.any():
+                mask = np.ones(n_vox, dtype=bool)
+        signal = data[mask].mean(axis=0)
+        global_signal[start:start + count] = signal
+
+        sum_y += data.sum(axis=1)
+        sum_y2 += np.einsum('ij,ij->i', data, data)
+        sum_yg += data.dot(signal)
+        trend += basis[start:start + count].T.dot(data.T)
+
+    mean = sum_y / n_vols
+    sum_sq = _clamp(sum_y2 - n_vols * mean ** 2, sum_y2)
+    std = np.sqrt(sum_sq / max(n_vols - 1, 1))
+    residual = _clamp(sum_y2 - (trend ** 2).sum(axis=0), sum_y2)
+    residual_std = np.sqrt(residual / max(n_vols - basis.shape[1], 1))
+
+    g_mean = global_signal.mean()
+    g_sum_sq = ((global_signal - g_mean) ** 2).sum()
+    covariance = sum_yg - n_vols * mean * g_mean
+    corr = _divide(covariance, np.sqrt(sum_sq * g_sum_sq))
+
+    maps = {'mean': mean,
+            'std': std,
+            'tsnr': _divide(mean, std),
+            'sfnr': _divide(mean, residual_std),
+            'corr': corr}
+
+    stats = OrderedDict()
+    stats['scan_length'] = n_vols
+    stats['mean_signal'] = mean[mask].mean()
+    stats['mean_tsnr'] = maps['tsnr'][mask].mean()
+    stats['mean_sfnr'] = maps['sfnr'][mask].mean()
+    stats['mean_corr'] = corr[mask].mean()
+    stats['global_signal_mean'] = g_mean
+    stats['global_signal_std'] = global_signal.std()
+    stats['global_signal_max_change'] = np.abs(np.diff(global_signal)).max() \
+            if n_vols > 1 else 0
+
+    for name in maps:
+        maps[name] = maps[name].reshape(shape[:3])
+    return maps, stats
+
+
+def write_map(data, template, output):
+    """
+    Writes a 3D map in the space of the template image.
+    """
+    header = template.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.Nifti1Image(data.astype(np.float32), template.affine,
+            header).to_filename(output)
+
+
+def write_stats(stats, output):
+    with open(output, 'w') as fh:
+        fh.write('metric,value\n')
+        for name, value in stats.items():
+            fh.write('{},{}\n'.format(name, value))
+
+
+def run_qc(nifti, output_prefix, chunk_size=CHUNK_SIZE):
+    """
+    Writes the fMRI QC maps and stats for an image to files starting with
+    output_prefix.
+    """
+    logger.debug("Computing fMRI QC metrics for {}".format(nifti))
+    maps, stats = compute_metrics(nifti, chunk_size=chunk_size)
+    template = nib.load(nifti)
+    for name in ['sfnr', 'corr', 'tsnr']:
+        write_map(maps[name], template,
+                '{}_{}.nii.gz'.format(output_prefix, name))
+    write_stats(stats, output_prefix + '_stats.csv')
+    return stats
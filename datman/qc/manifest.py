@@ -0,0 +1,211 @@
+"""
+Keeps track of which inputs a subject's QC outputs were made from, so a QC
+page can be brought up to date by redoing only the series that changed.
+
+The manifest is a JSON file in the subject's QC folder. It holds:
+
+    inputs      The size and modification time of every nifti in the
+                subject's nii folder when the page was last generated. If
+                these still match the folder the page is up to date.
+    series      For each nifti that was QC'd, its size, modification time and
+                SHA-1, the QC outputs made from it and the html it added to
+                the QC page (its 'fragment').
+
+A series is only redone if its nifti's contents changed, so touching a file
+(or copying it with a new mtime) costs a hash but no QC commands.
+
+    manifest = QCManifest(qc_dir)
+    if not manifest.inputs_changed(nifti_paths):
+        return
+    fragment = manifest.get_fragment(nifti)
+    if fragment is None:
+        manifest.invalidate(nifti)
+        ... run the QC for nifti and build its fragment ...
+        manifest.update(nifti, fragment)
+    manifest.set_inputs(nifti_paths)
+    manifest.save()
+"""
+import os
+import json
+import glob
+import hashlib
+import logging
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'qc-manifest.json'
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    """
+    Returns the SHA-1 hex digest of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_stat(path):
+    """
+    Returns the [size, mtime] recorded for a file, or None if it's missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+class QCManifest(object):
+    """
+    The QC manifest for one subject's QC folder.
+    """
+
+    def __init__(self, qc_dir):
+        self.qc_dir = qc_dir
+        self.path = os.path.join(qc_dir, MANIFEST_NAME)
+        contents = self._read()
+        self.inputs = contents.get('inputs')
+        self.series = contents.get('series', {})
+
+    def exists(self):
+        """
+        True if a manifest was read (i.e. the page was made with one).
+        """
+        return self.inputs is not None
+
+    def inputs_changed(self, nifti_paths):
+        """
+        True if the niftis differ from those the page was last generated from
+        (files added, removed or modified). Only stats the files.
+        """
+        if self.inputs is None:
+            return True
+        current = {os.path.basename(path): get_stat(path)
+                for path in nifti_paths}
+        return current != self.inputs
+
+    def set_inputs(self, nifti_paths):
+        """
+        Records the niftis the page was generated from.
+        """
+        self.inputs = {os.path.basename(path): get_stat(path)
+                for path in nifti_paths}
+
+    def is_current(self, nifti):
+        """
+        True if the QC recorded for this nifti was made from its current
+        contents and all of its outputs still exist.
+        """
+        entry = self.series.get(os.path.basename(nifti))
+        if not entry:
+            return False
+        if not all(os.path.exists(os.path.join(self.qc_dir, output))
+                for output in entry['outputs']):
+            return False
+        return self._input_matches(nifti, entry)
+
+    def get_fragment(self, nifti):
+        """
+        Returns the html recorded for this nifti, or None if its QC must be
+        redone.
+        """
+        if not self.is_current(nifti):
+            return None
+        return self.series[os.path.basename(nifti)]['fragment']
+
+    def invalidate(self, nifti):
+        """
+        Forgets a nifti's QC, deleting the outputs made from its old contents
+        so they get regenerated. Outputs are kept if the nifti is unchanged.
+        Returns the deleted outputs.
+        """
+        entry = self.series.pop(os.path.basename(nifti), None)
+        if not entry or self._input_matches(nifti, entry):
+            return []
+        removed = []
+        for output in entry['outputs']:
+            try:
+                os.remove(os.path.join(self.qc_dir, output))
+            except OSError:
+                continue
+            removed.append(output)
+        if removed:
+            logger.info("{} changed, removed {} old QC outputs".format(
+                    nifti, len(removed)))
+        return removed
+
+    def find_outputs(self, nifti):
+        """
+        Returns the names of the files in the QC folder made from this nifti.
+        All QC outputs are named <nifti basename>.<ext> or
+        <nifti basename>_<suffix>.
+        """
+        base_name = datman.utils.nifti_basename(nifti)
+        found = glob.glob(os.path.join(self.qc_dir, base_name + '.*')) + \
+                glob.glob(os.path.join(self.qc_dir, base_name + '_*'))
+        return sorted(os.path.basename(path) for path in found)
+
+    def update(self, nifti, fragment, outputs=None):
+        """
+        Records the QC made from a nifti's current contents.
+        """
+        size, mtime = get_stat(nifti)
+        if outputs is None:
+            outputs = self.find_outputs(nifti)
+        self.series[os.path.basename(nifti)] = {
+                'size': size,
+                'mtime': mtime,
+                'sha1': hash_file(nifti),
+                'outputs': outputs,
+                'fragment': fragment}
+
+    def prune(self, nifti_paths):
+        """
+        Drops entries for niftis that are no longer present.
+        """
+        keep = set(os.path.basename(path) for path in nifti_paths)
+        for name in list(self.series):
+            if name not in keep:
+                del self.series[name]
+
+    def save(self):
+        contents = {'version': MANIFEST_VERSION,
+                    'inputs': self.inputs,
+                    'series': self.series}
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as fh:
+            json.dump(contents, fh, indent=1, sort_keys=True)
+        os.rename(temp, self.path)
+
+    def _input_matches(self, nifti, entry):
+        stat = get_stat(nifti)
+        if stat is None or stat[0] != entry['size']:
+            return False
+        if stat[1] == entry['mtime']:
+            return True
+        # Modified time changed, but the contents may not have
+        if hash_file(nifti) != entry['sha1']:
+            return False
+        entry['mtime'] = stat[1]
+        return True
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as fh:
+                contents = json.load(fh)
+        except IOError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring unreadable QC manifest {}".format(
+                    self.path))
+            return {}
+        if contents.get('version') != MANIFEST_VERSION:
+            return {}
+        return contents
@@ -0,0 +1,166 @@
+"""
+Renders montage PNGs of NIfTI images for the QC pages.
+
+These replace FSL's 'slicer' and 'pngappend'. Each image is loaded once (with
+a memory map when it's uncompressed), only the slices needed are extracted,
+and the montage is built in memory and written as a single PNG.
+
+    import datman.qc.montage as montage
+
+    # Every second axial slice, 600 pixels wide (slicer -S 2 600)
+    montage.axial_montage('sub.nii.gz', 'sub_raw.png', gap=2, width=600)
+
+    # Slices at 40%, 50% and 60% through each axis (slicesdir)
+    montage.orthogonal_montage('sub.nii.gz', 'sub_montage.png')
+
+Volumes are displayed in RAS orientation (anterior / superior at the top,
+left on the left) with square pixels. 4D images are represented by their
+first volume. Intensities are scaled between the 2nd and 98th percentile of
+non-zero voxels.
+"""
+import logging
+
+import numpy as np
+import nibabel as nib
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Positions (as a fraction of each axis) shown by orthogonal_montage()
+ORTHOGONAL_POSITIONS = (0.4, 0.5, 0.6)
+
+# Percentiles of non-zero voxel intensity mapped to black and white
+INTENSITY_RANGE = (2, 98)
+
+
+def load_volume(image):
+    """
+    Returns the first 3D volume of a NIfTI (a path or nibabel image) as a
+    float array in RAS orientation, along with its voxel sizes.
+    """
+    if not hasattr(image, 'dataobj'):
+        image = nib.load(image, mmap=True)
+
+    if len(image.shape) > 3:
+        # Slicing the proxy avoids reading the rest of the time series
+        data = image.dataobj[..., 0]
+        while data.ndim > 3:
+            data = data[..., 0]
+    else:
+        data = image.dataobj[...]
+    data = np.asarray(data, dtype=np.float32)
+
+    ornt = nib.orientations.io_orientation(image.affine)
+    data = nib.orientations.apply_orientation(data, ornt)
+    zooms = np.array(image.header.get_zooms()[:3], dtype=float)
+    zooms = zooms[ornt[:, 0].astype(int)]
+    return data, zooms
+
+
+def scale_intensity(data, limits=INTENSITY_RANGE):
+    """
+    Maps a volume's intensities to 8 bit greyscale using a robust range.
+    """
+    nonzero = data[data != 0]
+    if not nonzero.size:
+        return np.zeros(data.shape, dtype=np.uint8)
+    low, high = np.percentile(nonzero, limits)
+    if high <= low:
+        high = low + 1
+    scaled = (data - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def get_slice(volume, zooms, axis, index):
+    """
+    Extracts a 2D slice along 'axis' (0=x, 1=y, 2=z) of a RAS volume,
+    oriented for display and resampled to square pixels.
+    """
+    plane = np.take(volume, index, axis=axis)
+    plane_zooms = [zoom for num, zoom in enumerate(zooms) if num != axis]
+    # Rows run top to bottom, so the second in-plane axis is flipped
+    plane = np.flipud(plane.T)
+    return _make_square(plane, plane_zooms[1], plane_zooms[0])
+
+
+def _make_square(plane, row_size, col_size):
+    smallest = min(row_size, col_size)
+    if row_size == col_size or smallest <= 0:
+        return plane
+    rows = int(round(plane.shape[0] * row_size / smallest))
+    cols = int(round(plane.shape[1] * col_size / smallest))
+    row_idx = (np.arange(rows) * plane.shape[0] // rows)
+    col_idx = (np.arange(cols) * plane.shape[1] // cols)
+    return plane[row_idx[:, np.newaxis], col_idx]
+
+
+def tile(slices, columns):
+    """
+    Arranges equally sized 2D slices into rows of 'columns' tiles.
+    """
+    rows = int(np.ceil(len(slices) / float(columns)))
+    height, width = slices[0].shape
+    grid = np.zeros((rows * height, columns * width), dtype=slices[0].dtype)
+    for num, plane in enumerate(slices):
+        row, col = divmod(num, columns)
+        grid[row * height:(row + 1) * height,
+                col * width:(col + 1) * width] = plane
+    return grid
+
+
+def append(images):
+    """
+    Joins 2D images side by side, centering any that are shorter than the
+    tallest (like 'pngappend' with '+').
+    """
+    height = max(img.shape[0] for img in images)
+    padded = []
+    for img in images:
+        top = (height - img.shape[0]) // 2
+        padded.append(np.pad(img, ((top, height - img.shape[0] - top),
+                (0, 0)), mode='constant'))
+    return np.hstack(padded)
+
+
+def write_png(pixels, output, width=None):
+    """
+    Writes an 8 bit greyscale array as a PNG, optionally resized to 'width'
+    pixels wide.
+    """
+    picture = Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8))
+    if width and picture.size[0] != width:
+        height = max(1, int(round(picture.size[1] * width /
+                float(picture.size[0]))))
+        picture = picture.resize((width, height), Image.BILINEAR)
+    picture.save(output, format='PNG')
+
+
+def axial_montage(image, output, gap=2, width=600):
+    """
+    Writes every 'gap'th axial slice of an image to a single PNG 'width'
+    pixels wide. Equivalent to 'slicer <image> -S <gap> <width> <output>'.
+    """
+    volume, zooms = load_volume(image)
+    volume = scale_intensity(volume)
+    slices = [get_slice(volume, zooms, 2, index)
+            for index in range(0, volume.shape[2], max(1, int(gap)))]
+    tile_width = slices[0].shape[1]
+    columns = max(1, min(len(slices), width // max(1, tile_width)))
+    write_png(tile(slices, columns), output, width=width)
+
+
+def orthogonal_montage(image, output, positions=ORTHOGONAL_POSITIONS):
+    """
+    Writes sagittal, coronal and axial slices taken at each of 'positions'
+    (fractions of the axis length) side by side in one PNG, matching the
+    output of FSL's slicesdir.
+    """
+    volume, zooms = load_volume(image)
+    volume = scale_intensity(volume)
+    slices = []
+    for axis in range(3):
+        for position in positions:
+            index = min(volume.shape[axis] - 1,
+                    int(position * volume.shape[axis]))
+            slices.append(get_slice(volume, zooms, axis, index))
+    write_png(append(slices), output)
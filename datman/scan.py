@@ -3,9 +3,10 @@ A class to make access to all information about a single scan easy
 and uniform.
 
 
-    WARNING: This class currently assumes the contents of the directories
-    does not change after the object is created. Certain attribute values may
-    become out of date if this is not true.
+    WARNING: The contents of nii_path and dcm_path are read the first time
+    niftis, dicoms, nii_tags, dcm_tags or get_tagged_* are used and are not
+    re-read afterwards. Call refresh() if the directories may have changed
+    since then.
 
 
     Both Scan and Series inherit from DatmanNamed and have the following
@@ -56,13 +57,36 @@ and uniform.
         get_tagged_dcm(tag)     Returns a list of 'Series' instances for each
                                 dicom in dcm_path with the given tag. If none
                                 are found returns an empty list.
+
+        refresh()               Forgets the series found so far, so that the
+                                next access re-reads nii_path and dcm_path.
 """
 import os
-import glob
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2 without the scandir backport
+    scandir = None
 
 import datman.utils
 import datman.scanid as scanid
 
+def list_files(path):
+    """
+    Returns the full path to every non-hidden entry in <path> using a single
+    directory read. An empty list is returned if <path> doesn't exist.
+    """
+    try:
+        if scandir is None:
+            names = os.listdir(path)
+            return [os.path.join(path, name) for name in names
+                    if not name.startswith('.')]
+        return [entry.path for entry in scandir(path)
+                if not entry.name.startswith('.')]
+    except OSError:
+        return []
+
 class DatmanNamed(object):
     """
     A parent class for all classes that will obey the datman naming scheme
@@ -144,36 +168,89 @@ class Scan(DatmanNamed):
 
         DatmanNamed.__init__(self, ident)
 
-        self.nii_path = self.__get_path('nii', config)
-        self.dcm_path = self.__get_path('dcm', config)
-        self.nrrd_path = self.__get_path('nrrd', config)
-        self.mnc_path = self.__get_path('mnc', config)
-        self.qc_path = self.__get_path('qc', config)
-        self.resource_path = self.__get_path('resources', config, session=True)
+        self.__config = config
+        self.__paths = {}
+        self.refresh()
+
+    @property
+    def nii_path(self):
+        return self.__get_path('nii')
+
+    @property
+    def dcm_path(self):
+        return self.__get_path('dcm')
+
+    @property
+    def nrrd_path(self):
+        return self.__get_path('nrrd')
+
+    @property
+    def mnc_path(self):
+        return self.__get_path('mnc')
+
+    @property
+    def qc_path(self):
+        return self.__get_path('qc')
 
-        self.niftis = self.__get_series(self.nii_path, ['.nii', '.nii.gz'])
-        self.dicoms = self.__get_series(self.dcm_path, ['.dcm'])
+    @property
+    def resource_path(self):
+        return self.__get_path('resources', session=True)
 
-        self.__nii_dict = self.__make_dict(self.niftis)
-        self.__dcm_dict = self.__make_dict(self.dicoms)
+    @property
+    def niftis(self):
+        if self.__niftis is None:
+            self.__niftis = self.__get_series(self.nii_path,
+                    ['.nii', '.nii.gz'])
+        return self.__niftis
 
-        self.nii_tags = self.__nii_dict.keys()
-        self.dcm_tags = self.__dcm_dict.keys()
+    @property
+    def dicoms(self):
+        if self.__dicoms is None:
+            self.__dicoms = self.__get_series(self.dcm_path, ['.dcm'])
+        return self.__dicoms
+
+    @property
+    def nii_tags(self):
+        return list(self.__get_nii_dict().keys())
+
+    @property
+    def dcm_tags(self):
+        return list(self.__get_dcm_dict().keys())
 
     def get_tagged_nii(self, tag):
         try:
-            matched_niftis = self.__nii_dict[tag]
+            matched_niftis = self.__get_nii_dict()[tag]
         except KeyError:
             matched_niftis = []
         return matched_niftis
 
     def get_tagged_dcm(self, tag):
         try:
-            matched_dicoms = self.__dcm_dict[tag]
+            matched_dicoms = self.__get_dcm_dict()[tag]
         except KeyError:
             matched_dicoms = []
         return matched_dicoms
 
+    def refresh(self):
+        """
+        Discards the niftis and dicoms found so far. They will be re-read from
+        disk the next time they're needed.
+        """
+        self.__niftis = None
+        self.__dicoms = None
+        self.__nii_dict = None
+        self.__dcm_dict = None
+
+    def __get_nii_dict(self):
+        if self.__nii_dict is None:
+            self.__nii_dict = self.__make_dict(self.niftis)
+        return self.__nii_dict
+
+    def __get_dcm_dict(self):
+        if self.__dcm_dict is None:
+            self.__dcm_dict = self.__make_dict(self.dicoms)
+        return self.__dcm_dict
+
     def __check_session(self, id_str):
         """
         Adds a default session number of "_01" if it's missing and the id
@@ -185,11 +262,16 @@ class Scan(DatmanNamed):
             id_str = id_str + "_01"
         return id_str
 
-    def __get_path(self, key, config, session=False):
+    def __get_path(self, key, session=False):
+        try:
+            return self.__paths[key]
+        except KeyError:
+            pass
         folder_name = self.full_id
         if session:
             folder_name = self.id_plus_session
-        path = os.path.join(config.get_path(key), folder_name)
+        path = os.path.join(self.__config.get_path(key), folder_name)
+        self.__paths[key] = path
         return path
 
     def __get_series(self, path, ext_list):
@@ -197,10 +279,9 @@ class Scan(DatmanNamed):
         This method will generate a ParseException if any files are not named
         according to the datman naming convention.
         """
-        glob_path = os.path.join(path, "*")
         series_list = []
         badly_named = []
-        for item in glob.glob(glob_path):
+        for item in list_files(path):
             if datman.utils.get_extension(item) in ext_list:
                 try:
                     series = Series(item)
@@ -3,6 +3,32 @@ Represents scan identifiers that conform to the TIGRLab naming scheme
 """
 import os.path
 import re
+import sys
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # python 2 has no lru_cache. The parse functions take a single string,
+    # so a dict that's emptied when full does the same job
+    def lru_cache(maxsize=None):
+        def decorator(func):
+            cache = {}
+
+            def wrapper(arg):
+                try:
+                    return cache[arg]
+                except KeyError:
+                    pass
+                if maxsize is not None and len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[arg] = func(arg)
+                return result
+
+            wrapper.__wrapped__ = func
+            wrapper.__doc__ = func.__doc__
+            wrapper.cache_clear = cache.clear
+            return wrapper
+        return decorator
 
 SCANID_RE = '(?P<study>[^_]+)_' \
             '(?P<site>[^_]+)_' \
@@ -44,95 +70,217 @@ SCANID_PHA_PATTERN   = re.compile('^'+SCANID_PHA_RE+'$')
 FILENAME_PATTERN     = re.compile('^'+FILENAME_RE)
 FILENAME_PHA_PATTERN = re.compile('^'+FILENAME_PHA_RE)
 
+# Single pass equivalents of the patterns above. The alternatives are tried in
+# the same order the individual patterns used to be tried in, so results are
+# identical. Group names can't repeat in a pattern, so each alternative
+# gets its own prefix and they're collapsed back into one set of fields after
+# matching.
+_FIELD = '[^_]+'
+_SUBJECT_RE = '(?:(?P<std_subject>{0})_(?P<std_timepoint>{0})_' \
+              '(?P<std_session>{0})|' \
+              '(?P<pha_subject>PHA_{0})|' \
+              '(?P<nosess_subject>{0})_(?P<nosess_timepoint>{0}))'.format(
+                    _FIELD)
+_FILENAME_SUBJECT_RE = '(?:(?P<pha_subject>PHA_{0})|' \
+                       '(?P<std_subject>{0})_(?P<std_timepoint>{0})_' \
+                       '(?P<std_session>{0}))'.format(_FIELD)
+
+COMBINED_SCANID_PATTERN = re.compile(
+        '^(?P<study>[^_]+)_(?P<site>[^_]+)_' + _SUBJECT_RE + '$')
+COMBINED_FILENAME_PATTERN = re.compile(
+        '^(?P<study>[^_]+)_(?P<site>[^_]+)_' + _FILENAME_SUBJECT_RE + '_' +
+        r'(?P<tag>[^_]+)_' +
+        r'(?P<series>\d+)_' +
+        r'(?P<description>.*?)' +
+        r'(?P<ext>.nii.gz|.nii|.json|.bvec|.bval|.tar.gz|.tar|.dcm|.IMA|.mnc|.nrrd|$)')
+
+# Number of distinct names remembered by parse() and parse_filename()
+PARSE_CACHE_SIZE = 2 ** 16
+
 #python 2 - 3 compatibility hack
 try:
     basestring
 except NameError:
     basestring = str
 
+try:
+    intern = sys.intern
+except AttributeError:
+    # python 2, intern is a builtin
+    pass
+
+def _intern(value):
+    try:
+        return intern(value)
+    except TypeError:
+        # python 2 can't intern unicode strings
+        return value
+
 class ParseException(Exception):
     pass
 
-class Identifier:
+class Identifier(object):
+    """
+    An immutable datman subject ID.
+
+    Fields are interned and the string forms are built once, when the
+    instance is created, so identifiers are cheap to keep in large indexes.
+    Two identifiers are equal (and hash the same) if they name the same
+    session, so they can be used directly as dictionary keys or set members.
+    """
+    __slots__ = ('study', 'site', 'subject', 'timepoint', 'session',
+                 '_session', '_full_id', '_id_with_timepoint', '_id_with_session',
+                 '_hash')
+
     def __init__(self, study, site, subject, timepoint, session):
-        self.study = study
-        self.site = site
-        self.subject = subject
-        self.timepoint = timepoint
         # Bug fix: spaces were being left after the session number leading to broken file names
-        self._session = session.strip()
-
-    @property
-    def session(self):
-        if self._session == 'XX':
-            return ''
-        return self._session
+        raw_session = _intern(session.strip())
+        session = '' if raw_session == 'XX' else raw_session
+
+        full_id = "_".join([study, site, subject])
+        with_timepoint = full_id + "_" + timepoint if timepoint else full_id
+        with_session = with_timepoint + "_" + session if session else \
+                with_timepoint
+
+        set_field = object.__setattr__
+        set_field(self, 'study', _intern(study))
+        set_field(self, 'site', _intern(site))
+        set_field(self, 'subject', _intern(subject))
+        set_field(self, 'timepoint', _intern(timepoint))
+        set_field(self, 'session', session)
+        set_field(self, '_session', raw_session)
+        set_field(self, '_full_id', full_id)
+        set_field(self, '_id_with_timepoint', with_timepoint)
+        set_field(self, '_id_with_session', with_session)
+        set_field(self, '_hash', hash(with_session))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("datman.scanid.Identifier is immutable. Create "
+                "a new instance instead of setting '{}'".format(name))
+
+    def __delattr__(self, name):
+        raise AttributeError("datman.scanid.Identifier is immutable")
+
+    def __reduce__(self):
+        return (Identifier, (self.study, self.site, self.subject,
+                self.timepoint, self._session))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._id_with_session == other._id_with_session
 
-    @session.setter
-    def session(self, value):
-        self._x = value
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
+    def __hash__(self):
+        return self._hash
 
     def get_full_subjectid(self):
-        return "_".join([self.study, self.site, self.subject])
+        return self._full_id
 
     def get_bids_name(self):
 
         return 'sub-' + self.site + self.subject
 
     def get_full_subjectid_with_timepoint(self):
-        ident = self.get_full_subjectid()
-        if self.timepoint:
-            ident += "_" + self.timepoint
-        return ident
+        return self._id_with_timepoint
 
     def get_full_subjectid_with_timepoint_session(self):
-        ident = self.get_full_subjectid_with_timepoint()
-        if self.session:
-            ident += "_" + self.session
-        return ident
+        return self._id_with_session
 
     def __str__(self):
-        if self.session:
-            return self.get_full_subjectid_with_timepoint_session()
-        else:
-            return self.get_full_subjectid_with_timepoint()
+        return self._id_with_session
+
+    def __repr__(self):
+        return "<datman.scanid.Identifier: {}>".format(self._id_with_session)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _match_scanid(identifier):
+    """
+    Returns the Identifier for a subject ID or None if it doesn't match the
+    naming convention. Identifiers are immutable, so cached instances are
+    shared between callers.
+    """
+    match = COMBINED_SCANID_PATTERN.match(identifier)
+    if not match:
+        return None
+    (study, site, subject, timepoint, session, pha_subject, nosess_subject,
+            nosess_timepoint) = match.groups()
+    if subject is not None:
+        return Identifier(study, site, subject, timepoint, session)
+    if pha_subject is not None:
+        return Identifier(study, site, pha_subject, '', '')
+    # work around for matching scanid's when session not supplied
+    return Identifier(study, site, nosess_subject, nosess_timepoint, 'XX')
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _match_filename(fname):
+    """
+    Returns an (Identifier, tag, series, description) tuple for a file name
+    or None if it doesn't match the naming convention.
+    """
+    match = COMBINED_FILENAME_PATTERN.match(fname)
+    if not match:
+        return None
+    (study, site, pha_subject, subject, timepoint, session, tag, series,
+            description, _) = match.groups()
+    if pha_subject is not None:
+        ident = Identifier(study, site, pha_subject, '', '')
+    else:
+        ident = Identifier(study, site, subject, timepoint, session)
+    return ident, tag, series, description
 
 
 def parse(identifier):
     if not isinstance(identifier, basestring):
         raise ParseException
 
-    match = SCANID_PATTERN.match(identifier)
-    if not match: match = SCANID_PHA_PATTERN.match(identifier)
-    # work around for matching scanid's when session not supplied
-    if not match: match = SCANID_PATTERN.match(identifier + '_XX')
-    if not match: raise ParseException("Invalid ID {}".format(identifier))
-
-    ident = Identifier(study    = match.group("study"),
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
+    ident = _match_scanid(identifier)
+    if not ident: raise ParseException("Invalid ID {}".format(identifier))
 
     return ident
 
 def parse_filename(path):
-    fname = os.path.basename(path)
-    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
-    if not match: match = FILENAME_PATTERN.match(fname)
-    if not match: raise ParseException()
-
-    ident = Identifier(study    = match.group("study"),
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
-
-    tag = match.group("tag")
-    series = match.group("series")
-    description = match.group("description")
-    return ident, tag, series, description
+    parsed = _match_filename(os.path.basename(path))
+    if not parsed: raise ParseException()
+
+    return parsed
+
+def parse_filenames(paths):
+    """
+    Parses a list of datman style file names in one call.
+
+    Returns a dictionary of columns. 'ident', 'tag', 'series' and
+    'description' each hold one entry per item in <paths> (in the same order)
+    and 'errors' maps the index of every name that could not be parsed to its
+    ParseException. Failed entries are None in every other column.
+    """
+    paths = list(paths)
+    basename = os.path.basename
+    matched = [_match_filename(basename(path)) for path in paths]
+
+    errors = {}
+    for index, parsed in enumerate(matched):
+        if not parsed:
+            errors[index] = ParseException("{} does not match datman "
+                    "convention".format(paths[index]))
+            matched[index] = (None, None, None, None)
+
+    idents, tags, series, descriptions = zip(*matched) if matched else \
+            ((), (), (), ())
+    return {'ident': list(idents),
+            'tag': list(tags),
+            'series': list(series),
+            'description': list(descriptions),
+            'errors': errors}
 
 def make_filename(ident, tag, series, description, ext=None):
     filename = "_".join([str(ident), tag, series, description])
@@ -5,17 +5,18 @@ import os
 import sys
 import re
 import io
+import errno
 import glob
 import zipfile
 import tarfile
 import logging
-import random
-import time
 import tempfile
 import shutil
+import fcntl
 import contextlib
 import subprocess as proc
 
+import nibabel as nib
 import pydicom as dcm
 import pyxnat
 
@@ -91,9 +92,7 @@ def read_checklist(study=None, subject=None, config=None, path=None):
         subject = ident.get_full_subjectid_with_timepoint()
 
     try:
-        with open(checklist_path, 'r') as checklist:
-            entries = _parse_checklist(checklist,
-                    subject=subject)
+        entries = _read_checklist_file(checklist_path, subject=subject)
     except Exception as e:
         raise MetadataException("Failed to read checklist file "
                 "{}. Reason - {}".format(checklist_path, str(e)))
@@ -162,7 +161,7 @@ def _parse_checklist(checklist, subject=None):
     else:
         entries = {}
 
-    for line in checklist.readlines():
+    for line in checklist:
         fields = line.split()
         if not fields:
             # Ignore blank lines
@@ -203,7 +202,10 @@ def update_checklist(entries, study=None, config=None, path=None):
 
     <entries> should be a dictionary with subject IDs (minus session/repeat) as
     the keys and qc entries as the value (with an empty string for new/blank
-    QC entries)
+    QC entries). An empty string never replaces an existing comment.
+
+    File system updates are appended to the checklist's journal (see
+    _append_metadata()) so concurrent updates don't overwrite each other.
 
     This will raise a MetadataException if any part of the update fails for
     any entry.
@@ -220,23 +222,19 @@ def update_checklist(entries, study=None, config=None, path=None):
     # No dashboard, or path was given, so update file system.
     checklist_path = locate_metadata('checklist.csv', study=study,
             config=config, path=path)
-    old_entries = read_checklist(path=checklist_path)
 
-    # Merge with existing list
+    lines = []
     for subject in entries:
         try:
             ident = datman.scanid.parse(subject)
         except:
             raise MetadataException("Attempt to add invalid subject ID {} to "
                     "QC checklist".format(subject))
-        subject = ident.get_full_subjectid_with_timepoint()
-        old_entries[subject] = entries[subject]
-
-    # Reformat to expected checklist line format
-    lines = ["qc_{}.html {}\n".format(sub, old_entries[sub])
-            for sub in old_entries]
+        lines.append(_format_checklist_entry(
+                ident.get_full_subjectid_with_timepoint(), entries[subject]))
 
-    write_metadata(sorted(lines), checklist_path)
+    _append_metadata(lines, checklist_path, _parse_checklist,
+            _format_checklist)
 
 
 def _update_qc_reviewers(entries):
@@ -313,8 +311,8 @@ def read_blacklist(study=None, scan=None, subject=None, config=None, path=None):
     blacklist_path = locate_metadata("blacklist.csv", study=study,
             subject=tmp_sub, config=config, path=path)
     try:
-        with open(blacklist_path, 'r') as blacklist:
-            entries = _parse_blacklist(blacklist, scan=scan, subject=subject)
+        entries = _read_blacklist_file(blacklist_path, scan=scan,
+                subject=subject)
     except Exception as e:
         raise MetadataException("Failed to read checklist file {}. Reason - "
                 "{}".format(blacklist_path, str(e)))
@@ -420,8 +418,8 @@ def update_blacklist(entries, study=None, config=None, path=None):
 
     blacklist_path = locate_metadata('blacklist.csv', study=study,
             config=config, path=path)
-    old_entries = read_blacklist(path=blacklist_path)
 
+    lines = []
     for scan_name in entries:
         try:
             datman.scanid.parse_filename(scan_name)
@@ -432,12 +430,10 @@ def update_blacklist(entries, study=None, config=None, path=None):
             logger.error("Can't add blacklist entry with empty comment. "
                     "Skipping {}".format(scan_name))
             continue
-        old_entries[scan_name] = entries[scan_name]
+        lines.append(_format_blacklist_entry(scan_name, entries[scan_name]))
 
-    lines = ["{} {}\n".format(sub, old_entries[sub]) for sub in old_entries]
-    new_list = ['series\treason\n']
-    new_list.extend(sorted(lines))
-    write_metadata(new_list, blacklist_path)
+    _append_metadata(lines, blacklist_path, _parse_blacklist,
+            _format_blacklist)
 
 
 def _update_scan_checklist(entries):
@@ -451,33 +447,28 @@ def _update_scan_checklist(entries):
                 "a default dashboard user defined. Please add "
                 "'DEFAULT_DASH_USER' to your config file.")
 
-    for scan_name in entries:
-        scan = dashboard.get_scan(scan_name)
-        if not scan:
-            raise MetadataException("{} does not exist in the dashboard "
-                    "database".format(scan_name))
-        scan.add_checklist_entry(user.id, comment=entries[scan_name],
-                sign_off=False)
+    try:
+        dashboard.add_checklist_entries(entries, user=user, sign_off=False)
+    except dashboard.DashboardException as e:
+        raise MetadataException("Failed to update dashboard blacklist. "
+                "Reason - {}".format(e))
 
 
-def write_metadata(lines, path, retry=3):
+def write_metadata(lines, path):
     """
-    Repeatedly attempts to write lines to <path>. The destination file
-    will be overwritten with <lines> so any contents you wish to preserve
-    should be contained within the list.
-    """
-    if not retry:
-        raise MetadataException("Failed to update {}".format(path))
+    Overwrites the metadata file at <path> with <lines>, so any contents you
+    wish to preserve should be contained within the list. Any journaled
+    updates that haven't been compacted into the file yet are discarded.
 
+    The journal lock is held while writing, so readers never see a partially
+    written file.
+    """
     try:
-        with open(path, "w") as meta_file:
-            meta_file.writelines(lines)
-    except:
-        logger.error("Failed to write metadata file {}. Tries "
-                "remaining - {}".format(path, retry))
-        wait_time = random.uniform(0, 10)
-        time.sleep(wait_time)
-        write_metadata(lines, path, retry=retry-1)
+        with _locked_journal(path, exclusive=True) as journal:
+            _replace_metadata(lines, path, journal)
+    except (IOError, OSError) as e:
+        raise MetadataException("Failed to update {}. Reason - {}".format(
+                path, e))
 
 
 def get_subject_metadata(config=None, study=None):
@@ -513,6 +504,322 @@ def get_subject_metadata(config=None, study=None):
     return all_qc
 
 
+# Updates to a metadata file are appended to a journal next to it, which
+# is merged back into the file once it grows past this many bytes
+METADATA_JOURNAL_EXT = '.journal'
+METADATA_JOURNAL_SIZE = 64 * 1024
+
+
+@contextlib.contextmanager
+def _locked_journal(path, exclusive=False):
+    """
+    Opens and locks the journal for the metadata file at <path>. Writers
+    hold an exclusive lock while appending to the journal or rewriting the
+    file, readers hold a shared lock while reading both.
+
+    A shared lock yields None if there is no journal to read.
+    """
+    journal_path = path + METADATA_JOURNAL_EXT
+    try:
+        journal = open(journal_path, 'a+' if exclusive else 'r')
+    except (IOError, OSError):
+        if exclusive:
+            raise
+        yield None
+        return
+    try:
+        fcntl.flock(journal, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield journal
+    finally:
+        # Closing the file releases the lock
+        journal.close()
+
+
+def _merge_metadata(path, parser, journal):
+    """
+    Parses the metadata file at <path> and applies any updates from its
+    (already locked) journal. Later journal entries replace earlier ones,
+    except that an empty comment never replaces an existing one.
+    """
+    with open(path, 'r') as metadata:
+        entries = parser(metadata)
+    if journal is None:
+        return entries
+    journal.seek(0)
+    for line in journal:
+        for key, comment in parser([line]).items():
+            if comment or key not in entries:
+                entries[key] = comment
+    return entries
+
+
+def _replace_metadata(lines, path, journal):
+    with open(path, 'w') as metadata:
+        metadata.writelines(lines)
+    journal.truncate(0)
+
+
+def _append_metadata(lines, path, parser, formatter):
+    """
+    Records updates to the metadata file at <path> in its journal and
+    compacts the journal into the file once it gets large. Each call is a
+    single locked append, so concurrent updates are never lost.
+    """
+    if not lines:
+        return
+    if not os.path.exists(path):
+        raise MetadataException("Metadata file {} doesn't exist".format(path))
+    try:
+        with _locked_journal(path, exclusive=True) as journal:
+            journal.writelines(lines)
+            journal.flush()
+            if journal.tell() > METADATA_JOURNAL_SIZE:
+                _replace_metadata(formatter(_merge_metadata(path, parser,
+                        journal)), path, journal)
+    except (IOError, OSError) as e:
+        raise MetadataException("Failed to update {}. Reason - {}".format(
+                path, e))
+
+
+def _compact_metadata(path, parser, formatter):
+    try:
+        with _locked_journal(path, exclusive=True) as journal:
+            journal.seek(0, os.SEEK_END)
+            if not journal.tell():
+                return
+            _replace_metadata(formatter(_merge_metadata(path, parser,
+                    journal)), path, journal)
+    except (IOError, OSError) as e:
+        raise MetadataException("Failed to compact {}. Reason - {}".format(
+                path, e))
+
+
+def compact_checklist(study=None, config=None, path=None):
+    """
+    Merges any journaled updates into the checklist.csv file. This happens
+    automatically as updates are made, but can be forced (e.g. before a tool
+    that reads the file directly is run).
+    """
+    checklist_path = locate_metadata('checklist.csv', study=study,
+            config=config, path=path)
+    _compact_metadata(checklist_path, _parse_checklist, _format_checklist)
+
+
+def compact_blacklist(study=None, config=None, path=None):
+    """
+    Merges any journaled updates into the blacklist.csv file.
+    """
+    blacklist_path = locate_metadata('blacklist.csv', study=study,
+            config=config, path=path)
+    _compact_metadata(blacklist_path, _parse_blacklist, _format_blacklist)
+
+
+def _format_checklist_entry(subject, comment):
+    return "qc_{}.html {}\n".format(subject, comment)
+
+
+def _format_checklist(entries):
+    return sorted(_format_checklist_entry(sub, entries[sub])
+            for sub in entries)
+
+
+def _format_blacklist_entry(scan_name, comment):
+    return "{} {}\n".format(scan_name, comment)
+
+
+def _format_blacklist(entries):
+    lines = ['series\treason\n']
+    lines.extend(sorted(_format_blacklist_entry(scan_name, entries[scan_name])
+            for scan_name in entries))
+    return lines
+
+
+class _MetadataFile(object):
+    """
+    Holds the parsed contents of a metadata file and its journal until
+    either of them changes.
+    """
+
+    def __init__(self, path, parser, index=None):
+        self.path = path
+        self.parser = parser
+        self.index = index
+        self.stamp = None
+        self.contents = None
+
+    def get(self):
+        stamp = (_file_stamp(self.path),
+                _file_stamp(self.path + METADATA_JOURNAL_EXT, missing_ok=True))
+        if stamp != self.stamp:
+            with _locked_journal(self.path) as journal:
+                entries = _merge_metadata(self.path, self.parser, journal)
+            self.contents = self.index(entries) if self.index else entries
+            self.stamp = stamp
+        return self.contents
+
+
+def _file_stamp(path, missing_ok=False):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        if missing_ok:
+            return None
+        raise
+    # Size and inode are checked too in case the mtime resolution is too
+    # coarse to notice a quick rewrite
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+# Maps (metadata file path, parser, index) to its _MetadataFile, so each file
+# is only parsed again after it has been modified
+_metadata_files = {}
+
+
+def _read_metadata_file(path, parser, index=None):
+    key = (os.path.abspath(path), parser, index)
+    try:
+        metadata = _metadata_files[key]
+    except KeyError:
+        metadata = _MetadataFile(path, parser, index)
+        _metadata_files[key] = metadata
+    return metadata.get()
+
+
+def _index_blacklist(entries):
+    """
+    Returns the blacklist entries along with a dictionary of each subject ID
+    (both with and without session) mapped to that subject's entries.
+    """
+    by_subject = {}
+    for scan_name, comment in entries.items():
+        ident = scanid.parse_filename(scan_name)[0]
+        for subid in set([ident.get_full_subjectid_with_timepoint(),
+                ident.get_full_subjectid_with_timepoint_session()]):
+            by_subject.setdefault(subid, {})[scan_name] = comment
+    return entries, by_subject
+
+
+def _read_blacklist_file(path, scan=None, subject=None):
+    """
+    Looks up blacklist.csv contents (including journaled updates) with the same
+    results as _parse_blacklist(), without re-reading the file if it hasn't
+    changed.
+    """
+    entries, by_subject = _read_metadata_file(path, _parse_blacklist,
+            _index_blacklist)
+    if scan:
+        return entries.get(scan)
+    if not subject:
+        return dict(entries)
+    try:
+        subid = scanid.parse(subject).get_full_subjectid_with_timepoint_session()
+    except scanid.ParseException:
+        # Not a full ID (e.g. just study and site) so match on the prefix
+        return {scan_name: entries[scan_name] for scan_name in entries
+                if scan_name.startswith(subject)}
+    return dict(by_subject.get(subid, {}))
+
+
+def _read_checklist_file(path, subject=None):
+    """
+    Looks up checklist.csv contents (including journaled updates) with the same
+    results as _parse_checklist(), without re-reading the file if it hasn't
+    changed.
+    """
+    entries = _read_metadata_file(path, _parse_checklist)
+    if subject:
+        return entries.get(subject)
+    return dict(entries)
+
+
+class QCMetadata(object):
+    """
+    Answers checklist and blacklist queries for a study from the
+    checklist.csv and blacklist.csv files in its metadata folder.
+
+    Each file is parsed once and indexed by scan name and subject ID, so
+    queries don't depend on the size of the file. A file is only read again
+    after its modification time changes. Unlike read_checklist() and
+    read_blacklist() the dashboard database is never consulted.
+
+        metadata = datman.utils.QCMetadata(config=config)
+        for nii in niftis:
+            if metadata.is_blacklisted(nii):
+                continue
+
+    Paths given for either file override the ones in the study's metadata
+    folder. A MetadataException is raised if a file can't be read.
+    """
+
+    def __init__(self, study=None, config=None, checklist_path=None,
+            blacklist_path=None):
+        if not (study or config or (checklist_path and blacklist_path)):
+            raise MetadataException("Can't locate QC metadata without either "
+                    "1) a study ID 2) a datman.config object or 3) full paths "
+                    "to both the checklist and blacklist")
+        self.checklist_path = locate_metadata('checklist.csv', study=study,
+                config=config, path=checklist_path)
+        self.blacklist_path = locate_metadata('blacklist.csv', study=study,
+                config=config, path=blacklist_path)
+
+    def get_blacklist(self, subject=None):
+        """
+        Returns a dictionary of blacklisted scan names mapped to their
+        comments, optionally restricted to a single subject (with or without
+        a session number)
+        """
+        return self._read(_read_blacklist_file, self.blacklist_path,
+                subject=subject)
+
+    def get_blacklist_comment(self, scan):
+        """
+        Returns the comment for a blacklisted scan or None if the scan isn't
+        blacklisted. The scan may be given as a full path with an extension.
+        """
+        try:
+            ident, tag, series, descr = scanid.parse_filename(scan)
+        except scanid.ParseException:
+            logger.error("Invalid scan name: {}".format(scan))
+            return None
+        scan = "_".join([str(ident), tag, series, descr])
+        return self._read(_read_blacklist_file, self.blacklist_path,
+                scan=scan)
+
+    def is_blacklisted(self, scan):
+        return self.get_blacklist_comment(scan) is not None
+
+    def get_checklist(self):
+        """
+        Returns a dictionary of subject IDs (minus session) mapped to their QC
+        comments
+        """
+        return self._read(_read_checklist_file, self.checklist_path)
+
+    def get_checklist_comment(self, subject):
+        """
+        Returns the QC comment for a subject, an empty string if the subject
+        hasn't been reviewed or None if the subject isn't in the checklist.
+        """
+        try:
+            ident = scanid.parse(subject)
+        except scanid.ParseException:
+            raise MetadataException("Invalid subject ID {}".format(subject))
+        return self._read(_read_checklist_file, self.checklist_path,
+                subject=ident.get_full_subjectid_with_timepoint())
+
+    def is_signed_off(self, subject):
+        return bool(self.get_checklist_comment(subject))
+
+    def _read(self, reader, path, **kwargs):
+        try:
+            return reader(path, **kwargs)
+        except MetadataException:
+            raise
+        except Exception as e:
+            raise MetadataException("Failed to read metadata file {}. Reason "
+                    "- {}".format(path, str(e)))
+
+
 def get_extension(path):
     """
     Get the filename extension on this path.
@@ -828,14 +1135,15 @@ def get_files_with_tag(parentdir, tag, fuzzy=False):
     within the filename's tag.
     """
 
+    contents = os.listdir(parentdir)
+    parsed = scanid.parse_filenames(contents)
+
     files = []
-    for f in os.listdir(parentdir):
-        try:
-            _, filetag, _, _ = scanid.parse_filename(f)
-            if tag == filetag or (fuzzy and tag in filetag):
-                files.append(os.path.join(parentdir, f))
-        except scanid.ParseException:
+    for f, filetag in zip(contents, parsed['tag']):
+        if filetag is None:
             continue
+        if tag == filetag or (fuzzy and tag in filetag):
+            files.append(os.path.join(parentdir, f))
 
     return files
 
@@ -882,6 +1190,183 @@ def make_temp_directory(suffix='', prefix='tmp', path=None):
         shutil.rmtree(temp_dir)
 
 
+MATERIALIZE_MODES = ['copy', 'hardlink', 'symlink', 'reflink']
+
+# ioctl request to clone a file's extents (Linux, btrfs / xfs / etc.)
+FICLONE = 0x40049409
+
+# Errors that mean a link can't be made here and a copy is needed instead
+_LINK_ERRORS = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+        errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS]
+
+
+def materialize(source, dest, mode='copy'):
+    """
+    Puts a file at dest with the contents of source. 'mode' is one of
+    MATERIALIZE_MODES:
+
+        copy        A full copy
+        hardlink    A hard link to source
+        symlink     A relative symbolic link to source
+        reflink     A copy-on-write clone of source, which shares its disk
+                    space until either file is changed
+
+    If a hardlink or reflink can't be made (e.g. dest is on another file
+    system, or the file system can't clone files) a copy is made instead.
+    Any existing dest is replaced, never written through. Returns the mode
+    actually used.
+
+    Note that hard and symbolic links share their data with source, so any
+    program that changes dest in place changes source too. Use unshare()
+    on dest first.
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError("Unknown mode {}, must be one of {}".format(mode,
+                ', '.join(MATERIALIZE_MODES)))
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if mode == 'symlink':
+        os.symlink(os.path.relpath(os.path.realpath(source),
+                os.path.dirname(os.path.abspath(dest))), dest)
+        return mode
+
+    try:
+        if mode == 'hardlink':
+            os.link(os.path.realpath(source), dest)
+            return mode
+        if mode == 'reflink':
+            _reflink(source, dest)
+            return mode
+    except (IOError, OSError) as e:
+        if e.errno not in _LINK_ERRORS:
+            raise
+        logger.debug("Can't {} {}, copying instead. Reason: {}".format(mode,
+                source, e))
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+    shutil.copy2(source, dest)
+    return 'copy'
+
+
+def _reflink(source, dest):
+    with open(source, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, dest)
+
+
+def sync_tree(source, dest, mode='copy'):
+    """
+    Brings the folder tree at dest up to date with the one at source,
+    placing each new or changed file with materialize(). Links in source are
+    followed. A file is unchanged if dest already shares its data, or has the
+    same size and modification time (which copies keep). Files that are only
+    in dest are left alone, so an unchanged tree is never written to.
+
+    Returns a tuple of (number of files updated, number unchanged, bytes not
+    copied because they're shared with source).
+    """
+    updated = 0
+    unchanged = 0
+    saved = 0
+    for root, dirs, files in os.walk(source, followlinks=True):
+        dest_root = os.path.join(dest, os.path.relpath(root, source))
+        makedirs(dest_root)
+        for name in files:
+            src_file = os.path.join(root, name)
+            dest_file = os.path.join(dest_root, name)
+            src_stat = os.stat(src_file)
+            if _is_synced(src_file, src_stat, dest_file):
+                unchanged += 1
+                if os.path.samefile(src_file, dest_file):
+                    saved += src_stat.st_size
+                continue
+            used = materialize(src_file, dest_file, mode)
+            updated += 1
+            if used != 'copy':
+                saved += src_stat.st_size
+    return updated, unchanged, saved
+
+
+def _is_synced(src_file, src_stat, dest_file):
+    try:
+        dest_stat = os.stat(dest_file)
+    except OSError:
+        return False
+    if os.path.samestat(src_stat, dest_stat):
+        return True
+    return (not os.path.islink(dest_file)
+            and dest_stat.st_size == src_stat.st_size
+            and int(dest_stat.st_mtime) == int(src_stat.st_mtime))
+
+
+def unshare(path):
+    """
+    Makes sure the file at path has its own copy of its data, so it can be
+    changed without changing the file it was linked from. Returns True if a
+    copy had to be made.
+    """
+    if not os.path.islink(path) and os.stat(path).st_nlink < 2:
+        return False
+    temp = path + '.unshare'
+    shutil.copy2(path, temp)
+    os.rename(temp, path)
+    return True
+
+
+
+# Bytes copied at a time by trim_volumes()
+TRIM_BUFFER_SIZE = 64 * 1024 ** 2
+
+
+def trim_volumes(source, dest, count):
+    """
+    Writes the 4D nifti at source to dest without its first 'count' volumes
+    (e.g. the dummy scans at the start of a BOLD run). This replaces
+    'fslroi source dest count -1'.
+
+    Volumes are contiguous on disk, so the data after the dropped volumes is
+    streamed through unchanged in one pass without being decoded. The data
+    type, scaling and extensions of source are kept. dest may not be source.
+    """
+    image = nib.load(source)
+    shape = image.shape
+    if len(shape) != 4:
+        raise ValueError("{} is not a 4D image".format(source))
+    if count < 0 or count >= shape[3]:
+        raise ValueError("Can't drop {} of the {} volumes in {}".format(count,
+                shape[3], source))
+
+    proxy = image.dataobj
+    vol_bytes = int(shape[0] * shape[1] * shape[2]) * \
+            proxy.dtype.itemsize
+    remaining = vol_bytes * (shape[3] - count)
+
+    header = image.header.copy()
+    header.set_data_shape(shape[:3] + (shape[3] - count,))
+    # nibabel moves the scaling from the header to the proxy when loading
+    header.set_slope_inter(proxy.slope, proxy.inter)
+    # The source's offset already leaves room for its header and extensions
+    header.set_data_offset(proxy.offset)
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+    with nib.openers.ImageOpener(source) as src:
+        with nib.openers.ImageOpener(dest, 'wb') as dst:
+            header.write_to(dst)
+            dst.write(b'\0' * (proxy.offset - dst.tell()))
+            src.seek(proxy.offset + vol_bytes * count)
+            while remaining > 0:
+                block = src.read(min(TRIM_BUFFER_SIZE, remaining))
+                if not block:
+                    raise IOError("{} is truncated".format(source))
+                dst.write(block)
+                remaining -= len(block)
+
+
+
 def remove_empty_files(path):
     for root, dirs, files in os.walk(path):
         for f in files:
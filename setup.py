@@ -21,12 +21,13 @@ setup(
     url="https://github.com/tigrlab/datman",
     long_description=description,
     scripts=glob.glob('bin/*.py') + glob.glob('bin/*.sh') + glob.glob('assets/*.sh'),
-    packages=['datman'],
+    packages=['datman', 'datman.qc'],
     classifiers=[
        'Development Status :: 4 - Beta',
        'Environment :: Console',
        'Intended Audience :: Science/Research',
     ],
     install_requires=['docopt', 'matplotlib', 'numpy', 'pandas', 'requests',
-        'scipy', 'scikit-image', 'pyyaml', 'nibabel', 'pydicom', 'qbatch'],
+        'scipy', 'scikit-image', 'pyyaml', 'nibabel', 'pydicom', 'qbatch',
+        'Pillow'],
  )
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Benchmarks datman.qc.fmri against qcmon's qc-fmri and qc-scanlength on a
+synthetic BOLD run, and compares their outputs.
+
+Usage:
+    benchmark_qc_fmri.py [options]
+
+Options:
+    --shape X,Y,Z       Volume size [default: 104,104,72]
+    --volumes N         Number of volumes, e.g. a long multiband run
+                        [default: 600]
+    --chunk N           Volumes datman.qc.fmri reads at a time [default: 32]
+    --nifti PATH        Benchmark an existing image instead
+    --keep DIR          Write outputs to DIR and keep them, so the two sets of
+                        outputs can be compared
+
+Details:
+    The qcmon commands are only timed if they're on the PATH. Peak memory is
+    the maximum resident size of the process (or of its children for the
+    qcmon commands).
+
+    When qcmon was run, the SFNR and correlation maps of the two are compared
+    inside the brain mask (correlation of the maps and largest relative
+    difference), as are the stats both of them report. qc-fmri's motion
+    metrics have no datman.qc.fmri equivalent and are listed separately.
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from docopt import docopt
+import numpy as np
+import nibabel as nib
+
+import datman.qc.fmri as fmri_qc
+
+
+def make_run(path, shape, volumes):
+    rng = np.random.RandomState(0)
+    # Filled a volume at a time to avoid a float64 copy of the whole run
+    data = np.empty(shape + (volumes,), dtype=np.int16)
+    for vol in range(volumes):
+        data[..., vol] = rng.normal(1000, 20, shape) + vol * 0.1
+    nib.Nifti1Image(data, np.eye(4)).to_filename(path)
+
+
+def peak_memory_mb(who=resource.RUSAGE_SELF):
+    # Linux reports kilobytes
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def time_it(label, func, who=resource.RUSAGE_SELF):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print("{:<32} {:8.2f}s {:10.0f} MB peak".format(label, elapsed,
+            peak_memory_mb(who)))
+
+
+def read_stats(path):
+    """
+    Reads a stats csv written as 'metric,value' lines, or as a header row of
+    metric names followed by one row of values.
+    """
+    with open(path) as fh:
+        rows = [line.strip().split(',') for line in fh if line.strip()]
+    if len(rows) == 2 and len(rows[0]) > 2 and len(rows[0]) == len(rows[1]):
+        rows = list(zip(rows[0], rows[1]))
+    stats = OrderedDict()
+    for row in rows:
+        try:
+            stats[row[0].strip()] = float(row[1])
+        except (IndexError, ValueError):
+            continue
+    return stats
+
+
+def compare_maps(name, native, qcmon, mask):
+    native = np.asarray(nib.load(native).dataobj, dtype=np.float64)[mask]
+    qcmon = np.asarray(nib.load(qcmon).dataobj, dtype=np.float64)[mask]
+    valid = np.isfinite(native) & np.isfinite(qcmon)
+    native, qcmon = native[valid], qcmon[valid]
+    corr = np.corrcoef(native, qcmon)[0, 1]
+    scale = np.maximum(np.abs(qcmon), 1e-6)
+    print("{:<32} r={:.4f} max relative diff {:.2%}".format(
+            name + ' map', corr, (np.abs(native - qcmon) / scale).max()))
+
+
+def compare_stats(native, qcmon):
+    native = read_stats(native)
+    qcmon = read_stats(qcmon)
+    for name in native:
+        if name in qcmon:
+            print("{:<32} {:12.4f} {:12.4f}".format(name, native[name],
+                    qcmon[name]))
+    only_qcmon = [name for name in qcmon if name not in native]
+    if only_qcmon:
+        print("Only in qc-fmri: {}".format(', '.join(only_qcmon)))
+
+
+def compare_outputs(nifti, native, qcmon):
+    first = np.asarray(nib.load(nifti).dataobj[..., 0], dtype=np.float64)
+    mask = first > fmri_qc.MASK_THRESHOLD * np.percentile(first, 98)
+    for name in ['sfnr', 'corr']:
+        compare_maps(name, '{}_{}.nii.gz'.format(native, name),
+                '{}_{}.nii.gz'.format(qcmon, name), mask)
+    print("{:<32} {:>12} {:>12}".format('stat', 'datman', 'qc-fmri'))
+    compare_stats(native + '_stats.csv', qcmon + '_stats.csv')
+
+
+def which(command):
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(folder, command), os.X_OK):
+            return True
+    return False
+
+
+def main():
+    arguments = docopt(__doc__)
+    shape = tuple(int(dim) for dim in arguments['--shape'].split(','))
+    volumes = int(arguments['--volumes'])
+    chunk = int(arguments['--chunk'])
+
+    out_dir = arguments['--keep'] or tempfile.mkdtemp(prefix='bench_fmri')
+    try:
+        nifti = arguments['--nifti']
+        if not nifti:
+            nifti = os.path.join(out_dir, 'bold.nii.gz')
+            print("Writing {}x{} run to {}".format(shape, volumes, nifti))
+            make_run(nifti, shape, volumes)
+
+        native = os.path.join(out_dir, 'native')
+        time_it('datman.qc.fmri scan length',
+                lambda: fmri_qc.write_scan_length(nifti,
+                    native + '_scanlengths.csv'))
+        time_it('datman.qc.fmri metrics',
+                lambda: fmri_qc.run_qc(nifti, native, chunk_size=chunk))
+
+        if not which('qc-fmri'):
+            print("qc-fmri not found, skipping qcmon")
+            return
+        qcmon = os.path.join(out_dir, 'qcmon')
+        time_it('qc-scanlength',
+                lambda: subprocess.check_call(['qc-scanlength', nifti,
+                    qcmon + '_scanlengths.csv']), resource.RUSAGE_CHILDREN)
+        time_it('qc-fmri',
+                lambda: subprocess.check_call(['qc-fmri', nifti, qcmon]),
+                resource.RUSAGE_CHILDREN)
+        compare_outputs(nifti, native, qcmon)
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    main()
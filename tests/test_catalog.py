@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from mock import MagicMock, patch
+
+import datman.catalog
+
+logging.disable(logging.CRITICAL)
+
+
+class TestCatalog(unittest.TestCase):
+    subject = "STUDY_CMH_0001_01"
+
+    def setUp(self):
+        self.study = tempfile.mkdtemp()
+        self.config = MagicMock()
+        self.config.get_path.side_effect = lambda key: os.path.join(
+                self.study, key) + "/"
+        os.mkdir(os.path.join(self.study, 'meta'))
+        self.make_file('nii', self.subject,
+                self.subject + "_01_T1_02_SagT1.nii.gz")
+        self.make_file('nii', self.subject,
+                self.subject + "_01_DTI60_05_Ax-DTI-60.nii.gz")
+        self.make_file('qc', self.subject, "qc_{}.html".format(self.subject))
+
+    def tearDown(self):
+        shutil.rmtree(self.study)
+
+    def make_file(self, path_type, folder, name):
+        path = os.path.join(self.study, path_type, folder)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'w') as new_file:
+            new_file.write('data')
+
+    def get_catalog(self):
+        return datman.catalog.Catalog(self.config,
+                path_types=['nii', 'qc', 'resources'])
+
+    def test_finds_files_by_tag_and_path_type(self):
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+            found = catalog.find(tag='T1', path_type='nii')
+
+        assert len(found) == 1
+        assert found[0].subject == self.subject
+        assert found[0].session == '01'
+        assert found[0].series == '02'
+        assert found[0].size == 4
+
+    def test_finds_non_datman_named_files_in_subject_folders(self):
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+            found = catalog.find(subject=self.subject, path_type='qc')
+
+        assert [os.path.basename(entry.path) for entry in found] == [
+                "qc_{}.html".format(self.subject)]
+        assert found[0].tag is None
+
+    def test_ignores_folders_without_datman_names(self):
+        self.make_file('nii', 'logs', 'STUDY_CMH_0002_01_01_T1_02_SagT1.nii')
+
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+            assert catalog.subjects('nii') == [self.subject]
+
+    def test_refresh_only_rereads_changed_directories(self):
+        with self.get_catalog() as catalog:
+            assert catalog.refresh() > 0
+            assert catalog.refresh() == 0
+
+            new_subject = "STUDY_CMH_0002_01"
+            self.make_file('nii', new_subject,
+                    new_subject + "_01_T1_02_SagT1.nii.gz")
+            # The changed nii folder + the new subject's folder
+            assert catalog.refresh() == 2
+            assert catalog.subjects('nii') == [self.subject, new_subject]
+
+    def test_removed_folders_are_dropped_from_index(self):
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+            shutil.rmtree(os.path.join(self.study, 'nii', self.subject))
+            catalog.refresh()
+
+            assert catalog.find(path_type='nii') == []
+            assert catalog.subjects('nii') == []
+
+    def test_index_persists_between_instances(self):
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+
+        with self.get_catalog() as catalog:
+            assert catalog.refresh() == 0
+            assert len(catalog.find(subject=self.subject)) == 3
+
+    def test_unreadable_folder_keeps_contents_and_is_reread(self):
+        subject_dir = os.path.join(self.study, 'nii', self.subject)
+        list_dir = datman.catalog._list_dir
+
+        def fail_on_subject(path):
+            if path.rstrip(os.sep) == subject_dir:
+                raise OSError("Stale file handle")
+            return list_dir(path)
+
+        with self.get_catalog() as catalog:
+            catalog.refresh()
+            self.make_file('nii', self.subject,
+                    self.subject + "_01_RST_03_Resting.nii.gz")
+            with patch('datman.catalog._list_dir', side_effect=fail_on_subject):
+                catalog.refresh()
+            assert len(catalog.find(path_type='nii')) == 2
+
+            catalog.refresh()
+            assert len(catalog.find(path_type='nii')) == 3
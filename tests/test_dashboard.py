@@ -0,0 +1,273 @@
+import unittest
+import logging
+
+from nose.tools import raises
+from mock import patch, MagicMock
+
+import datman.dashboard as dashboard
+
+logging.disable(logging.CRITICAL)
+
+T1 = 'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz'
+T1_JSON = 'STUDY_CMH_0001_01_01_T1_02_SagT1.json'
+DTI = 'STUDY_CMH_0001_01_01_DTI60_05_Ax-DTI.nii.gz'
+OTHER_T1 = 'STUDY_CMH_0002_01_01_T1_02_SagT1.nii.gz'
+
+
+def make_record(name, **kwargs):
+    record = MagicMock(**kwargs)
+    record.name = name
+    return record
+
+
+def query_result(mock_model, records):
+    mock_model.query.filter.return_value.all.return_value = records
+
+
+@patch('datman.dashboard.dash_found', True)
+class TestGetScans(unittest.TestCase):
+
+    @patch('datman.dashboard.models', create=True)
+    @patch('datman.dashboard.queries', create=True)
+    def test_uses_one_query_for_all_scans(self, mock_queries, mock_models):
+        t1 = make_record('STUDY_CMH_0001_01_01_T1_02')
+        query_result(mock_models.Scan, [t1])
+
+        scans = dashboard.get_scans([T1, T1_JSON, DTI])
+
+        assert scans == {T1: t1, T1_JSON: t1, DTI: None}
+        assert mock_models.Scan.query.filter.call_count == 1
+        assert sorted(mock_models.Scan.name.in_.call_args[0][0]) == [
+                'STUDY_CMH_0001_01_01_DTI60_05', 'STUDY_CMH_0001_01_01_T1_02']
+        assert not mock_queries.get_scan.called
+
+    @patch('datman.dashboard.QUERY_CHUNK_SIZE', 1)
+    @patch('datman.dashboard.models', create=True)
+    def test_long_lists_split_into_chunks(self, mock_models):
+        query_result(mock_models.Scan, [])
+
+        dashboard.get_scans([T1, DTI, OTHER_T1])
+
+        assert mock_models.Scan.query.filter.call_count == 3
+
+    @raises(dashboard.DashboardException)
+    @patch('datman.dashboard.models', create=True)
+    def test_raises_exception_for_duplicate_records(self, mock_models):
+        query_result(mock_models.Scan, [
+                make_record('STUDY_CMH_0001_01_01_T1_02'),
+                make_record('STUDY_CMH_0001_01_01_T1_02')])
+
+        dashboard.get_scans([T1])
+
+    @raises(dashboard.DashboardException)
+    @patch('datman.dashboard.models', create=True)
+    def test_raises_exception_for_invalid_name(self, mock_models):
+        dashboard.get_scans([T1, 'not_a_datman_name'])
+
+    @patch('datman.dashboard.add_scans')
+    @patch('datman.dashboard.models', create=True)
+    def test_creates_only_missing_scans(self, mock_models, mock_add):
+        t1 = make_record('STUDY_CMH_0001_01_01_T1_02')
+        dti = make_record('STUDY_CMH_0001_01_01_DTI60_05')
+        query_result(mock_models.Scan, [t1])
+        mock_add.return_value = {DTI: dti}
+
+        scans = dashboard.get_scans([T1, DTI], create=True)
+
+        mock_add.assert_called_once_with([DTI])
+        assert scans == {T1: t1, DTI: dti}
+
+
+@patch('datman.dashboard.dash_found', True)
+class TestAddScans(unittest.TestCase):
+
+    @patch('datman.dashboard.get_sessions')
+    @patch('datman.dashboard.models', create=True)
+    @patch('datman.dashboard.queries', create=True)
+    def test_added_in_one_transaction(self, mock_queries, mock_models,
+            mock_sessions):
+        study = MagicMock()
+        study.scantypes = [MagicMock(tag='T1'), MagicMock(tag='DTI60')]
+        mock_queries.get_study.return_value = [MagicMock(study=study)]
+        session = MagicMock()
+        other_session = MagicMock()
+        mock_sessions.return_value = {'STUDY_CMH_0001_01_01': session,
+                'STUDY_CMH_0002_01_01': other_session}
+
+        added = dashboard.add_scans({T1: None, DTI: None, OTHER_T1: 12})
+
+        assert sorted(added) == sorted([T1, DTI, OTHER_T1])
+        assert mock_queries.get_study.call_count == 1
+        mock_sessions.assert_called_once_with(set(['STUDY_CMH_0001_01_01',
+                'STUDY_CMH_0002_01_01']), create=True)
+        other_session.add_scan.assert_called_once_with(
+                'STUDY_CMH_0002_01_01_T1_02', '02', 'T1', 'SagT1',
+                source_id=12)
+        db_session = mock_models.db.session
+        assert db_session.begin_nested.call_count == 3
+        assert db_session.commit.call_count == 1
+        assert not db_session.rollback.called
+
+    @patch('datman.dashboard.get_sessions')
+    @patch('datman.dashboard.models', create=True)
+    @patch('datman.dashboard.queries', create=True)
+    def test_rolled_back_when_a_scan_fails(self, mock_queries, mock_models,
+            mock_sessions):
+        study = MagicMock()
+        study.scantypes = [MagicMock(tag='T1'), MagicMock(tag='DTI60')]
+        mock_queries.get_study.return_value = [MagicMock(study=study)]
+        session = MagicMock()
+        session.add_scan.side_effect = [MagicMock(), ValueError]
+        mock_sessions.return_value = {'STUDY_CMH_0001_01_01': session}
+
+        with self.assertRaises(ValueError):
+            dashboard.add_scans([T1, DTI])
+
+        assert mock_models.db.session.rollback.call_count == 1
+        assert not mock_models.db.session.commit.called
+
+    @raises(dashboard.DashboardException)
+    @patch('datman.dashboard.get_sessions')
+    @patch('datman.dashboard.models', create=True)
+    @patch('datman.dashboard.queries', create=True)
+    def test_raises_exception_for_unconfigured_tag(self, mock_queries,
+            mock_models, mock_sessions):
+        study = MagicMock()
+        study.scantypes = [MagicMock(tag='T1')]
+        mock_queries.get_study.return_value = [MagicMock(study=study)]
+
+        dashboard.add_scans([T1, DTI])
+
+
+@patch('datman.dashboard.dash_found', True)
+class TestGetSessions(unittest.TestCase):
+
+    @patch('datman.dashboard.models', create=True)
+    @patch('datman.dashboard.queries', create=True)
+    def test_uses_one_query_for_all_sessions(self, mock_queries, mock_models):
+        session = make_record('STUDY_CMH_0001_01', num=2)
+        other = make_record('STUDY_CMH_0001_01', num=3)
+        phantom = make_record('STUDY_CMH_PHA_FBN0001', num=1)
+        query_result(mock_models.Session, [session, other, phantom])
+
+        sessions = dashboard.get_sessions(['STUDY_CMH_0001_01_02',
+                'STUDY_CMH_0001_01_01', 'STUDY_CMH_PHA_FBN0001'])
+
+        assert sessions == {'STUDY_CMH_0001_01_02': session,
+                'STUDY_CMH_0001_01_01': None,
+                'STUDY_CMH_PHA_FBN0001': phantom}
+        assert mock_models.Session.query.filter.call_count == 1
+        assert sorted(mock_models.Session.name.in_.call_args[0][0]) == [
+                'STUDY_CMH_0001_01', 'STUDY_CMH_PHA_FBN0001']
+        assert not mock_queries.get_session.called
+
+    @patch('datman.dashboard.add_session')
+    @patch('datman.dashboard.models', create=True)
+    def test_creates_only_missing_sessions(self, mock_models, mock_add):
+        session = make_record('STUDY_CMH_0001_01', num=1)
+        query_result(mock_models.Session, [session])
+
+        sessions = dashboard.get_sessions(['STUDY_CMH_0001_01_01',
+                'STUDY_CMH_0002_01_01'], create=True)
+
+        mock_add.assert_called_once_with('STUDY_CMH_0002_01_01')
+        assert sessions['STUDY_CMH_0001_01_01'] is session
+
+
+@patch('datman.dashboard.dash_found', True)
+class TestAddChecklistEntries(unittest.TestCase):
+
+    @patch('datman.dashboard.models', create=True)
+    def test_entries_added_in_one_transaction(self, mock_models):
+        t1 = make_record('STUDY_CMH_0001_01_01_T1_02')
+        dti = make_record('STUDY_CMH_0001_01_01_DTI60_05')
+        query_result(mock_models.Scan, [t1, dti])
+        user = MagicMock(id=3)
+
+        dashboard.add_checklist_entries({T1: 'motion', DTI: ''}, user=user)
+
+        t1.add_checklist_entry.assert_called_once_with(3, comment='motion',
+                sign_off=False)
+        assert mock_models.db.session.begin_nested.call_count == 2
+        assert mock_models.db.session.commit.call_count == 1
+
+    @raises(dashboard.DashboardException)
+    @patch('datman.dashboard.models', create=True)
+    def test_raises_exception_for_missing_scans(self, mock_models):
+        query_result(mock_models.Scan, [])
+
+        dashboard.add_checklist_entries({T1: ''}, user=MagicMock())
+
+
+@patch('datman.dashboard.dash_found', True)
+class TestRecordCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dashboard.enable_cache()
+
+    def tearDown(self):
+        dashboard.disable_cache()
+
+    @patch('datman.dashboard.queries', create=True)
+    def test_each_subject_looked_up_once(self, mock_queries):
+        subject = MagicMock()
+        mock_queries.find_subjects.return_value = [subject]
+
+        # Same subject, with and without session
+        assert dashboard.get_subject('STUDY_CMH_0001_01_01') is subject
+        assert dashboard.get_subject('STUDY_CMH_0001_01') is subject
+        assert dashboard.get_subject('STUDY_CMH_0001_01_02') is subject
+
+        assert mock_queries.find_subjects.call_count == 1
+        assert self.cache.hits == 2
+        assert self.cache.misses == 1
+
+    @patch('datman.dashboard.queries', create=True)
+    def test_missing_records_are_cached(self, mock_queries):
+        mock_queries.get_scan.return_value = []
+
+        assert dashboard.get_scan(T1) is None
+        assert dashboard.get_scan(T1_JSON) is None
+
+        assert mock_queries.get_scan.call_count == 1
+
+    @patch('datman.dashboard.get_session')
+    @patch('datman.dashboard.queries', create=True)
+    def test_add_scan_invalidates_cached_scan(self, mock_queries,
+            mock_session):
+        study = MagicMock()
+        study.scantypes = [MagicMock(tag='T1')]
+        mock_queries.get_study.return_value = [MagicMock(study=study)]
+        mock_queries.get_scan.return_value = []
+        assert dashboard.get_scan(T1) is None
+
+        new_scan = MagicMock()
+        mock_queries.get_scan.return_value = [new_scan]
+        dashboard.add_scan(T1)
+
+        assert dashboard.get_scan(T1) is new_scan
+        assert mock_queries.get_scan.call_count == 2
+
+    @patch('datman.dashboard.models', create=True)
+    def test_bulk_query_skips_cached_scans(self, mock_models):
+        t1 = make_record('STUDY_CMH_0001_01_01_T1_02')
+        dti = make_record('STUDY_CMH_0001_01_01_DTI60_05')
+        query_result(mock_models.Scan, [t1])
+        dashboard.get_scans([T1])
+
+        query_result(mock_models.Scan, [dti])
+        scans = dashboard.get_scans([T1, DTI])
+
+        assert scans == {T1: t1, DTI: dti}
+        mock_models.Scan.name.in_.assert_called_with(
+                ['STUDY_CMH_0001_01_01_DTI60_05'])
+
+    @patch('datman.dashboard.queries', create=True)
+    def test_not_used_when_disabled(self, mock_queries):
+        dashboard.disable_cache()
+        mock_queries.get_scan.return_value = []
+
+        dashboard.get_scan(T1)
+        dashboard.get_scan(T1)
+
+        assert mock_queries.get_scan.call_count == 2
@@ -95,4 +95,49 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+def test_parse_filenames_returns_columns_in_input_order():
+    parsed = scanid.parse_filenames([
+            'DTI_CMH_H001_01_01_T1_03_description.nii.gz',
+            'SPN01_MRC_PHA_FBN0013_RST_04_EPI-3x3x4xTR2.nii.gz'])
+    eq_([str(ident) for ident in parsed['ident']],
+            ['DTI_CMH_H001_01_01', 'SPN01_MRC_PHA_FBN0013'])
+    eq_(parsed['tag'], ['T1', 'RST'])
+    eq_(parsed['series'], ['03', '04'])
+    eq_(parsed['description'], ['description', 'EPI-3x3x4xTR2'])
+    eq_(parsed['errors'], {})
+
+def test_parse_filenames_reports_errors_per_item():
+    parsed = scanid.parse_filenames(['garbage.nii.gz',
+            '/data/DTI_CMH_H001_01_01_T1_02_description.nii.gz'])
+    eq_(list(parsed['errors'].keys()), [0])
+    ok_(isinstance(parsed['errors'][0], scanid.ParseException))
+    eq_(parsed['ident'][0], None)
+    eq_(parsed['tag'], [None, 'T1'])
+    eq_(str(parsed['ident'][1]), 'DTI_CMH_H001_01_01')
+
+def test_parse_returns_same_result_when_cached():
+    first = scanid.parse("DTI_CMH_H001_01")
+    second = scanid.parse("DTI_CMH_H001_01")
+    eq_(str(first), str(second))
+    eq_(second.session, '')
+
+def test_identifiers_for_same_session_are_equal_and_hash_the_same():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    other = scanid.Identifier("DTI", "CMH", "H001", "01", "02")
+    eq_(ident, other)
+    eq_(hash(ident), hash(other))
+    eq_({ident: 'found'}[other], 'found')
+
+def test_identifiers_for_different_sessions_are_not_equal():
+    ok_(scanid.parse("DTI_CMH_H001_01_01") != scanid.parse("DTI_CMH_H001_01_02"))
+
+def test_missing_session_equals_empty_session():
+    eq_(scanid.parse("DTI_CMH_H001_01"),
+            scanid.Identifier("DTI", "CMH", "H001", "01", ""))
+
+@raises(AttributeError)
+def test_identifier_is_immutable():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    ident.session = "03"
+
 # vim: ts=4 sw=4:
@@ -182,41 +182,45 @@ class FMRIQC(unittest.TestCase):
             "STUDY_SITE_0001_01_01_OBS_09_Ax-Observe-Task")
 
     @patch('os.path.isfile')
-    @patch('datman.utils.run')
-    def test_no_commands_run_when_output_exists(self, mock_run, mock_isfile):
+    @patch('bin.dm_qc_report.slicer')
+    @patch('bin.dm_qc_report.slicesdir')
+    @patch('datman.qc.fmri')
+    def test_no_commands_run_when_output_exists(self, mock_fmri,
+            mock_slicesdir, mock_slicer, mock_isfile):
         mock_isfile.return_value = True
 
         qc.fmri_qc(self.file_name, self.qc_dir, self.qc_report)
 
-        assert mock_run.call_count == 0
-
-    @patch('datman.utils.run')
-    def test_expected_commands_run(self, mock_run):
-        scan_length = 'qc-scanlength {} {}'.format(self.file_name,
-                self.output_name + '_scanlengths.csv')
-        fmri = 'qc-fmri {} {}'.format(self.file_name,
-                self.output_name)
-
-        slicer_cmd = 'slicer {} -S {} {} {}'
-        slicer1 = slicer_cmd.format(self.output_name +
-                '_sfnr.nii.gz', qc.SLICER_GAP, qc.SLICER_FMRI_RES,
-                self.output_name + '_sfnr.png')
-        slicer2 = slicer_cmd.format(self.output_name + '_corr.nii.gz',
-                 qc.SLICER_GAP, qc.SLICER_FMRI_RES,
-                 self.output_name + '_corr.png')
-        slicer3 = slicer_cmd.format(self.file_name, qc.SLICER_GAP,
-                qc.SLICER_FMRI_RES, self.output_name + '_raw.png')
+        assert mock_fmri.run_qc.call_count == 0
+        assert mock_fmri.write_scan_length.call_count == 0
+        assert mock_slicer.call_count == 0
+        assert mock_slicesdir.call_count == 0
 
+    @patch('bin.dm_qc_report.slicer')
+    @patch('bin.dm_qc_report.slicesdir')
+    @patch('datman.qc.fmri')
+    def test_expected_commands_run(self, mock_fmri, mock_slicesdir,
+            mock_slicer):
         qc.fmri_qc(self.file_name, self.qc_dir, self.qc_report)
 
-        expected_calls = [call(scan_length), call(fmri), call(slicer1),
-                call(slicer2), call(slicer3)]
-
-        assert mock_run.call_count == 5
-        print("Test will fail if format of the argument string changes."\
-              " If the new code is correct, update this test to make it pass "\
-              " with the new format.")
-        mock_run.assert_has_calls(expected_calls, any_order=True)
+        mock_fmri.write_scan_length.assert_called_once_with(self.file_name,
+                self.output_name + '_scanlengths.csv')
+        mock_fmri.run_qc.assert_called_once_with(self.file_name,
+                self.output_name)
+        mock_slicesdir.assert_called_once_with(self.file_name,
+                self.output_name + '_montage.png')
+
+        expected_calls = [
+                call(self.output_name + '_sfnr.nii.gz',
+                    self.output_name + '_sfnr.png', qc.SLICER_GAP,
+                    qc.SLICER_FMRI_RES),
+                call(self.output_name + '_corr.nii.gz',
+                    self.output_name + '_corr.png', qc.SLICER_GAP,
+                    qc.SLICER_FMRI_RES),
+                call(self.file_name, self.output_name + '_raw.png',
+                    qc.SLICER_GAP, qc.SLICER_FMRI_RES)]
+        assert mock_slicer.call_count == 3
+        mock_slicer.assert_has_calls(expected_calls, any_order=True)
 
 class AddImage(unittest.TestCase):
     qc_report = MagicMock(spec=file)
@@ -413,3 +417,58 @@ class AddReportToChecklist(unittest.TestCase):
             qc.add_report_to_checklist(report, self.checklist)
 
             return mock_file.call_count, mock_file.call_args_list, checklist_mock
+
+class RunQCTasks(unittest.TestCase):
+
+    def test_dependent_tasks_run_after_their_dependencies(self):
+        finished = []
+        tasks = qc.QCTasks()
+        first = tasks.add(finished.append, 'first')
+        tasks.add(finished.append, 'second', after=[first])
+        tasks.add(finished.append, 'independent')
+
+        tasks.run(cores=4)
+
+        assert len(finished) == 3
+        assert finished.index('first') < finished.index('second')
+
+    @patch('datman.utils.run')
+    def test_tasks_skipped_when_dependency_fails(self, mock_run):
+        mock_run.return_value = (1, '')
+        finished = []
+        tasks = qc.QCTasks()
+        failed = tasks.add('qc-fmri some_file.nii.gz output')
+        tasks.add(finished.append, 'dependent', after=[failed])
+        tasks.add(finished.append, 'independent')
+
+        tasks.run(cores=2)
+
+        assert finished == ['independent']
+
+    def test_immediate_mode_runs_tasks_when_added(self):
+        finished = []
+        tasks = qc.QCTasks(immediate=True)
+        tasks.add(finished.append, 'task')
+        assert finished == ['task']
+
+class UpdateManifest(unittest.TestCase):
+
+    @patch('bin.dm_qc_report.get_nifti_paths')
+    def test_series_with_failed_tasks_not_recorded(self, mock_niftis):
+        mock_niftis.return_value = ['ok.nii.gz', 'failed.nii.gz']
+        manifest = MagicMock()
+        subject = MagicMock()
+        ok_task = qc.QCTask('cmd', (), [])
+        failed_task = qc.QCTask('cmd', (), [])
+        failed_task.failed = True
+        ok_fragment = qc.ReportFragment('qc_subject.html')
+        ok_fragment.write('<img>')
+
+        qc.update_manifest(manifest, subject, [
+                ('ok.nii.gz', ok_fragment, [ok_task]),
+                ('failed.nii.gz', qc.ReportFragment('qc_subject.html'),
+                    [failed_task])])
+
+        manifest.update.assert_called_once_with('ok.nii.gz', '<img>')
+        manifest.set_inputs.assert_called_once_with(['ok.nii.gz'])
+        assert manifest.save.called
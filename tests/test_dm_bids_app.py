@@ -8,6 +8,8 @@ from mock import patch, mock_open
 import nose, pytest
 import subprocess as proc
 import shutil
+import tempfile
+import time
 import unittest
 
 ba = importlib.import_module("bin.dm_bids_app") 
@@ -91,15 +93,15 @@ def test_gen_log_redirect_fails_if_cannot_create_directory_permissions(mock_make
 
     
 @patch('os.makedirs') 
-def test_fs_fetch_recon_returns_rsync_when_recon_found(mock_makedir): 
+def test_fs_fetch_recon_returns_sync_when_recon_found(mock_makedir): 
 
-    subject = 'SPN01_CMH_1234_01' 
-    exp_dir = os.path.join(output_path,'freesurfer','sub-CMH1234') 
+    subject = 'SPN01_CMH_6666_01' 
+    exp_dir = os.path.join(output_path,'freesurfer','sub-CMH6666') 
     sub_dir = os.path.join(output_path) 
     
     expected_cmd = '''
 
-    rsync -L -a {recon_dir}/ {out_dir}
+    dm_sync_tree.py --mode hardlink {recon_dir} {out_dir}
 
     '''.format(recon_dir=os.path.join(fs_dir,subject),out_dir = exp_dir) 
 
@@ -116,6 +118,28 @@ def test_fs_fetch_recon_returns_nothing_if_no_recon(mock_makedir):
     mock_makedir.returnvalue = ''
     assert ba.fetch_fs_recon(fs_dir,sub_dir,subject).replace(' ','') == ''
     
+def test_existing_freesurfer_synced_for_single_session_group():
+
+    jargs = {'freesurfer-dir' : fs_dir, 'keeprecon' : True}
+
+    fetch_cmd, symlink_cmds = ba.get_existing_freesurfer(jargs,output_path,
+            ['SPN01_CMH_6666_01','SPN01_CMH_4321_01','SPN01_CMH_4321_02'])
+
+    assert fetch_cmd.count('dm_sync_tree.py') == 1
+    assert os.path.join(fs_dir,'SPN01_CMH_6666_01') in fetch_cmd
+    assert 'SPN01_CMH_4321' not in fetch_cmd
+    assert len(symlink_cmds) == 2
+
+def test_existing_freesurfer_not_synced_for_longitudinal_group():
+
+    jargs = {'freesurfer-dir' : fs_dir, 'keeprecon' : True}
+
+    fetch_cmd, symlink_cmds = ba.get_existing_freesurfer(jargs,output_path,
+            ['SPN01_CMH_6666_01','SPN01_CMH_6666_02'])
+
+    assert fetch_cmd == ''
+    assert symlink_cmds == []
+
 def test_get_exclusion_cmd_formats_correctly(): 
 
     tags = ['HI','EXCLUDE','ME']
@@ -332,3 +356,178 @@ class TestBASHCommands(unittest.TestCase):
 
 
 
+def test_pack_groups_splits_into_packs_of_size():
+
+    groups = ['SPN01_CMH_0003', 'SPN01_CMH_0001', 'SPN01_CMH_0002']
+
+    assert ba.pack_groups(groups, 2) == [['SPN01_CMH_0001', 'SPN01_CMH_0002'],
+            ['SPN01_CMH_0003']]
+    assert ba.pack_groups(groups, 1) == [[g] for g in sorted(groups)]
+
+def test_scale_threads_multiplies_thread_argument():
+
+    thread_dict = {'MRIQC' : '--n_procs'}
+    jargs = {'app':'MRIQC', 'bidsargs':{'--n_procs' : '4'}}
+
+    assert ba.scale_threads(jargs, thread_dict, 3) == 12
+    assert jargs['bidsargs']['--n_procs'] == '12'
+
+def test_scale_threads_leaves_unset_threads_alone():
+
+    thread_dict = {'MRIQC' : '--n_procs'}
+    jargs = {'app':'MRIQC', 'bidsargs':{}}
+
+    assert ba.scale_threads(jargs, thread_dict, 3) is None
+    assert jargs['bidsargs'] == {}
+
+def test_get_participant_labels_joins_pack_labels():
+
+    pack = ['SPN01_CMH_1234_01', 'SPN01_CMH_5678_01']
+
+    assert ba.get_participant_labels(pack) == 'CMH1234 CMH5678'
+    assert ba.get_participant_labels(pack[0]) == 'CMH1234'
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix='bids_ledger')
+        self.ledger = ba.get_ledger_path(self.log_dir, 'MRIQC')
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def write(self, path, contents):
+        with open(path, 'w') as fh:
+            fh.write(contents)
+
+    def test_latest_status_in_ledger_is_used(self):
+        self.write(self.ledger, 'sub-CMH0001\t1\t100\nsub-CMH0002\t0\t100\n'
+                'sub-CMH0001\t0\t200\nsub-CMH0003\t1\t200\n')
+        subjects = ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01',
+                'SPN01_CMH_0003_01']
+
+        assert ba.filter_subjects(subjects, '', 'MRIQC', self.log_dir) == [
+                'SPN01_CMH_0003_01']
+
+    def test_falls_back_to_end_of_log_when_not_in_ledger(self):
+        log = os.path.join(self.log_dir, '{}_MRIQC.log')
+        self.write(log.format('sub-CMH0001'), 'ERROR\n' + 'x' * ba.LOG_TAIL_SIZE)
+        self.write(log.format('sub-CMH0002'), 'Workflow did not execute cleanly')
+        subjects = ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01',
+                'SPN01_CMH_0003_01']
+
+        assert ba.filter_subjects(subjects, '', 'MRIQC', self.log_dir) == [
+                'SPN01_CMH_0002_01', 'SPN01_CMH_0003_01']
+
+    def test_job_records_exit_status_for_each_participant(self):
+        init_cmd = ba.get_init_cmd('SPN01', ['SPN01_CMH_0001', 'SPN01_CMH_0002'],
+                self.log_dir, self.log_dir, 'out', 'some_image.img', '',
+                self.ledger)
+        job = os.path.join(self.log_dir, 'job.sh')
+        ba.write_executable(job, init_cmd + ['\n false \n'])
+
+        proc.call([job])
+
+        assert ba.read_ledger(self.ledger) == {'sub-CMH0001': '1',
+                'sub-CMH0002': '1'}
+
+def test_mriqc_fork_passes_bids_database():
+
+    jargs = {'app': 'MRIQC', 'bidsargs': {}, 'bids-database': '/data/bids_db'}
+
+    cmd = ba.mriqc_fork(jargs, '')[0]
+
+    assert '-B /data/bids_db:/bids_db' in cmd
+    assert '--bids-database-dir /bids_db' in cmd
+    assert 'bids_db' not in ba.mriqc_fork({'bidsargs': {}}, '')[0]
+
+def test_jobs_dont_rebuild_bids_database():
+
+    cmd = ba.get_nii_to_bids_cmd('SPN01', ['SPN01_CMH_0001_01'], '')
+
+    assert 'dm_to_bids.py SPN01 --bids-dir $BIDS SPN01_CMH_0001_01' in cmd
+    assert 'database' not in cmd
+
+class TestUpdateBidsDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dm_bids_app')
+        self.bids_dir = os.path.join(self.root, 'bids')
+        self.bids_db = os.path.join(self.root, 'db', 'bids_db')
+        self.converted = []
+        self.indexed = []
+        self.index_status = 0
+        patcher = patch.object(ba.proc, 'call', side_effect=self.call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def call(self, cmd):
+        '''
+        Stands in for dm_to_bids.py, which writes a manifest for each session it
+        converts, and for the container's python, which writes the database
+        '''
+        if cmd[0] == 'dm_to_bids.py':
+            for sub in self.converted:
+                ses_dir = os.path.join(self.bids_dir, sub, 'ses-01')
+                if not os.path.isdir(ses_dir):
+                    os.makedirs(ses_dir)
+                open(os.path.join(ses_dir, ba.BIDS_MANIFEST_NAME), 'w').close()
+            return 0
+        db_dir = cmd[cmd.index('-B', 4) + 1].split(':')[0]
+        self.indexed.append(cmd)
+        with open(os.path.join(db_dir, 'layout.db'), 'w') as fh:
+            fh.write('index {}'.format(len(self.indexed)))
+        return self.index_status
+
+    def update(self):
+        return ba.update_bids_database('SPN01', ['SPN01_CMH_0001_01'],
+                self.bids_dir, 'app.img', self.bids_db)
+
+    def database(self):
+        with open(os.path.join(self.bids_db, 'layout.db')) as fh:
+            return fh.read()
+
+    def test_index_built_with_container_python(self):
+        self.converted = ['sub-CMH0001']
+
+        assert self.update()
+
+        assert self.database() == 'index 1'
+        cmd = self.indexed[0]
+        assert cmd[:2] == ['singularity', 'exec']
+        assert '{}:/bids'.format(self.bids_dir) in cmd
+        assert cmd[cmd.index('app.img') + 1:][:2] == ['python', '-c']
+
+    def test_up_to_date_database_not_rebuilt(self):
+        self.converted = ['sub-CMH0001']
+        self.update()
+        self.converted = []
+        os.utime(self.bids_db, (time.time() + 10, time.time() + 10))
+
+        assert self.update()
+
+        assert len(self.indexed) == 1
+
+    def test_converted_session_replaces_database(self):
+        self.converted = ['sub-CMH0001']
+        self.update()
+        os.utime(self.bids_db, (time.time() - 10, time.time() - 10))
+
+        assert self.update()
+
+        assert self.database() == 'index 2'
+        assert os.listdir(os.path.dirname(self.bids_db)) == ['bids_db']
+
+    def test_failed_index_keeps_old_database(self):
+        self.converted = ['sub-CMH0001']
+        self.update()
+        os.utime(self.bids_db, (time.time() - 10, time.time() - 10))
+        self.index_status = 1
+
+        assert not self.update()
+
+        assert self.database() == 'index 1'
+        assert os.listdir(os.path.dirname(self.bids_db)) == ['bids_db']
@@ -0,0 +1,115 @@
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+import importlib
+import logging
+
+from mock import MagicMock
+
+import datman.config
+
+logging.disable(logging.CRITICAL)
+
+header_checks = importlib.import_module('bin.dm_header_checks')
+
+
+class TagSettings(object):
+
+    def __init__(self, qc_types):
+        self.qc_types = qc_types
+
+    def __iter__(self):
+        return iter(self.qc_types)
+
+    def get(self, tag, key):
+        return self.qc_types[tag]
+
+
+class CheckStudy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='header_checks')
+        self.nii = os.path.join(self.tmp, 'nii')
+        self.std = os.path.join(self.tmp, 'std')
+        os.makedirs(self.std)
+
+        standard = {'EchoTime': 0.03, 'FlipAngle': 90, 'SeriesNumber': 2,
+                'ImageType': ['ORIGINAL', 'PRIMARY']}
+        self.write_json(self.std, 'STUDY_CMH_9999_01_01_T1_02_SagT1.json',
+                standard)
+
+        self.write_json(os.path.join(self.nii, 'STUDY_CMH_0001_01'),
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.json',
+                dict(standard, EchoTime=0.031, SeriesNumber=3))
+        self.write_json(os.path.join(self.nii, 'STUDY_CMH_0002_01'),
+                'STUDY_CMH_0002_01_01_T1_04_SagT1.json',
+                {'EchoTime': 0.03, 'SeriesNumber': 4,
+                 'ImageType': ['DERIVED']})
+        self.write_json(os.path.join(self.nii, 'STUDY_CMH_0002_01'),
+                'STUDY_CMH_0002_01_01_RST_05_Resting.json', {})
+        self.write_json(os.path.join(self.nii, 'STUDY_CMH_PHA_FBN0001'),
+                'STUDY_CMH_PHA_FBN0001_T1_02_SagT1.json', {})
+
+        self.config = MagicMock()
+        self.config.get_path.side_effect = lambda key: {'nii': self.nii,
+                'std': self.std}[key]
+        self.config.get_tags.return_value = TagSettings({'T1': 'anat',
+                'RST': 'fmri'})
+
+        def get_key(key, site=None):
+            if key == 'IgnoreHeaderFields':
+                return ['SeriesNumber']
+            raise datman.config.UndefinedSetting
+        self.config.get_key.side_effect = get_key
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_json(self, folder, name, contents):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, name), 'w') as fh:
+            json.dump(contents, fh)
+
+    def get_issues(self, rows):
+        return sorted((row['series'].split('_')[2], row['field'],
+                row['issue']) for row in rows)
+
+    def test_reports_each_difference_once(self):
+        rows = header_checks.check_study(self.config, processes=1,
+                tolerances={'EchoTime': 0.005})
+
+        assert self.get_issues(rows) == [
+                ('0002', '', 'error'),
+                ('0002', 'FlipAngle', 'missing'),
+                ('0002', 'ImageType', 'diff')]
+
+    def test_results_same_with_process_pool(self):
+        serial = header_checks.check_study(self.config, processes=1)
+        parallel = header_checks.check_study(self.config, processes=2)
+
+        assert self.get_issues(serial) == self.get_issues(parallel)
+        assert ('0001', 'EchoTime', 'diff') in self.get_issues(parallel)
+
+    def test_standards_read_once_per_site(self):
+        standards = header_checks.load_standards(self.config, set(['CMH']))
+
+        assert list(standards) == [('CMH', 'T1')]
+        assert 'SeriesNumber' not in standards[('CMH', 'T1')]['contents']
+        assert self.config.get_tags.call_count == 1
+
+    def test_diff_table_written_as_columns(self):
+        rows = header_checks.check_study(self.config, processes=1)
+        output = os.path.join(self.tmp, 'header_diffs.csv')
+
+        header_checks.write_diff_table(rows, output)
+
+        with open(output) as fh:
+            reader = csv.DictReader(fh)
+            table = list(reader)
+        assert reader.fieldnames == header_checks.DIFF_COLUMNS
+        image_type = [row for row in table if row['field'] == 'ImageType'][0]
+        assert json.loads(image_type['expected']) == ['ORIGINAL', 'PRIMARY']
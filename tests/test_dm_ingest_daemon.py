@@ -0,0 +1,175 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import importlib
+import logging
+
+from mock import MagicMock, patch
+
+logging.disable(logging.CRITICAL)
+
+# The daemon imports dm_link and dm_xnat_upload the way a script run from bin
+# would
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.path.pardir, 'bin'))
+daemon = importlib.import_module('bin.dm_ingest_daemon')
+
+
+class StopLoop(Exception):
+    pass
+
+
+def drain(work):
+    found = []
+    while not work._queue.empty():
+        found.append(work._queue.get())
+    return found
+
+
+class TestArchiveQueue(unittest.TestCase):
+
+    def test_archive_queued_once_until_done(self):
+        work = daemon.ArchiveQueue()
+
+        work.put('/zips/A.zip')
+        work.put('/zips/A.zip')
+        assert drain(work) == ['/zips/A.zip']
+
+        work.put('/zips/A.zip')
+        assert drain(work) == []
+
+        work.done('/zips/A.zip')
+        work.put('/zips/A.zip')
+        assert drain(work) == ['/zips/A.zip']
+
+    def test_failed_archive_retried_only_when_lookup_changes(self):
+        work = daemon.ArchiveQueue()
+        work.put('/zips/A.zip')
+        drain(work)
+        work.failed('/zips/A.zip', 100)
+
+        work.retry_failed(100)
+        assert drain(work) == []
+
+        work.retry_failed(200)
+        assert drain(work) == ['/zips/A.zip']
+
+        work.retry_failed(300)
+        assert drain(work) == []
+
+
+class TestRunWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.linked = {}
+        patcher = patch.object(daemon.link, 'already_linked', self.linked)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lookup = MagicMock()
+        self.lookup.refresh.return_value = 100
+
+    def run_once(self, work, archive):
+        work.put(archive)
+        work._queue.put(None)
+        daemon.run_worker(work, '/dicom', 'PatientName', None, self.lookup)
+
+    @patch.object(daemon.upload, 'process_archive')
+    @patch.object(daemon.link, 'link_archive')
+    def test_unlinked_archive_retried_after_lookup_changes(self, link_archive,
+            process_archive):
+        archive = os.path.realpath('/zips/A.zip')
+        link_archive.return_value = None
+        work = daemon.ArchiveQueue()
+
+        self.run_once(work, archive)
+        assert process_archive.call_count == 0
+
+        def link(archive, *args):
+            self.linked[archive] = '/dicom/STUDY_CMH_0001_01.zip'
+            return self.linked[archive]
+        link_archive.side_effect = link
+        self.lookup.refresh.return_value = 200
+        work.retry_failed(200)
+        work._queue.put(None)
+        daemon.run_worker(work, '/dicom', 'PatientName', None, self.lookup)
+
+        process_archive.assert_called_once_with(
+                '/dicom/STUDY_CMH_0001_01.zip')
+        work.retry_failed(300)
+        assert drain(work) == []
+
+    @patch.object(daemon.link, 'link_archive')
+    def test_archive_that_raises_is_marked_failed(self, link_archive):
+        link_archive.side_effect = IOError
+        work = daemon.ArchiveQueue()
+
+        self.run_once(work, '/zips/A.zip')
+
+        work.retry_failed(200)
+        assert drain(work) == ['/zips/A.zip']
+
+
+class TestWatchPolling(unittest.TestCase):
+
+    def setUp(self):
+        self.zips = tempfile.mkdtemp(prefix='ingest_daemon')
+        self.archive = os.path.join(self.zips, 'A.zip')
+        with open(self.archive, 'w') as fh:
+            fh.write('data')
+        self.lookup = MagicMock()
+        self.lookup.refresh.return_value = 100
+        self.clock = [1000.0]
+
+    def tearDown(self):
+        shutil.rmtree(self.zips)
+
+    def poll(self, work, polls, on_poll=None):
+        """
+        Runs watch_polling for the given number of polls, 10 seconds apart.
+        """
+        count = [0]
+
+        def sleep(seconds):
+            count[0] += 1
+            if count[0] >= polls:
+                raise StopLoop
+            self.clock[0] += seconds
+            if on_poll:
+                on_poll(count[0])
+
+        with patch.object(daemon.time, 'time', lambda: self.clock[0]), \
+                patch.object(daemon.time, 'sleep', sleep):
+            try:
+                daemon.watch_polling(self.zips, work, self.lookup, 10, 25)
+            except StopLoop:
+                pass
+
+    def test_archive_queued_once_after_settling(self):
+        work = daemon.ArchiveQueue()
+
+        self.poll(work, 3)
+        assert drain(work) == []
+
+        self.poll(work, 5)
+        assert drain(work) == [self.archive]
+        assert drain(work) == []
+
+    def test_changing_archive_not_queued(self):
+        work = daemon.ArchiveQueue()
+
+        def grow(poll_count):
+            with open(self.archive, 'a') as fh:
+                fh.write('more')
+
+        self.poll(work, 6, on_poll=grow)
+        assert drain(work) == []
+
+    def test_failed_archive_requeued_when_lookup_changes(self):
+        work = daemon.ArchiveQueue()
+        work.failed(self.archive, 50)
+
+        self.poll(work, 1)
+
+        assert drain(work) == [self.archive]
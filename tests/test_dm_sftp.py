@@ -0,0 +1,338 @@
+import os
+import time
+import shutil
+import zipfile
+import tempfile
+import unittest
+import importlib
+import logging
+
+import paramiko
+from mock import MagicMock, patch
+
+logging.disable(logging.CRITICAL)
+
+sftp = importlib.import_module('bin.dm_sftp')
+
+
+class FakeRemoteFile(object):
+    """
+    A remote file read from a local one. Reads stop at 'fail_at' bytes and
+    then raise IOError, like a dropped connection would.
+    """
+
+    def __init__(self, path, fail_at=None):
+        self.file = open(path, 'rb')
+        self.fail_at = fail_at
+        self.seeks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def seek(self, offset):
+        self.seeks.append(offset)
+        self.file.seek(offset)
+
+    def prefetch(self, size=None):
+        pass
+
+    def read(self, size=-1):
+        if self.fail_at is not None:
+            remaining = self.fail_at - self.file.tell()
+            if remaining <= 0 or size < 0:
+                raise IOError('Connection dropped')
+            size = min(size, remaining)
+        return self.file.read(size)
+
+
+class FakeSFTPClient(object):
+    """
+    Serves the files under a local folder as the remote server's files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.opened = {}
+        self.fail = {}
+
+    def local_path(self, remote_path):
+        return os.path.join(self.root, remote_path.lstrip('/'))
+
+    def listdir_attr(self, path):
+        folder = self.local_path(path)
+        return [paramiko.SFTPAttributes.from_stat(
+                os.stat(os.path.join(folder, name)), name)
+                for name in os.listdir(folder)]
+
+    def open(self, remote_path, mode='r'):
+        if self.fail.get(remote_path) == 0:
+            raise IOError('Permission denied')
+        remote = FakeRemoteFile(self.local_path(remote_path),
+                fail_at=self.fail.get(remote_path))
+        self.opened[remote_path] = remote
+        return remote
+
+    def close(self):
+        pass
+
+
+class SFTPTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp(prefix='dm_sftp_remote')
+        self.zips = tempfile.mkdtemp(prefix='dm_sftp_zips')
+        self.client = FakeSFTPClient(self.remote)
+        patcher = patch.object(sftp.paramiko.SFTPClient, 'from_transport',
+                return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.zips)
+
+    def add_remote(self, path, data, mtime=1500000000):
+        local = self.client.local_path(path)
+        if not os.path.isdir(os.path.dirname(local)):
+            os.makedirs(os.path.dirname(local))
+        with open(local, 'wb') as fh:
+            fh.write(data)
+        os.utime(local, (mtime, mtime))
+
+    def read(self, path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def downloader(self):
+        return sftp.Downloader(MagicMock(), 2)
+
+
+class TestDownloadNeeded(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.target = tempfile.mkstemp(prefix='dm_sftp')
+        os.close(fd)
+        os.utime(self.target, (1000, 1000))
+        self.entry = paramiko.SFTPAttributes()
+        self.entry.st_size = 10
+        self.entry.st_mtime = 2000
+
+    def tearDown(self):
+        if os.path.exists(self.target):
+            os.remove(self.target)
+
+    def test_missing_local_file_is_downloaded(self):
+        os.remove(self.target)
+        record = {'size': 10, 'mtime': 2000}
+
+        assert sftp.download_needed(record, self.entry, self.target)
+
+    def test_file_matching_manifest_is_skipped(self):
+        record = {'size': 10, 'mtime': 2000}
+
+        assert not sftp.download_needed(record, self.entry, self.target)
+
+    def test_changed_size_is_downloaded(self):
+        record = {'size': 5, 'mtime': 2000}
+
+        assert sftp.download_needed(record, self.entry, self.target)
+
+    def test_changed_mtime_is_downloaded(self):
+        record = {'size': 10, 'mtime': 1500}
+
+        assert sftp.download_needed(record, self.entry, self.target)
+
+    def test_without_manifest_older_local_copy_is_downloaded(self):
+        assert sftp.download_needed(None, self.entry, self.target)
+
+        os.utime(self.target, (3000, 3000))
+        assert not sftp.download_needed(None, self.entry, self.target)
+
+
+class TestDownloader(SFTPTestCase):
+
+    data = b'0123456789' * 100
+
+    def setUp(self):
+        super(TestDownloader, self).setUp()
+        self.add_remote('/exports/A.zip', self.data)
+        self.target = os.path.join(self.zips, 'A.zip')
+        self.part = sftp.get_part_name(self.target, len(self.data),
+                1500000000)
+
+    def fetch(self, size=None, mtime=1500000000):
+        size = len(self.data) if size is None else size
+        with self.downloader() as downloader:
+            return downloader.fetch([('/exports/A.zip', self.target, size,
+                    mtime)])
+
+    def test_download_renamed_into_place(self):
+        assert self.fetch() == [('/exports/A.zip', len(self.data),
+                1500000000)]
+
+        assert self.read(self.target) == self.data
+        assert os.path.getmtime(self.target) == 1500000000
+        assert os.listdir(self.zips) == ['A.zip']
+
+    def test_resumes_from_partial_download(self):
+        with open(self.part, 'wb') as fh:
+            fh.write(self.data[:300])
+
+        assert self.fetch()
+
+        assert self.client.opened['/exports/A.zip'].seeks == [300]
+        assert self.read(self.target) == self.data
+
+    def test_interrupted_download_kept_to_resume(self):
+        self.client.fail['/exports/A.zip'] = 400
+
+        assert self.fetch() == []
+
+        assert not os.path.exists(self.target)
+        assert self.read(self.part) == self.data[:400]
+
+    def test_size_mismatch_not_renamed(self):
+        # The file grew after it was listed
+        assert self.fetch(size=500) == []
+
+        assert not os.path.exists(self.target)
+
+    def test_part_larger_than_remote_restarted(self):
+        part = sftp.get_part_name(self.target, 500, 1500000000)
+        with open(part, 'wb') as fh:
+            fh.write(b'x' * 600)
+        self.add_remote('/exports/A.zip', self.data[:500])
+
+        assert self.fetch(size=500)
+
+        assert self.client.opened['/exports/A.zip'].seeks == [0]
+        assert self.read(self.target) == self.data[:500]
+
+    def test_part_of_old_version_removed(self):
+        old_part = sftp.get_part_name(self.target, 2000, 1400000000)
+        with open(old_part, 'wb') as fh:
+            fh.write(b'x' * 300)
+
+        assert self.fetch()
+
+        assert self.client.opened['/exports/A.zip'].seeks == [0]
+        assert self.read(self.target) == self.data
+        assert os.listdir(self.zips) == ['A.zip']
+
+
+class TestProcessDir(SFTPTestCase):
+
+    def test_failed_download_not_recorded(self):
+        self.add_remote('/exports/A.zip', b'a' * 100)
+        self.add_remote('/exports/B.zip', b'b' * 100)
+        self.client.fail['/exports/B.zip'] = 0
+        fetched = {}
+
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader)
+
+        assert fetched == {'/exports/A.zip': {'size': 100,
+                'mtime': 1500000000}}
+        assert os.listdir(self.zips) == ['A.zip']
+
+    def test_unchanged_file_skipped(self):
+        self.add_remote('/exports/A.zip', b'a' * 100)
+        fetched = {}
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader)
+        self.client.opened.clear()
+
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader)
+
+        assert self.client.opened == {}
+
+    def test_changed_file_downloaded_again(self):
+        self.add_remote('/exports/A.zip', b'a' * 100)
+        fetched = {}
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader)
+        self.add_remote('/exports/A.zip', b'c' * 120, mtime=1600000000)
+
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader)
+
+        assert fetched['/exports/A.zip'] == {'size': 120, 'mtime': 1600000000}
+        assert self.read(os.path.join(self.zips, 'A.zip')) == b'c' * 120
+
+    def test_dry_run_downloads_nothing(self):
+        self.add_remote('/exports/A.zip', b'a' * 100)
+        fetched = {}
+
+        with self.downloader() as downloader:
+            sftp.process_dir(self.client, '/exports', self.zips, fetched,
+                    downloader, dryrun=True)
+
+        assert os.listdir(self.zips) == []
+        assert fetched == {}
+
+
+class TestZipFolders(SFTPTestCase):
+
+    files = {'IM-0001.dcm': b'a' * 100, 'IM-0002.dcm': b'b' * 50,
+            'Series2/IM-0001.dcm': b'c' * 70, 'Series2/Sub/IM-0002.dcm': b''}
+
+    def setUp(self):
+        super(TestZipFolders, self).setUp()
+        for number, name in enumerate(sorted(self.files)):
+            self.add_remote('/exports/SESSION/' + name, self.files[name],
+                    mtime=1500000000 + number * 60)
+        self.target = os.path.join(self.zips, 'SESSION.zip')
+
+    def zip_folder(self):
+        with self.downloader() as downloader:
+            return downloader.zip_folders([('/exports/SESSION', self.target)])
+
+    def test_members_match_make_archive_layout(self):
+        old_zip = shutil.make_archive(os.path.join(self.zips, 'old'), 'zip',
+                self.client.local_path('/exports/SESSION'))
+        with zipfile.ZipFile(old_zip) as archive:
+            # Only newer pythons add entries for folders
+            expected = sorted(name for name in archive.namelist()
+                    if not name.endswith('/'))
+
+        assert self.zip_folder() == [self.target]
+
+        with zipfile.ZipFile(self.target) as archive:
+            assert sorted(archive.namelist()) == expected
+            for name, data in self.files.items():
+                assert archive.read(name) == data
+
+    def test_members_stored_with_remote_mtimes(self):
+        self.zip_folder()
+
+        with zipfile.ZipFile(self.target) as archive:
+            for number, name in enumerate(sorted(self.files)):
+                info = archive.getinfo(name)
+                assert info.compress_type == zipfile.ZIP_STORED
+                mtime = time.localtime(1500000000 + number * 60)[:6]
+                assert info.date_time == mtime
+
+    def test_mtime_before_1980_clamped(self):
+        self.add_remote('/exports/SESSION/IM-0001.dcm', b'a', mtime=0)
+
+        self.zip_folder()
+
+        with zipfile.ZipFile(self.target) as archive:
+            assert archive.getinfo('IM-0001.dcm').date_time == \
+                    time.localtime(sftp.ZIP_EPOCH)[:6]
+
+    def test_temp_zip_removed_on_failure(self):
+        self.client.fail['/exports/SESSION/Series2/IM-0001.dcm'] = 20
+
+        assert self.zip_folder() == []
+
+        assert os.listdir(self.zips) == []
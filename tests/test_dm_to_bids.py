@@ -0,0 +1,421 @@
+import os
+import glob
+import json
+import shutil
+import tempfile
+import unittest
+import importlib
+import logging
+
+import numpy as np
+import nibabel as nib
+from mock import patch
+
+logging.disable(logging.CRITICAL)
+
+to_bids = importlib.import_module('bin.dm_to_bids')
+scanid = importlib.import_module('datman.scanid')
+
+TAG_MAP = {'anat': ['T1'], 'fmri': ['RST', 'VN-SPRL-COMB', 'EMP'], 'dti': [],
+        'fmap': ['ECHO1', 'ECHO2']}
+ALL_TAGS = ['T1', 'RST', 'VN-SPRL-COMB', 'EMP', 'ECHO1', 'ECHO2']
+SUBJECT = 'STUDY_CMH_0001_01'
+FMAP = 'sub-CMH0001/ses-01/fmap/sub-CMH0001_ses-01_acq-CMH_{}_{}.{}'
+
+
+def result(subject, status, bytes=0):
+    return {'subject': subject, 'status': status, 'bytes': bytes, 'saved': 0,
+            'seconds': 1.0, 'error': ''}
+
+
+def fake_convert(subject_dir, nii_dir, bids_dir, all_tags, stats, **options):
+    """
+    Stands in for convert_subject in the --jobs workers. The subject name
+    picks the outcome.
+    """
+    if subject_dir.endswith('FAIL'):
+        raise RuntimeError('conversion broke')
+    stats['bytes'] += 10
+    return not subject_dir.endswith('SKIP')
+
+
+class TestReportResults(unittest.TestCase):
+
+    def test_skipped_subjects_are_not_failures(self):
+        results = [result('STUDY_CMH_0001_01', 'converted'),
+                result('STUDY_CMH_0002_01', 'skipped')]
+
+        assert to_bids.report_results(results, 10) == 0
+
+    def test_returns_number_failed(self):
+        results = [result('STUDY_CMH_0001_01', 'converted'),
+                result('STUDY_CMH_0002_01', 'skipped'),
+                result('STUDY_CMH_0003_01', 'failed'),
+                result('STUDY_CMH_0004_01', 'failed')]
+
+        assert to_bids.report_results(results, 10) == 2
+
+    def test_no_results(self):
+        assert to_bids.report_results([], 0) == 0
+
+
+class TestRunSubject(unittest.TestCase):
+
+    job = ('STUDY_CMH_0001_01', '/nii', '/bids', ['T1'])
+
+    @patch.object(to_bids, 'convert_subject')
+    def test_converted_subject(self, convert_subject):
+        convert_subject.return_value = True
+
+        stats = to_bids.run_subject(self.job)
+
+        assert stats['status'] == 'converted'
+        assert stats['subject'] == 'STUDY_CMH_0001_01'
+        assert stats['error'] == ''
+
+    @patch.object(to_bids, 'convert_subject')
+    def test_skipped_subject(self, convert_subject):
+        convert_subject.return_value = False
+
+        assert to_bids.run_subject(self.job)['status'] == 'skipped'
+
+    @patch.object(to_bids, 'convert_subject')
+    def test_exception_marks_subject_failed(self, convert_subject):
+        convert_subject.side_effect = ValueError('bad file')
+
+        stats = to_bids.run_subject(self.job)
+
+        assert stats['status'] == 'failed'
+        assert stats['error'] == 'bad file'
+
+    @patch.object(to_bids, 'convert_subject')
+    def test_exit_marks_subject_failed(self, convert_subject):
+        convert_subject.side_effect = SystemExit(1)
+
+        assert to_bids.run_subject(self.job)['status'] == 'failed'
+
+    @patch.object(to_bids, 'convert_subject')
+    def test_converts_with_options(self, convert_subject):
+        convert_subject.return_value = True
+        options = {'fs_dir': '/fs', 'fmriprep_fs_dir': None, 'rewrite': True}
+
+        with patch.object(to_bids, '_convert_options', options):
+            to_bids.run_subject(self.job)
+
+        args, kwargs = convert_subject.call_args
+        assert args == self.job
+        assert kwargs['rewrite'] is True
+        assert kwargs['fs_dir'] == '/fs'
+
+
+class TestConvertSubjects(unittest.TestCase):
+
+    args = ('/nii', '/bids', ['T1'])
+    options = {'fs_dir': '/fs', 'fmriprep_fs_dir': None, 'rewrite': False}
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix='dm_to_bids')
+        for name in ['_convert_options', 'materialize_mode', 'dummy_volumes',
+                'tag_map', '_worker_log_dir']:
+            patcher = patch.object(to_bids, name, getattr(to_bids, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    @patch.object(to_bids, 'convert_subject', fake_convert)
+    def test_serial_results_in_order(self):
+        results = to_bids.convert_subjects(['SUB1', 'SUB2SKIP', 'SUB3FAIL'],
+                1, self.log_dir, self.options, self.args)
+
+        assert [(r['subject'], r['status']) for r in results] == [
+                ('SUB1', 'converted'), ('SUB2SKIP', 'skipped'),
+                ('SUB3FAIL', 'failed')]
+        assert to_bids._convert_options == self.options
+        # Serial runs log to the main log only
+        assert os.listdir(self.log_dir) == []
+
+    @patch.object(to_bids, 'convert_subject', fake_convert)
+    def test_jobs_convert_every_subject(self):
+        subjects = ['SUB1', 'SUB2SKIP', 'SUB3FAIL', 'SUB4']
+
+        results = to_bids.convert_subjects(subjects, 2, self.log_dir,
+                self.options, self.args)
+
+        statuses = dict((r['subject'], r['status']) for r in results)
+        assert statuses == {'SUB1': 'converted', 'SUB2SKIP': 'skipped',
+                'SUB3FAIL': 'failed', 'SUB4': 'converted'}
+        assert sum(r['bytes'] for r in results) == 30
+        assert to_bids.report_results(results, 10) == 1
+
+    @patch.object(to_bids, 'convert_subject', fake_convert)
+    def test_jobs_log_each_subject_separately(self):
+        subjects = ['SUB1', 'SUB2']
+
+        to_bids.convert_subjects(subjects, 2, self.log_dir, self.options,
+                self.args)
+
+        logs = sorted(glob.glob(os.path.join(self.log_dir, '*.log')))
+        assert [log.split('dm_to_bids_')[-1] for log in logs] == [
+                'SUB1.log', 'SUB2.log']
+
+
+def entry(session, bids, size=10, mtime=100.0):
+    return {'session': session, 'size': size, 'mtime': mtime, 'bids': bids}
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fh:
+        fh.write('data')
+
+
+def fake_generate_fmap(cmd):
+    """
+    Stands in for CMH_generate_fmap.sh, which needs FSL. Makes the same
+    outputs and removes the echoes, the way the script does.
+    """
+    echo1, echo2, output = cmd[2:5]
+    shutil.copy(echo1, output + '_fieldmap.nii.gz')
+    shutil.copy(echo2, output + '_magnitude.nii.gz')
+    os.remove(echo1)
+    os.remove(echo2)
+
+
+class TestPlanSubject(unittest.TestCase):
+
+    type_folders = dict((folder, '/bids/sub-CMH0001/ses-01/{}/'.format(
+            folder)) for folder in ['anat', 'func', 'fmap', 'dwi'])
+
+    def setUp(self):
+        patcher = patch.object(to_bids, 'tag_map', TAG_MAP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_runs_count_up_through_sessions(self):
+        ses_ser_file_map = {
+            '01': {'03': ['STUDY_CMH_0001_01_01_RST_03_Rest.nii.gz',
+                    'STUDY_CMH_0001_01_01_RST_03_Rest.json']},
+            '02': {'02': ['STUDY_CMH_0001_01_02_RST_02_Rest.nii.gz']}}
+
+        plan = to_bids.plan_subject(ses_ser_file_map, ALL_TAGS,
+                self.type_folders)
+
+        func = '/bids/sub-CMH0001/ses-01/func/'
+        assert list(plan.items()) == [
+            ('STUDY_CMH_0001_01_01_RST_03_Rest.json', ('01', 'RST', func +
+                    'sub-CMH0001_ses-01_task-rest_acq-CMH_run-01_bold.json')),
+            ('STUDY_CMH_0001_01_01_RST_03_Rest.nii.gz', ('01', 'RST', func +
+                    'sub-CMH0001_ses-01_task-rest_acq-CMH_run-01_bold.nii.gz')),
+            ('STUDY_CMH_0001_01_02_RST_02_Rest.nii.gz', ('02', 'RST', func +
+                    'sub-CMH0001_ses-01_task-rest_acq-CMH_run-02_bold.nii.gz'))]
+
+    def test_unconvertable_file_has_no_bids_path(self):
+        ses_ser_file_map = {'01': {'05': [
+                'STUDY_CMH_0001_01_01_ECHO1_05_FMAP.json']}}
+
+        plan = to_bids.plan_subject(ses_ser_file_map, ALL_TAGS,
+                self.type_folders)
+
+        assert plan['STUDY_CMH_0001_01_01_ECHO1_05_FMAP.json'] == (
+                '01', 'ECHO1', None)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.bids_dir = tempfile.mkdtemp(prefix='dm_to_bids')
+        self.files = {'A.nii.gz': entry('01', 'sub/A.nii.gz'),
+                'B.nii.gz': entry('02', 'sub/B.nii.gz')}
+        self.manifest = {'files': dict(self.files), 'outputs': {
+                '01': ['sub/A.nii.gz', 'sub/A.json'],
+                '02': ['sub/B.nii.gz', 'sub/B_fieldmap.nii.gz']}}
+        for outputs in self.manifest['outputs'].values():
+            for output in outputs:
+                touch(os.path.join(self.bids_dir, output))
+
+    def tearDown(self):
+        shutil.rmtree(self.bids_dir)
+
+    def changed(self, files):
+        return to_bids.find_changed_sessions(files, self.manifest,
+                self.bids_dir)
+
+    def test_nothing_changed(self):
+        assert self.changed(self.files) == set()
+
+    def test_new_file_changes_session(self):
+        self.files['C.nii.gz'] = entry('02', 'sub/C.nii.gz')
+
+        assert self.changed(self.files) == set(['02'])
+
+    def test_changed_file_changes_session(self):
+        self.files['A.nii.gz'] = entry('01', 'sub/A.nii.gz', size=20)
+
+        assert self.changed(self.files) == set(['01'])
+
+    def test_removed_file_changes_session(self):
+        del self.files['B.nii.gz']
+
+        assert self.changed(self.files) == set(['02'])
+
+    def test_renumbered_run_changes_session(self):
+        self.files['B.nii.gz'] = entry('02', 'sub/B_run-02.nii.gz')
+
+        assert self.changed(self.files) == set(['02'])
+
+    def test_missing_output_changes_session(self):
+        os.remove(os.path.join(self.bids_dir, 'sub/B_fieldmap.nii.gz'))
+
+        assert self.changed(self.files) == set(['02'])
+
+    def test_remove_outputs_of_sessions_given(self):
+        os.remove(os.path.join(self.bids_dir, 'sub/B.nii.gz'))
+
+        to_bids.remove_outputs(self.manifest, set(['02']), self.bids_dir)
+
+        assert sorted(os.listdir(os.path.join(self.bids_dir, 'sub'))) == [
+                'A.json', 'A.nii.gz']
+
+    def test_read_manifest_records_outputs(self):
+        manifest_path = os.path.join(self.bids_dir, 'manifest.json')
+        to_bids.write_manifest(manifest_path, self.manifest['files'],
+                self.manifest['outputs'])
+
+        assert to_bids.read_manifest(manifest_path) == self.manifest
+
+    def test_outputs_of_old_manifest_are_the_bids_files(self):
+        manifest_path = os.path.join(self.bids_dir, 'manifest.json')
+        with open(manifest_path, 'w') as fh:
+            json.dump({'files': self.files}, fh)
+
+        assert to_bids.read_manifest(manifest_path)['outputs'] == {
+                '01': ['sub/A.nii.gz'], '02': ['sub/B.nii.gz']}
+
+    def test_missing_manifest(self):
+        manifest_path = os.path.join(self.bids_dir, 'manifest.json')
+
+        assert to_bids.read_manifest(manifest_path) is None
+
+    def test_unreadable_manifest_is_empty(self):
+        manifest_path = os.path.join(self.bids_dir, 'manifest.json')
+        with open(manifest_path, 'w') as fh:
+            fh.write('{"files": ')
+
+        assert to_bids.read_manifest(manifest_path) == {'files': {},
+                'outputs': {}}
+
+
+class TestConvertSubject(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dm_to_bids')
+        self.nii_dir = os.path.join(self.root, 'nii')
+        self.bids_dir = os.path.join(self.root, 'bids')
+        os.makedirs(os.path.join(self.nii_dir, SUBJECT))
+        os.makedirs(self.bids_dir)
+        for name, value in [('tag_map', TAG_MAP), ('dummy_volumes', {}),
+                ('materialize_mode', 'copy')]:
+            patcher = patch.object(to_bids, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(to_bids.datman.utils, 'run',
+                side_effect=fake_generate_fmap)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.add_scan('01', 'RST', 3, 'Rest', (4, 4, 2, 6))
+        for session in ['01', '02']:
+            self.add_scan(session, 'ECHO1', 10 * int(session), 'FMAP')
+            self.add_scan(session, 'ECHO2', 10 * int(session) + 1, 'FMAP')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def nii_path(self, session, tag, series, description):
+        return os.path.join(self.nii_dir, SUBJECT, '{}_{}_{}_{}_{}'.format(
+                SUBJECT, session, tag, series, description))
+
+    def add_scan(self, session, tag, series, description,
+            shape=(4, 4, 2, 4)):
+        base = self.nii_path(session, tag, '{:02}'.format(series), description)
+        nib.Nifti1Image(np.ones(shape, dtype=np.int16), np.eye(4)).to_filename(
+                base + '.nii.gz')
+        with open(base + '.json', 'w') as fh:
+            json.dump({'RepetitionTime': 2.0}, fh)
+
+    def convert(self, rewrite=False):
+        stats = {'bytes': 0, 'saved': 0}
+        return to_bids.convert_subject(SUBJECT, self.nii_dir, self.bids_dir,
+                ALL_TAGS, stats, rewrite=rewrite)
+
+    def fmaps(self):
+        fmap_dir = os.path.join(self.bids_dir, 'sub-CMH0001/ses-01/fmap')
+        return sorted(os.listdir(fmap_dir))
+
+    def manifest(self):
+        return to_bids.read_manifest(os.path.join(self.bids_dir,
+                'sub-CMH0001/ses-01', to_bids.MANIFEST_NAME))
+
+    def test_unchanged_subject_is_skipped(self):
+        assert self.convert()
+
+        assert not self.convert()
+
+    def test_generated_field_maps_are_recorded(self):
+        self.convert()
+
+        outputs = self.manifest()['outputs']
+        assert outputs['02'] == [FMAP.format('run-02', 'fieldmap', 'json'),
+                FMAP.format('run-02', 'fieldmap', 'nii.gz'),
+                FMAP.format('run-02', 'magnitude', 'nii.gz')]
+
+    def test_renumbered_field_maps_leave_no_stale_files(self):
+        self.convert()
+        for path in glob.glob(self.nii_path('01', 'ECHO*', '*', '*')):
+            os.remove(path)
+
+        assert self.convert()
+
+        assert self.fmaps() == ['sub-CMH0001_ses-01_acq-CMH_run-01_'
+                + name for name in ['fieldmap.json', 'fieldmap.nii.gz',
+                'magnitude.nii.gz']]
+        assert sorted(self.manifest()['outputs']) == ['01', '02']
+        assert self.manifest()['outputs']['02'][0] == FMAP.format('run-01',
+                'fieldmap', 'json')
+
+    def test_removed_session_is_dropped_from_manifest(self):
+        self.convert()
+        for path in glob.glob(self.nii_path('02', 'ECHO*', '*', '*')):
+            os.remove(path)
+
+        assert self.convert()
+
+        assert sorted(self.manifest()['outputs']) == ['01']
+        assert 'run-02' not in ' '.join(self.fmaps())
+
+    def test_missing_output_reconverts_its_session(self):
+        self.convert()
+        magnitude = os.path.join(self.bids_dir,
+                FMAP.format('run-02', 'magnitude', 'nii.gz'))
+        os.remove(magnitude)
+
+        assert self.convert()
+
+        assert os.path.exists(magnitude)
+
+    def test_rewrite_converts_unchanged_subject(self):
+        self.convert()
+
+        assert self.convert(rewrite=True)
+
+    def test_subject_without_manifest_needs_rewrite(self):
+        self.convert()
+        os.remove(os.path.join(self.bids_dir, 'sub-CMH0001/ses-01',
+                to_bids.MANIFEST_NAME))
+
+        assert not self.convert()
+        assert self.convert(rewrite=True)
+        assert self.manifest() is not None
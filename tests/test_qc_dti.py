@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+from nose.tools import raises
+
+import datman.qc.dti as dti_qc
+
+logging.disable(logging.CRITICAL)
+
+
+class TestDTIMetrics(unittest.TestCase):
+
+    bvals = np.array([0, 0, 0] + [1000] * 12 + [0] + [2000] * 8)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dti_qc')
+        rng = np.random.RandomState(0)
+        brain = np.zeros((12, 12, 8))
+        brain[2:10, 2:10, 1:7] = 1
+        data = np.empty(brain.shape + (len(self.bvals),))
+        for vol, bval in enumerate(self.bvals):
+            noise = 1 + rng.normal(0, 0.02, brain.shape)
+            data[..., vol] = brain * 1000 * np.exp(-bval * 0.0008) * noise
+        data[:, :, 3, 5] *= 0.3
+        data[:, :, 4, 20] *= 2
+        self.data = data
+
+        self.nifti = os.path.join(self.tmp, 'dti.nii.gz')
+        self.bval = os.path.join(self.tmp, 'dti.bval')
+        nib.Nifti1Image(data.astype(np.int16), np.eye(4)).to_filename(
+                self.nifti)
+        np.savetxt(self.bval, self.bvals[np.newaxis], fmt='%d')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shells_group_similar_bvals(self):
+        shells = dti_qc.get_shells(np.array([0, 5, 995, 1005, 2010]))
+        assert list(shells) == [0, 0, 1000, 1000, 2000]
+
+    def test_slice_means_independent_of_chunk_size(self):
+        means_a = dti_qc.get_slice_means(self.nifti, self.bvals,
+                chunk_size=4)[0]
+        means_b = dti_qc.get_slice_means(self.nifti, self.bvals,
+                chunk_size=100)[0]
+
+        assert means_a.shape == (len(self.bvals), 8)
+        assert np.allclose(means_a, means_b)
+
+    def test_finds_spikes_and_dropouts(self):
+        outliers, stats = dti_qc.compute_metrics(self.nifti, self.bval,
+                chunk_size=5)
+
+        found = [item[:4] for item in outliers]
+        assert found == [(5, 3, 1000, 'dropout'), (20, 4, 2000, 'spike')]
+        assert stats['spike_count'] == 1
+        assert stats['dropout_count'] == 1
+        assert stats['b0_volumes'] == 4
+        assert stats['directions'] == 20
+        assert stats['shells'] == '1000 2000'
+
+    def test_run_qc_writes_outputs(self):
+        prefix = os.path.join(self.tmp, 'dti')
+
+        dti_qc.run_qc(self.nifti, self.bval, prefix)
+
+        with open(prefix + '_spikecount.csv') as fh:
+            lines = fh.read().splitlines()
+        assert lines[0] == 'volume,slice,bval,type,ratio'
+        assert lines[1].startswith('5,3,1000,dropout,')
+        with open(prefix + '_stats.csv') as fh:
+            assert 'spike_count,1' in fh.read().splitlines()
+
+    @raises(ValueError)
+    def test_raises_exception_when_bvals_dont_match_volumes(self):
+        dti_qc.get_slice_means(self.nifti, self.bvals[:-1])
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+
+import datman.qc.fmri as fmri_qc
+
+logging.disable(logging.CRITICAL)
+
+
+class TestFMRIMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='fmri_qc')
+        rng = np.random.RandomState(0)
+        # Noisy signal with a linear drift, surrounded by empty voxels
+        data = rng.normal(100, 5, (6, 7, 5, 40)) + 0.5 * np.arange(40)
+        data[:1] = 0
+        self.data = data.astype(np.int16)
+        self.nifti = os.path.join(self.tmp, 'bold.nii.gz')
+        image = nib.Nifti1Image(self.data, np.eye(4))
+        image.header.set_slope_inter(2, 1)
+        image.to_filename(self.nifti)
+        self.values = np.asanyarray(nib.load(self.nifti).dataobj).astype(float)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_chunks_match_whole_image(self):
+        chunks = [chunk for _, chunk in fmri_qc.iter_chunks(
+                nib.load(self.nifti), chunk_size=7)]
+
+        assert len(chunks) == 6
+        assert np.allclose(np.concatenate(chunks, axis=3), self.values)
+
+    def test_chunk_size_does_not_change_results(self):
+        maps_a, stats_a = fmri_qc.compute_metrics(self.nifti, chunk_size=3)
+        maps_b, stats_b = fmri_qc.compute_metrics(self.nifti, chunk_size=40)
+
+        for name in maps_a:
+            assert np.allclose(maps_a[name], maps_b[name])
+        assert np.allclose(list(stats_a.values()), list(stats_b.values()))
+
+    def test_maps_match_direct_computation(self):
+        maps, stats = fmri_qc.compute_metrics(self.nifti, chunk_size=8)
+
+        mean = self.values.mean(axis=3)
+        std = self.values.std(axis=3, ddof=1)
+        design = np.vander(np.arange(40), 3)
+        series = self.values.reshape(-1, 40).T
+        fit = np.linalg.lstsq(design, series, rcond=-1)[0]
+        residual_std = np.sqrt(((series - design.dot(fit)) ** 2).sum(axis=0)
+                / 37).reshape(mean.shape)
+
+        assert stats['scan_length'] == 40
+        assert np.allclose(maps['mean'], mean)
+        assert np.allclose(maps['tsnr'][1:], mean[1:] / std[1:])
+        assert np.allclose(maps['sfnr'][1:], mean[1:] / residual_std[1:])
+        # Removing the drift gives a higher SFNR than tSNR
+        assert stats['mean_sfnr'] > stats['mean_tsnr']
+        assert not maps['sfnr'][0].any()
+
+    def test_run_qc_writes_outputs(self):
+        prefix = os.path.join(self.tmp, 'bold')
+        scan_length = prefix + '_scanlengths.csv'
+
+        fmri_qc.run_qc(self.nifti, prefix)
+        fmri_qc.write_scan_length(self.nifti, scan_length)
+
+        for suffix in ['_sfnr.nii.gz', '_corr.nii.gz', '_tsnr.nii.gz']:
+            assert nib.load(prefix + suffix).shape == (6, 7, 5)
+        with open(prefix + '_stats.csv') as fh:
+            assert fh.readline().strip() == 'metric,value'
+            assert fh.readline().strip() == 'scan_length,40'
+        with open(scan_length) as fh:
+            assert fh.read().splitlines()[1] == '{},40'.format(self.nifti)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import datman.qc.manifest as qc_manifest
+
+logging.disable(logging.CRITICAL)
+
+
+class TestQCManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='qc_manifest')
+        self.nii = os.path.join(self.tmp, 'nii')
+        self.qc = os.path.join(self.tmp, 'qc')
+        os.makedirs(self.nii)
+        os.makedirs(self.qc)
+        self.t1 = self.make_file(self.nii,
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz', 'T1 data')
+        self.dti = self.make_file(self.nii,
+                'STUDY_CMH_0001_01_01_DTI60_05_Ax-DTI.nii.gz', 'DTI data')
+        self.outputs = [
+                self.make_file(self.qc,
+                    'STUDY_CMH_0001_01_01_T1_02_SagT1.png', 'png'),
+                self.make_file(self.qc,
+                    'STUDY_CMH_0001_01_01_DTI60_05_Ax-DTI_stats.csv', 'csv')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_file(self, folder, name, contents):
+        path = os.path.join(folder, name)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def make_manifest(self):
+        manifest = qc_manifest.QCManifest(self.qc)
+        manifest.update(self.t1, '<img t1>')
+        manifest.update(self.dti, '<img dti>')
+        manifest.set_inputs([self.t1, self.dti])
+        manifest.save()
+        return qc_manifest.QCManifest(self.qc)
+
+    def test_outputs_found_by_series_name(self):
+        manifest = qc_manifest.QCManifest(self.qc)
+        assert manifest.find_outputs(self.t1) == [
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.png']
+
+    def test_unchanged_inputs_reuse_fragments(self):
+        manifest = self.make_manifest()
+
+        assert manifest.exists()
+        assert not manifest.inputs_changed([self.t1, self.dti])
+        assert manifest.get_fragment(self.t1) == '<img t1>'
+
+    def test_new_series_marks_inputs_changed(self):
+        manifest = self.make_manifest()
+        new = self.make_file(self.nii,
+                'STUDY_CMH_0001_02_01_T1_03_SagT1.nii.gz', 'repeat')
+
+        assert manifest.inputs_changed([self.t1, self.dti, new])
+        assert manifest.get_fragment(new) is None
+        assert manifest.get_fragment(self.t1) == '<img t1>'
+
+    def test_touched_input_is_still_current(self):
+        manifest = self.make_manifest()
+        stat = os.stat(self.t1)
+        os.utime(self.t1, (stat.st_atime, stat.st_mtime + 100))
+
+        assert manifest.inputs_changed([self.t1, self.dti])
+        assert manifest.get_fragment(self.t1) == '<img t1>'
+        assert manifest.invalidate(self.t1) == []
+        assert os.path.exists(self.outputs[0])
+
+    def test_changed_input_removes_old_outputs(self):
+        manifest = self.make_manifest()
+        self.make_file(self.nii, os.path.basename(self.t1), 'New T1 data')
+
+        assert manifest.get_fragment(self.t1) is None
+        assert manifest.invalidate(self.t1) == [
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.png']
+        assert not os.path.exists(self.outputs[0])
+        assert os.path.exists(self.outputs[1])
+
+    def test_missing_output_makes_series_out_of_date(self):
+        manifest = self.make_manifest()
+        os.remove(self.outputs[1])
+
+        assert manifest.get_fragment(self.dti) is None
+
+    def test_prune_drops_removed_series(self):
+        manifest = self.make_manifest()
+        manifest.prune([self.t1])
+        assert list(manifest.series) == [os.path.basename(self.t1)]
+
+    def test_unreadable_manifest_ignored(self):
+        self.make_file(self.qc, qc_manifest.MANIFEST_NAME, '{not json')
+        manifest = qc_manifest.QCManifest(self.qc)
+        assert not manifest.exists()
+        assert manifest.inputs_changed([self.t1])
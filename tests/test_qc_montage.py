@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+from PIL import Image
+
+import datman.qc.montage as montage
+
+logging.disable(logging.CRITICAL)
+
+
+class TestMontage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='montage')
+        data = np.zeros((20, 24, 10, 3), dtype=np.int16)
+        # A bright block in the left, anterior, superior corner
+        data[:5, -6:, -3:, 0] = 100
+        data[5:15, 5:20, 2:8, 0] = 50
+        data[..., 1:] = 1000
+        self.nifti = os.path.join(self.tmp, 'image.nii.gz')
+        nib.save(nib.Nifti1Image(data, np.diag([2, 2, 4, 1])), self.nifti)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_load_volume_uses_first_volume_in_ras(self):
+        image = nib.load(self.nifti)
+        flipped = nib.Nifti1Image(np.asanyarray(image.dataobj)[::-1],
+                np.diag([-2, 2, 4, 1]))
+
+        data, zooms = montage.load_volume(flipped)
+
+        assert data.shape == (20, 24, 10)
+        assert list(zooms) == [2, 2, 4]
+        assert data[0, -1, -1] == 100
+
+    def test_scale_intensity_handles_empty_volume(self):
+        scaled = montage.scale_intensity(np.zeros((3, 3, 3)))
+        assert scaled.dtype == np.uint8
+        assert not scaled.any()
+
+    def test_get_slice_makes_pixels_square(self):
+        volume = np.zeros((20, 24, 10), dtype=np.uint8)
+        plane = montage.get_slice(volume, [2, 2, 4], 0, 10)
+        # 24 x 10 voxels of 2mm x 4mm -> 20 rows of 24 columns
+        assert plane.shape == (20, 24)
+
+    def test_axial_montage_writes_png_of_requested_width(self):
+        output = os.path.join(self.tmp, 'raw.png')
+
+        montage.axial_montage(self.nifti, output, gap=2, width=300)
+
+        picture = Image.open(output)
+        assert picture.size[0] == 300
+        assert picture.mode == 'L'
+
+    def test_orthogonal_montage_joins_nine_slices(self):
+        output = os.path.join(self.tmp, 'montage.png')
+
+        montage.orthogonal_montage(self.nifti, output)
+
+        # 3 sagittal (24 wide) + 3 coronal (20) + 3 axial (20) slices
+        picture = Image.open(output)
+        assert picture.size == (3 * 24 + 3 * 20 + 3 * 20, 24)
@@ -89,14 +89,14 @@ class TestScan(unittest.TestCase):
         assert subject.niftis == []
         assert subject.dicoms == []
 
-    @patch('glob.glob')
-    def test_niftis_with_either_extension_type_found(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_niftis_with_either_extension_type_found(self, mock_list):
         simple_ext = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         complex_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.nii.gz".format(self.good_name)
         wrong_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.bvec".format(self.good_name)
 
         nii_list = [simple_ext, complex_ext, wrong_ext]
-        mock_glob.return_value = nii_list
+        mock_list.return_value = nii_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -106,27 +106,28 @@ class TestScan(unittest.TestCase):
         assert sorted(found_niftis) == sorted(expected)
 
     @raises(datman.scanid.ParseException)
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_subject_series_with_nondatman_name_causes_parse_exception(self,
-            mock_glob):
+            mock_list):
         well_named = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         badly_named1 = "{}_01_DTI60-1000_05_Ax-DTI-60.nii".format(self.bad_name)
         badly_named2 = "{}_01_T2_07.nii".format(self.good_name)
 
         nii_list = [well_named, badly_named1, badly_named2]
-        mock_glob.return_value = nii_list
+        mock_list.return_value = nii_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
+        subject.niftis
 
-    @patch('glob.glob')
-    def test_dicoms_lists_only_dicom_files(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_dicoms_lists_only_dicom_files(self, mock_list):
         dicom1 = "{}_01_T1_02_SagT1-BRAVO.dcm".format(self.good_name)
         dicom2 = "{}_01_DTI60-1000_05_Ax-DTI-60.dcm".format(self.good_name)
         nifti = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         wrong_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.bvec".format(self.good_name)
 
         dcm_list = [dicom1, nifti, dicom2, wrong_ext]
-        mock_glob.return_value = dcm_list
+        mock_list.return_value = dcm_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -135,37 +136,37 @@ class TestScan(unittest.TestCase):
 
         assert sorted(found_dicoms) == sorted(expected)
 
-    @patch('glob.glob')
-    def test_nii_tags_lists_all_tags(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_nii_tags_lists_all_tags(self, mock_list):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.nii"
 
-        mock_glob.return_value = [T1, DTI]
+        mock_list.return_value = [T1, DTI]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert sorted(subject.nii_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.dcm_tags == []
 
-    @patch('glob.glob')
-    def test_dcm_tags_lists_all_tags(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_dcm_tags_lists_all_tags(self, mock_list):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [T1, DTI]
+        mock_list.return_value = [T1, DTI]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert sorted(subject.dcm_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.nii_tags == []
 
-    @patch('glob.glob')
-    def test_get_tagged_nii_finds_all_matching_series(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_get_tagged_nii_finds_all_matching_series(self, mock_list):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
         DTI = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.nii"
 
-        mock_glob.return_value = [T1_1, DTI, T1_2]
+        mock_list.return_value = [T1_1, DTI, T1_2]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -177,13 +178,13 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
-    def test_get_tagged_dcm_finds_all_matching_series(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_get_tagged_dcm_finds_all_matching_series(self, mock_list):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.dcm"
         DTI = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [T1_1, DTI, T1_2]
+        mock_list.return_value = [T1_1, DTI, T1_2]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -195,14 +196,35 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
-    def test_get_tagged_X_returns_empty_list_when_no_tag_files(self, mock_glob):
+    @patch('datman.scan.list_files')
+    def test_get_tagged_X_returns_empty_list_when_no_tag_files(self, mock_list):
         nifti = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
         dicom = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [nifti, dicom]
+        mock_list.return_value = [nifti, dicom]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert subject.get_tagged_nii('DTI') == []
         assert subject.get_tagged_dcm('T1') == []
+
+    @patch('datman.scan.list_files')
+    def test_series_not_read_until_needed(self, mock_list):
+        subject = datman.scan.Scan(self.good_name, self.config)
+
+        assert not mock_list.called
+
+    @patch('datman.scan.list_files')
+    def test_refresh_rereads_directory_contents(self, mock_list):
+        T1 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
+        DTI = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.nii.gz"
+
+        mock_list.return_value = [T1]
+        subject = datman.scan.Scan(self.good_name, self.config)
+        assert subject.nii_tags == ['T1']
+
+        mock_list.return_value = [T1, DTI]
+        assert subject.nii_tags == ['T1']
+
+        subject.refresh()
+        assert sorted(subject.nii_tags) == ['DTI', 'T1']
@@ -2,11 +2,18 @@
 
 
 import os
+import errno
+import multiprocessing
+import shutil
+import tempfile
 
 
 import unittest
 import logging
 
+import numpy as np
+import nibabel as nib
+
 from nose.tools import raises
 from mock import patch
 
@@ -62,3 +69,278 @@ class TestCheckDependencyConfigured(unittest.TestCase):
 
     # def test_exception_contains_program_name(self):
     #     assert False
+
+
+class TestQCMetadata(unittest.TestCase):
+
+    checklist = ["qc_STUDY_CMH_0001_01.html signed off by me\n",
+                 "qc_STUDY_CMH_0002_01.html\n",
+                 "qc_STUDY_CMH_0001_01.html duplicate entry\n"]
+    blacklist = ["series\treason\n",
+                 "STUDY_CMH_0001_01_01_T1_02_SagT1 motion\n",
+                 "STUDY_CMH_0001_01_02_DTI60_05_Ax-DTI too noisy\n",
+                 "STUDY_CMH_0002_01_01_T2_03_T2 wrong fov\n",
+                 "not_a_scan_name some comment\n"]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checklist_path = os.path.join(self.tmpdir, 'checklist.csv')
+        self.blacklist_path = os.path.join(self.tmpdir, 'blacklist.csv')
+        with open(self.checklist_path, 'w') as checklist:
+            checklist.writelines(self.checklist)
+        with open(self.blacklist_path, 'w') as blacklist:
+            blacklist.writelines(self.blacklist)
+        self.metadata = utils.QCMetadata(checklist_path=self.checklist_path,
+                blacklist_path=self.blacklist_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_is_blacklisted_accepts_full_paths(self):
+        nii = '/some/path/STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz'
+        assert self.metadata.is_blacklisted(nii)
+        assert not self.metadata.is_blacklisted(
+                'STUDY_CMH_0001_01_01_T1_03_SagT1.nii.gz')
+
+    def test_blacklist_indexed_by_subject_and_session(self):
+        entries = self.metadata.get_blacklist(subject='STUDY_CMH_0001_01')
+        assert sorted(entries) == ['STUDY_CMH_0001_01_01_T1_02_SagT1',
+                'STUDY_CMH_0001_01_02_DTI60_05_Ax-DTI']
+        entries = self.metadata.get_blacklist(subject='STUDY_CMH_0001_01_02')
+        assert entries == {'STUDY_CMH_0001_01_02_DTI60_05_Ax-DTI':
+                'too noisy'}
+
+    def test_matches_read_blacklist_and_read_checklist(self):
+        assert self.metadata.get_blacklist() == \
+                utils.read_blacklist(path=self.blacklist_path)
+        assert self.metadata.get_checklist() == \
+                utils.read_checklist(path=self.checklist_path)
+        assert utils.read_checklist(path=self.checklist_path) == {
+                'STUDY_CMH_0001_01': 'signed off by me',
+                'STUDY_CMH_0002_01': ''}
+
+    def test_is_signed_off(self):
+        assert self.metadata.is_signed_off('STUDY_CMH_0001_01_01')
+        assert not self.metadata.is_signed_off('STUDY_CMH_0002_01')
+        assert not self.metadata.is_signed_off('STUDY_CMH_0003_01')
+
+    def test_file_only_parsed_again_after_it_changes(self):
+        with patch('datman.utils._merge_metadata',
+                wraps=utils._merge_metadata) as mock_parse:
+            # Cache is keyed on the parser, so use a fresh path
+            path = os.path.join(self.tmpdir, 'other_checklist.csv')
+            shutil.copy(self.checklist_path, path)
+            metadata = utils.QCMetadata(checklist_path=path,
+                    blacklist_path=self.blacklist_path)
+            for _ in range(3):
+                metadata.is_signed_off('STUDY_CMH_0002_01')
+            utils.update_checklist({'STUDY_CMH_0002_01': 'reviewed'},
+                    path=path)
+            assert metadata.is_signed_off('STUDY_CMH_0002_01')
+        assert mock_parse.call_count == 2
+
+    def test_returned_dicts_do_not_modify_cache(self):
+        entries = self.metadata.get_checklist()
+        entries['STUDY_CMH_0003_01'] = ''
+        assert 'STUDY_CMH_0003_01' not in self.metadata.get_checklist()
+
+    @raises(utils.MetadataException)
+    def test_raises_MetadataException_when_file_missing(self):
+        os.remove(self.blacklist_path)
+        self.metadata.get_blacklist()
+
+
+class TestMetadataJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checklist = os.path.join(self.tmpdir, 'checklist.csv')
+        self.blacklist = os.path.join(self.tmpdir, 'blacklist.csv')
+        with open(self.checklist, 'w') as checklist:
+            checklist.write("qc_STUDY_CMH_0001_01.html signed off\n")
+        with open(self.blacklist, 'w') as blacklist:
+            blacklist.write("series\treason\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_updates_are_appended_to_journal(self):
+        utils.update_checklist({'STUDY_CMH_0002_01': ''}, path=self.checklist)
+        with open(self.checklist) as checklist:
+            assert checklist.read() == "qc_STUDY_CMH_0001_01.html signed off\n"
+        assert utils.read_checklist(path=self.checklist) == {
+                'STUDY_CMH_0001_01': 'signed off',
+                'STUDY_CMH_0002_01': ''}
+
+    def test_empty_comment_does_not_replace_existing_comment(self):
+        utils.update_checklist({'STUDY_CMH_0001_01_01': ''},
+                path=self.checklist)
+        utils.update_checklist({'STUDY_CMH_0002_01': 'reviewed'},
+                path=self.checklist)
+        utils.update_checklist({'STUDY_CMH_0002_01': ''}, path=self.checklist)
+        assert utils.read_checklist(path=self.checklist) == {
+                'STUDY_CMH_0001_01': 'signed off',
+                'STUDY_CMH_0002_01': 'reviewed'}
+
+    def test_compaction_writes_canonical_file(self):
+        utils.update_blacklist({'STUDY_CMH_0002_01_01_T1_02_SagT1': 'motion',
+                'STUDY_CMH_0001_01_01_T1_02_SagT1': 'wrong'},
+                path=self.blacklist)
+        utils.update_blacklist({'STUDY_CMH_0002_01_01_T1_02_SagT1': 'ghosts'},
+                path=self.blacklist)
+        utils.compact_blacklist(path=self.blacklist)
+
+        with open(self.blacklist) as blacklist:
+            assert blacklist.readlines() == ['series\treason\n',
+                    'STUDY_CMH_0001_01_01_T1_02_SagT1 wrong\n',
+                    'STUDY_CMH_0002_01_01_T1_02_SagT1 ghosts\n']
+        assert os.path.getsize(self.blacklist + '.journal') == 0
+
+    @patch('datman.utils.METADATA_JOURNAL_SIZE', 200)
+    def test_journal_compacted_automatically_when_large(self):
+        for num in range(1, 20):
+            utils.update_checklist({'STUDY_CMH_{:04}_01'.format(num): 'ok'},
+                    path=self.checklist)
+        assert os.path.getsize(self.checklist + '.journal') < 200
+        assert len(utils.read_checklist(path=self.checklist)) == 19
+
+    def test_concurrent_updates_are_not_lost(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(_add_checklist_entry, [(self.checklist, num)
+                    for num in range(2, 42)])
+        finally:
+            pool.close()
+            pool.join()
+        assert len(utils.read_checklist(path=self.checklist)) == 41
+
+    def test_write_metadata_discards_journal(self):
+        utils.update_checklist({'STUDY_CMH_0002_01': ''}, path=self.checklist)
+        utils.write_metadata(["qc_STUDY_CMH_0003_01.html\n"], self.checklist)
+        assert utils.read_checklist(path=self.checklist) == {
+                'STUDY_CMH_0003_01': ''}
+
+
+class TestMaterialize(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='materialize')
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.src, 'mri'))
+        self.source = os.path.join(self.src, 'mri', 'T1.mgz')
+        with open(self.source, 'w') as fh:
+            fh.write('original')
+        self.dest = os.path.join(self.tmp, 'T1.mgz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(path) as fh:
+            return fh.read()
+
+    def test_hardlink_shares_data(self):
+        used = utils.materialize(self.source, self.dest, 'hardlink')
+        assert used == 'hardlink'
+        assert os.path.samefile(self.source, self.dest)
+
+    def test_symlink_is_relative(self):
+        utils.materialize(self.source, self.dest, 'symlink')
+        assert os.readlink(self.dest) == os.path.join('src', 'mri', 'T1.mgz')
+        assert self.read(self.dest) == 'original'
+
+    @patch('datman.utils._reflink')
+    def test_falls_back_to_copy_when_links_unsupported(self, mock_reflink):
+        mock_reflink.side_effect = IOError(errno.EOPNOTSUPP, 'Not supported')
+        used = utils.materialize(self.source, self.dest, 'reflink')
+        assert used == 'copy'
+        assert not os.path.samefile(self.source, self.dest)
+        assert self.read(self.dest) == 'original'
+
+    def test_replaces_existing_link_without_writing_through(self):
+        utils.materialize(self.source, self.dest, 'symlink')
+        other = os.path.join(self.tmp, 'other')
+        with open(other, 'w') as fh:
+            fh.write('other')
+        utils.materialize(other, self.dest, 'copy')
+        assert self.read(self.source) == 'original'
+        assert self.read(self.dest) == 'other'
+
+    def test_unshare_gives_file_own_copy(self):
+        utils.materialize(self.source, self.dest, 'hardlink')
+        assert utils.unshare(self.dest)
+        with open(self.dest, 'w') as fh:
+            fh.write('changed')
+        assert self.read(self.source) == 'original'
+        assert not utils.unshare(self.dest)
+
+    def test_tree_counts_bytes_saved(self):
+        dest = os.path.join(self.tmp, 'dest')
+        updated, unchanged, saved = utils.sync_tree(self.src, dest,
+                'hardlink')
+        assert (updated, unchanged) == (1, 0)
+        assert saved == len('original')
+        assert os.path.samefile(self.source,
+                os.path.join(dest, 'mri', 'T1.mgz'))
+
+    def test_sync_only_updates_changed_files(self):
+        dest = os.path.join(self.tmp, 'dest')
+        utils.sync_tree(self.src, dest, 'copy')
+        added = os.path.join(self.src, 'mri', 'aseg.mgz')
+        with open(added, 'w') as fh:
+            fh.write('new')
+
+        updated, unchanged, saved = utils.sync_tree(self.src, dest, 'copy')
+
+        assert (updated, unchanged, saved) == (1, 1, 0)
+        assert self.read(os.path.join(dest, 'mri', 'aseg.mgz')) == 'new'
+
+    def test_sync_replaces_file_that_changed_size(self):
+        dest = os.path.join(self.tmp, 'dest')
+        utils.sync_tree(self.src, dest, 'copy')
+        with open(self.source, 'w') as fh:
+            fh.write('rerun recon')
+
+        assert utils.sync_tree(self.src, dest, 'copy')[:2] == (1, 0)
+        assert self.read(os.path.join(dest, 'mri', 'T1.mgz')) == 'rerun recon'
+
+    @raises(ValueError)
+    def test_raises_exception_for_unknown_mode(self):
+        utils.materialize(self.source, self.dest, 'move')
+
+
+class TestTrimVolumes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='trim')
+        self.data = np.arange(4 * 5 * 3 * 10, dtype=np.int16).reshape(
+                (4, 5, 3, 10))
+        image = nib.Nifti1Image(self.data, np.diag([2, 2, 3, 1]))
+        image.header.set_slope_inter(2, 1)
+        image.header.set_zooms((2, 2, 3, 1.5))
+        self.source = os.path.join(self.tmp, 'bold.nii.gz')
+        image.to_filename(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_drops_leading_volumes(self):
+        dest = os.path.join(self.tmp, 'trimmed.nii.gz')
+        utils.trim_volumes(self.source, dest, 4)
+
+        trimmed = nib.load(dest)
+        assert trimmed.shape == (4, 5, 3, 6)
+        assert trimmed.get_data_dtype() == np.int16
+        assert trimmed.header.get_zooms() == (2, 2, 3, 1.5)
+        assert np.allclose(trimmed.get_fdata(), self.data[..., 4:] * 2 + 1)
+
+    @raises(ValueError)
+    def test_raises_exception_when_too_many_volumes_dropped(self):
+        utils.trim_volumes(self.source, os.path.join(self.tmp, 'out.nii'),
+                10)
+
+
+def _add_checklist_entry(args):
+    path, num = args
+    utils.update_checklist({'STUDY_CMH_{:04}_01'.format(num): 'ok'},
+            path=path)